@@ -0,0 +1,105 @@
+import sys
+import time
+import shutil
+import tempfile
+import logging
+import argparse
+import numpy as np
+from nnet_trainer import NNTrainer
+
+logger = logging.getLogger('__main__')
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler(sys.stderr))
+
+if __name__ != '__main__':
+  raise ImportError ('This script can only be run, and can\'t be imported')
+
+logger.info(" ".join(sys.argv))
+
+arg_parser = argparse.ArgumentParser(
+  description = 'training steps per second of a frame dnn on random data, '
+                'for each steps_per_run, on the cpu unless --use-gpu')
+arg_parser.add_argument('--use-gpu', dest = 'use_gpu', action = 'store_true')
+arg_parser.add_argument('--input-dim', type = int, default = 440)
+arg_parser.add_argument('--output-dim', type = int, default = 2000)
+arg_parser.add_argument('--hidden-units', type = int, default = 512)
+arg_parser.add_argument('--hidden-layers', type = int, default = 4)
+arg_parser.add_argument('--batch-size', type = int, default = 64)
+arg_parser.add_argument('--num-batches', type = int, default = 2000)
+arg_parser.add_argument('--input-pipeline', type = str, default = 'feed')
+arg_parser.add_argument('--steps-per-run', type = str, default = '1,4,16,64',
+                        help = 'comma separated, one benchmark each')
+arg_parser.set_defaults(use_gpu = False)
+args = arg_parser.parse_args()
+
+
+class RandomFrames:
+  ''' the part of FrameDataGenerator that iter_data uses, on random frames generated up front '''
+  def __init__ (self, args):
+    self.batch_size = args.batch_size
+    self.num_batches = args.num_batches
+    random_state = np.random.RandomState(777)
+    # a pool of batches cycled through, so generating them is not timed
+    self.x = random_state.randn(16, self.batch_size, args.input_dim).astype('float32')
+    self.y = random_state.randint(0, args.output_dim, (16, self.batch_size)).astype('int32')
+    self.batch_counter = 0
+
+  def get_batch_frames(self):
+    if self.batch_counter == self.num_batches:
+      return None, None
+    index = self.batch_counter % len(self.x)
+    self.batch_counter += 1
+    return self.x[index], self.y[index]
+
+  def get_batch_size(self):
+    return self.batch_size
+
+  def get_last_batch_counts(self):
+    return self.batch_size
+
+  def count_units(self):
+    return 'frames'
+
+  def reset_batch(self):
+    self.batch_counter = 0
+
+
+tmp_dir = tempfile.mkdtemp()
+feature_conf = { 'batch_size': args.batch_size, 'input_pipeline': args.input_pipeline }
+train_params = { 'learning_rate': 0.008 }
+
+results = []
+for steps_per_run in [ int(x) for x in args.steps_per_run.split(',') ]:
+  nnet_conf = { 'nnet_arch': 'dnn', 'hidden_units': args.hidden_units,
+                'num_hidden_layers': args.hidden_layers, 'nonlin': 'Sigmoid',
+                'with_softmax': False, 'steps_per_run': steps_per_run }
+  if args.input_pipeline == 'queue':
+    feature_conf['input_queue_capacity'] = max(16, steps_per_run)
+
+  nnet = NNTrainer(nnet_conf, args.input_dim, args.output_dim, feature_conf,
+                   use_gpu = args.use_gpu, gpu_ids = '1')
+  nnet_proto_file = tmp_dir+'/nnet.proto'
+  nnet.make_proto(nnet_conf, nnet_proto_file)
+  nnet.init_nnet(nnet_proto_file)
+  nnet.init_training({ 'op_type': 'sgd' })
+
+  data_gen = RandomFrames(args)
+  # warm up: the first runs allocate and optimize the graph
+  data_gen.num_batches = 4 * steps_per_run
+  nnet.iter_data(tmp_dir+'/warmup.log', data_gen, train_params)
+  data_gen.num_batches = args.num_batches
+
+  start_time = time.time()
+  loss, acc = nnet.iter_data(tmp_dir+'/train.log', data_gen, train_params)
+  duration = time.time() - start_time
+
+  results.append((steps_per_run, args.num_batches / duration))
+  logger.info("steps_per_run %3d: %.1f steps per sec, avg loss %.6f, acc %s",
+              steps_per_run, args.num_batches / duration, loss, acc)
+  nnet.__exit__()
+
+shutil.rmtree(tmp_dir)
+
+base = results[0][1]
+for steps_per_run, steps_per_sec in results:
+  print("steps_per_run %3d: %8.1f steps/sec  x%.2f" % (steps_per_run, steps_per_sec, steps_per_sec / base))
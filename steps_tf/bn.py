@@ -4,12 +4,16 @@ import make_nnet_proto
 
 class BN(object):
 
-  def __init__(self, input_dim, output_dim, batch_size, num_towers = 1):
+  def __init__(self, input_dim, output_dim, batch_size, num_towers = 1, input_queue = 0):
     self.type = 'bn'
     self.input_dim = input_dim
     self.output_dim = output_dim
     self.batch_size = batch_size
     self.num_towers = num_towers
+    # capacity of the input queue in front of the placeholders, 0 to feed them
+    self.input_queue = input_queue
+    self.enqueue_op = None
+    self.enqueue_holders = []
 
 
   def get_input_dim(self):
@@ -30,6 +34,7 @@ class BN(object):
       self.init_bn_single(graph, nnet_proto_file, seed)
     else:
       self.init_bn_multi(graph, nnet_proto_file, seed)
+    self.enqueue_op, self.enqueue_holders = nnet.read_input_queue(graph)
 
 
   def init_bn_single(self, graph, nnet_proto_file, seed = 777):
@@ -38,6 +43,9 @@ class BN(object):
     with graph.as_default():
       tf.set_random_seed(seed)
       feats_holder, labels_holder = nnet.placeholder_dnn(self.input_dim, self.batch_size)
+      if self.input_queue > 0:
+        feats_holder, labels_holder = nnet.input_queue([feats_holder, labels_holder],
+                                                       self.input_queue)
       keep_prob_holder = tf.placeholder(tf.float32, shape=[], name = 'keep_prob')
       
       logits, bn_outputs = nnet.inference_bn(feats_holder, nnet_proto_file, keep_prob_holder)
@@ -67,6 +75,9 @@ class BN(object):
       feats_holder, labels_holder = nnet.placeholder_bn(
                                       self.input_dim, 
                                       self.batch_size * self.num_towers)
+      if self.input_queue > 0:
+        feats_holder, labels_holder = nnet.input_queue([feats_holder, labels_holder],
+                                                       self.input_queue)
       
       keep_prob_holder = tf.placeholder(tf.float32, shape=[], name = 'keep_prob')
       
@@ -120,6 +131,7 @@ class BN(object):
       self.read_bn_single(graph)
     else:
       self.read_bn_multi(graph, load_towers)
+    self.enqueue_op, self.enqueue_holders = nnet.read_input_queue(graph)
 
 
   def read_bn_single(self, graph):
@@ -223,6 +235,11 @@ class BN(object):
     return self.train_op
 
 
+  def get_bucket_metrics(self):
+    ''' [loss, eval acc] of each bucket, the loss as get_loss returns it; one bucket here '''
+    return [ [self.loss, self.eval_acc] ]
+
+
   def prep_feed(self, data_gen, train_params):
     x, y = data_gen.get_batch_frames()
 
@@ -235,12 +252,37 @@ class BN(object):
                   self.learning_rate_holder: train_params['learning_rate'],
                   self.keep_prob_holder: 1.0})
 
-    return feed_dict, x is not None
+    return nnet.check_feed(feed_dict), x is not None
 
   
+  def has_input_queue(self):
+    return self.enqueue_op is not None
+
+
+  def get_enqueue_op(self):
+    return self.enqueue_op
+
+
+  def prep_enqueue_feed(self, data_gen):
+    x, y = data_gen.get_batch_frames()
+    feed_dict = dict(zip(self.enqueue_holders, [x, y]))
+    return nnet.check_feed(feed_dict), x is not None
+
+
+  def prep_params_feed(self, params = None):
+    ''' feed_dict for a step on a queued batch, i.e. everything prep_feed feeds but the batch '''
+    feed_dict = { self.keep_prob_holder: 1.0 }
+
+    if params is not None:
+      feed_dict.update({
+                  self.learning_rate_holder: params.get('learning_rate', 0.0)})
+
+    return feed_dict
+
+
   def prep_forward_feed(self, x):
     feed_dict = { self.feats_holder: x}
-    return feed_dict
+    return nnet.check_feed(feed_dict)
   
   
   def get_outputs(self):
@@ -0,0 +1,127 @@
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+
+def splice_rows(rows, splice):
+  '''
+  input:
+    rows: np matrix [num_frames + 2*splice, dim], one row per raw frame, edges included
+  output:
+    np matrix [num_frames, (2*splice+1) * dim], laid out like the spliced features
+  '''
+  rows = numpy.ascontiguousarray(rows)
+  num_frames = len(rows) - 2 * splice
+  row_stride, col_stride = rows.strides
+  windows = as_strided(rows, shape = (num_frames, 2 * splice + 1, rows.shape[1]),
+                       strides = (row_stride, row_stride, col_stride))
+  return windows.reshape(num_frames, -1)
+
+
+def edge_pad(rows, splice):
+  # the context beyond the utterance repeats the edge frames, like splice-feats
+  return numpy.pad(rows, ((splice, splice), (0, 0)), mode = 'edge')
+
+
+def add_noise(feat, labels, random_state, augmenter):
+  '''
+  gaussian noise of stddev augment_noise; the noise is drawn per raw frame, so all copies
+  of a frame in the spliced features get the same noise
+  '''
+  raw_dim = feat.shape[1] // (2 * augmenter.splice + 1)
+  noise = random_state.normal(0.0, augmenter.noise, (len(feat), raw_dim)).astype('float32')
+  feat += splice_rows(edge_pad(noise, augmenter.splice), augmenter.splice)
+  return feat, labels
+
+
+def mask_time(feat, labels, random_state, augmenter):
+  ''' time_masks spans of up to time_mask_width raw frames set to 0, the global mean '''
+  raw_dim = feat.shape[1] // (2 * augmenter.splice + 1)
+  masked = numpy.zeros((len(feat), 1), dtype = 'float32')
+  for width in random_state.randint(0, augmenter.time_mask_width + 1, augmenter.time_masks):
+    start = random_state.randint(0, max(1, len(feat) - width + 1))
+    masked[start:start+width] = 1.0
+  keep = 1.0 - splice_rows(edge_pad(masked, augmenter.splice), augmenter.splice)
+  feat *= numpy.repeat(keep, raw_dim, axis = 1)
+  return feat, labels
+
+
+def mask_freq(feat, labels, random_state, augmenter):
+  ''' freq_masks bands of up to freq_mask_width bins set to 0, in every frame of the context '''
+  context = 2 * augmenter.splice + 1
+  keep = numpy.ones(feat.shape[1] // context, dtype = 'float32')
+  for width in random_state.randint(0, augmenter.freq_mask_width + 1, augmenter.freq_masks):
+    start = random_state.randint(0, max(1, len(keep) - width + 1))
+    keep[start:start+width] = 0.0
+  feat *= numpy.tile(keep, context)
+  return feat, labels
+
+
+def perturb_speed(feat, labels, random_state, augmenter):
+  '''
+  frame rate changed by a random factor within 1 +- speed_perturb, by dropping or repeating
+  spliced frames; frame labels follow their frames
+  '''
+  rate = random_state.uniform(1.0 - augmenter.speed_perturb, 1.0 + augmenter.speed_perturb)
+  index = numpy.arange(0.0, len(feat), rate).astype('int64')
+  if labels is not None:
+    labels = labels[index]
+  return feat[index], labels
+
+
+# name in "augment = ..." -> function (feat, labels, random_state, augmenter) -> (feat, labels)
+AUGMENTATIONS = { 'noise': add_noise,
+                  'time_mask': mask_time,
+                  'freq_mask': mask_freq,
+                  'speed': perturb_speed }
+
+
+class Augmenter:
+  '''
+  augments the utterances of a split after they are read, spliced and normalized, before they
+  are packed; it runs where the split is prepared, in the split workers if there are any.
+  Nothing is stored on disk, every pass over the data is augmented anew.
+  enabled for the training data with "augment = <names>" in the [feature] section,
+  comma separated names of AUGMENTATIONS, applied in that order
+  '''
+  def __init__ (self, names, conf, splice):
+    for name in names:
+      if name not in AUGMENTATIONS:
+        raise RuntimeError('augmentation %s not supported' % name)
+    self.names = names
+    self.splice = splice
+    self.noise = conf.get('augment_noise', 0.1)
+    self.time_masks = conf.get('time_masks', 2)
+    self.time_mask_width = conf.get('time_mask_width', 20)
+    self.freq_masks = conf.get('freq_masks', 2)
+    self.freq_mask_width = conf.get('freq_mask_width', 8)
+    self.speed_perturb = conf.get('speed_perturb', 0.1)
+
+
+  def apply(self, features, labels, random_state):
+    '''
+    input:
+      features: list of float32 np matrix [num_frames, feat_dim], changed in place
+      labels: list of np array [num_frames], frame labels, or None
+      random_state: np RandomState, or numpy.random
+    output:
+      features, labels; lengths change with speed
+    '''
+    features = list(features)
+    labels = None if labels is None else list(labels)
+    for i in range(len(features)):
+      feat = features[i]
+      lab = None if labels is None else labels[i]
+      for name in self.names:
+        feat, lab = AUGMENTATIONS[name](feat, lab, random_state, self)
+      features[i] = feat
+      if labels is not None:
+        labels[i] = lab
+    return features, labels
+
+
+def make_augmenter(conf, splice):
+  ''' the Augmenter of "augment" in conf, None without '''
+  names = [ name.strip() for name in conf.get('augment', '').split(',') if name.strip() ]
+  if len(names) == 0:
+    return None
+  return Augmenter(names, conf, splice)
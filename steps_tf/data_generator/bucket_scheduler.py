@@ -0,0 +1,107 @@
+import numpy
+from windowed_split import split_state, split_from_state
+
+
+class BucketScheduler:
+  '''
+  windows of several buckets in one WindowedSplit, each window with a bucket of its own.
+  Every batch is drawn from one bucket, picked at random in proportion to the windows it has
+  left; windows that do not fill a batch are carried over to the next split instead of dropped.
+  '''
+  def __init__ (self, buckets, batch_size):
+    '''
+    input:
+      buckets: list of window lengths, a batch is padded to the length of its bucket
+    '''
+    self.buckets = buckets
+    self.batch_size = batch_size
+    self.split = None
+    self.window_bucket = numpy.empty(0, dtype = 'int64')
+    # windows of each bucket not batched yet, in the order they are batched
+    self.queues = [ numpy.empty(0, dtype = 'int64') for b in buckets ]
+
+
+  def num_left(self):
+    return sum(len(queue) for queue in self.queues)
+
+
+  def add(self, split, window_bucket, shuffle = False):
+    '''
+    replace the windows that are batched already by those of split
+    input:
+      split: WindowedSplit
+      window_bucket: np array, bucket of each window of split
+      shuffle: shuffle the windows, the carried ones with them
+    '''
+    if self.num_left() > 0:
+      left = numpy.concatenate(self.queues)
+      split = split.prepend(self.split, left)
+      window_bucket = numpy.append(self.window_bucket[left], window_bucket)
+    if shuffle:
+      order = numpy.random.permutation(len(split))
+      split.permute(order)
+      window_bucket = window_bucket[order]
+    self.split = split
+    self.window_bucket = window_bucket
+    self.queues = [ numpy.where(window_bucket == b)[0] for b in range(len(self.buckets)) ]
+
+
+  def ready(self):
+    ''' whether a full batch is left in any bucket '''
+    return any(len(queue) >= self.batch_size for queue in self.queues)
+
+
+  def choose_bucket(self):
+    ''' a bucket with a full batch, picked with probability proportional to its windows '''
+    sizes = numpy.array([ len(queue) if len(queue) >= self.batch_size else 0
+                          for queue in self.queues ], dtype = 'float64')
+    return numpy.random.choice(len(sizes), p = sizes / sizes.sum())
+
+
+  def next_batch(self, buffers):
+    '''
+    input:
+      buffers: see WindowedSplit.take
+    output:
+      bucket_id, and the batch as WindowedSplit.take returns it, padded to buckets[bucket_id]
+    '''
+    bucket_id = self.choose_bucket()
+    index = self.queues[bucket_id][:self.batch_size]
+    self.queues[bucket_id] = self.queues[bucket_id][self.batch_size:]
+    return bucket_id, self.split.take(index, buffers, self.buckets[bucket_id])
+
+
+  def left_state(self):
+    '''
+    the windows not batched yet, with only their frames, as a dict of np arrays; less than
+    a batch per bucket once no bucket is ready, see generator_state.load_point
+    '''
+    if self.split is None:
+      return {}
+    left = numpy.concatenate(self.queues)
+    state = split_state(self.split.select(left), 'left_')
+    state['left_window_bucket'] = self.window_bucket[left]
+    return state
+
+
+  def set_left(self, state):
+    ''' hold the windows of left_state, in the order they were left '''
+    if 'left_window_bucket' not in state:
+      self.split = None
+      self.window_bucket = numpy.empty(0, dtype = 'int64')
+      self.queues = [ numpy.empty(0, dtype = 'int64') for b in self.buckets ]
+      return
+    self.split = split_from_state(state, 'left_')
+    self.window_bucket = state['left_window_bucket']
+    self.queues = [ numpy.where(self.window_bucket == b)[0] for b in range(len(self.buckets)) ]
+
+
+  def get_state(self):
+    ''' how many windows of each bucket are not batched yet, for a generator checkpoint '''
+    return dict(('scheduler_queue_left_%d' % b, len(queue)) for b, queue in enumerate(self.queues))
+
+
+  def set_state(self, state):
+    ''' skip the windows batched before get_state, once the split is loaded again '''
+    for b, queue in enumerate(self.queues):
+      self.queues[b] = queue[len(queue) - int(state['scheduler_queue_left_%d' % b]):]
@@ -0,0 +1,142 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import numpy
+from kaldi_io import kaldi_io_numpy
+from feature_index import FeatureIndex
+
+logger = logging.getLogger('__main__')
+
+
+def utterance_stats(feat, splice):
+  '''
+  stats of the spliced features of one utterance, without splicing: the block of offset o
+  is feat[clip(t+o)], i.e. all frames, less the first (or last) o frames, plus o copies of the
+  last (or first) frame, as splice-feats repeats the edge frames
+  input:
+    feat: np matrix [num_frames, raw_dim], unspliced
+  output:
+    count: number of frames
+    mean, m2: float64 np matrix [2*splice+1, raw_dim], mean and sum of squared deviations
+              of each block of the spliced features
+  '''
+  num_frames = len(feat)
+  feat_mean = feat.mean(axis = 0, dtype = numpy.float64)
+  # centered per utterance, so the sums of squares do not lose precision
+  centered = feat - feat_mean
+  squared = centered * centered
+  total = centered.sum(axis = 0)
+  total_squared = squared.sum(axis = 0)
+
+  sums = numpy.empty((2*splice+1, feat.shape[1]))
+  sums_squared = numpy.empty((2*splice+1, feat.shape[1]))
+  sums[splice] = total
+  sums_squared[splice] = total_squared
+  for k in range(1, splice+1):
+    m = min(k, num_frames)
+    sums[splice+k] = total - centered[:m].sum(axis = 0) + m * centered[-1]
+    sums_squared[splice+k] = total_squared - squared[:m].sum(axis = 0) + m * squared[-1]
+    sums[splice-k] = total - centered[-m:].sum(axis = 0) + m * centered[0]
+    sums_squared[splice-k] = total_squared - squared[-m:].sum(axis = 0) + m * squared[0]
+
+  mean = feat_mean + sums / num_frames
+  m2 = sums_squared - sums * sums / num_frames
+  return num_frames, mean, m2
+
+
+def merge_stats(a, b):
+  ''' the stats of a and b together, (count, mean, m2) each, by Chan et al.'s parallel update '''
+  count_a, mean_a, m2_a = a
+  count_b, mean_b, m2_b = b
+  if count_a == 0:
+    return b
+  count = count_a + count_b
+  delta = mean_b - mean_a
+  mean = mean_a + delta * (1.0 * count_b / count)
+  m2 = m2_a + m2_b + delta * delta * (1.0 * count_a * count_b / count)
+  return count, mean, m2
+
+
+def accumulate_stats(scp_file, utt_ids, splice):
+  ''' merged stats of utt_ids, read from scp_file '''
+  index = FeatureIndex(scp_file)
+  stats = (0, 0.0, 0.0)
+  for uid in utt_ids:
+    feat = index[uid]
+    if len(feat) > 0:
+      stats = merge_stats(stats, utterance_stats(feat, splice))
+  index.close()
+  return stats
+
+
+def accumulate_stats_job(args):
+  # Pool.map passes one argument
+  return accumulate_stats(*args)
+
+
+def stats_key(scp_file, splice, num_utts, seed):
+  ''' identifies the stats: the contents of the scp and everything the sample depends on '''
+  md5 = hashlib.md5()
+  with open(scp_file, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      md5.update(block)
+  return '%s splice=%d utts=%d seed=%d' % (md5.hexdigest(), splice, num_utts, seed)
+
+
+def compute_cmvn(scp_file, splice, cmvn_file, num_utts = 10000, num_jobs = None, seed = 777):
+  '''
+  global cmvn stats of the spliced features, like
+  "splice-feats | compute-cmvn-stats", but on unspliced features in num_jobs processes.
+  The stats are cached: <cmvn_file>.key records what they were computed from, and as long as
+  it matches they are not computed again, e.g. when training is resumed.
+  input:
+    scp_file: features, unspliced
+    splice: context width
+    cmvn_file: written as a double matrix [2, feat_dim+1], as compute-cmvn-stats does
+    num_utts: size of the random sample of utterances, 0 for all
+  '''
+  key = stats_key(scp_file, splice, num_utts, seed)
+  if os.path.exists(cmvn_file) and os.path.exists(cmvn_file + '.key'):
+    with open(cmvn_file + '.key') as f:
+      if f.read().strip() == key:
+        logger.info('cmvn stats in %s are up to date' % cmvn_file)
+        return
+
+  index = FeatureIndex(scp_file)
+  utt_ids = index.keys()
+  index.close()
+  if num_utts > 0 and num_utts < len(utt_ids):
+    sample = numpy.random.RandomState(seed).choice(len(utt_ids), num_utts, replace = False)
+    utt_ids = [ utt_ids[i] for i in sorted(sample) ]
+
+  if num_jobs is None:
+    num_jobs = multiprocessing.cpu_count()
+  num_jobs = max(1, min(num_jobs, len(utt_ids)))
+  bounds = numpy.linspace(0, len(utt_ids), num_jobs + 1).astype('int64')
+  chunks = [ (scp_file, utt_ids[bounds[i]:bounds[i+1]], splice) for i in range(num_jobs) ]
+  if num_jobs == 1:
+    results = [ accumulate_stats_job(chunks[0]) ]
+  else:
+    pool = multiprocessing.Pool(num_jobs)
+    try:
+      results = pool.map(accumulate_stats_job, chunks)
+    finally:
+      pool.close()
+      pool.join()
+
+  stats = (0, 0.0, 0.0)
+  for result in results:
+    stats = merge_stats(stats, result)
+  count, mean, m2 = stats
+  if count == 0:
+    raise RuntimeError('no frames to compute cmvn stats from in %s' % scp_file)
+
+  cmvn = numpy.zeros((2, mean.size + 1))
+  cmvn[0, :-1] = mean.reshape(-1) * count
+  cmvn[0, -1] = count
+  cmvn[1, :-1] = (m2 + mean * mean * count).reshape(-1)
+  kaldi_io_numpy.write_kaldi_object(cmvn_file, cmvn, 'matrix', numpy.float64)
+  with open(cmvn_file + '.key', 'w') as f:
+    f.write(key + '\n')
+  logger.info('cmvn stats of %d frames of %d utterances written to %s' % (count, len(utt_ids), cmvn_file))
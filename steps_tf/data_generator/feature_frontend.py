@@ -0,0 +1,121 @@
+import numpy
+from numpy.lib.stride_tricks import as_strided
+from kaldi_io import kaldi_io_numpy
+from feature_index import FeatureIndex
+
+# same variance floor as apply-cmvn
+VAR_FLOOR = 1.0e-20
+
+class NativeFrontend:
+  '''
+  in-process replacement for "splice-feats | apply-cmvn --norm-vars=true cmvn.mat"
+  enabled with "frontend = native" in the [feature] section
+  '''
+  def __init__ (self, cmvn_file, splice):
+    self.splice = splice
+    self.scale, self.offset = self.load_cmvn(cmvn_file)
+    self.feat_dim = len(self.scale)
+
+
+  def load_cmvn(self, cmvn_file):
+    '''
+    input:
+      cmvn_file: global stats from compute-cmvn-stats, [2, feat_dim+1]
+    output:
+      scale, offset: float32 np array [feat_dim], normalized = feat * scale + offset
+    '''
+    stats = kaldi_io_numpy.read_kaldi_object(cmvn_file, 'matrix', numpy.float64)
+    count = stats[0, -1]
+    if count < 1.0:
+      raise RuntimeError('Insufficient stats for cepstral mean and variance normalization: count = %f' % count)
+    mean = stats[0, :-1] / count
+    var = stats[1, :-1] / count - mean * mean
+    var = numpy.maximum(var, VAR_FLOOR)
+    scale = 1.0 / numpy.sqrt(var)
+    offset = - mean * scale
+    return scale.astype(numpy.float32), offset.astype(numpy.float32)
+
+
+  def splice_feats(self, feat, out = None):
+    '''
+    input:
+      feat: np matrix [num_frames, raw_dim]
+      out: optional np matrix [num_frames, raw_dim * (2*splice+1)] to write to
+    output:
+      spliced features, the first and last frames are repeated at the edges like splice-feats
+    '''
+    num_frames, raw_dim = feat.shape
+    context = 2 * self.splice + 1
+    padded = numpy.pad(feat, ((self.splice, self.splice), (0, 0)), mode = 'edge')
+    padded = numpy.ascontiguousarray(padded, dtype = numpy.float32)
+    row_stride, col_stride = padded.strides
+    windows = as_strided(padded, shape = (num_frames, context, raw_dim),
+                         strides = (row_stride, row_stride, col_stride))
+    if out is None:
+      out = numpy.empty((num_frames, context * raw_dim), dtype = numpy.float32)
+    out.reshape(num_frames, context, raw_dim)[...] = windows
+    return out
+
+
+  def normalize(self, feats):
+    ''' apply the global cmvn in place '''
+    feats *= self.scale
+    feats += self.offset
+    return feats
+
+
+  def splice_batch(self, frames, index, lo, hi):
+    '''
+    splice and normalize a batch from unspliced frames, for lazy splicing
+    input:
+      frames: np matrix [num_frames, raw_dim], unspliced and unnormalized
+      index: np array [batch_size], centre frames of the batch
+      lo, hi: np array [num_frames], first and last frame of the utterance of each frame;
+              context beyond them repeats the edge frame like splice-feats
+    output:
+      np matrix [batch_size, feat_dim], same as splicing and normalizing whole utterances
+    '''
+    offsets = numpy.arange(-self.splice, self.splice + 1)
+    rows = numpy.clip(index[:, None] + offsets, lo[index][:, None], hi[index][:, None])
+    batch = frames[rows].reshape(len(index), -1)
+    return self.normalize(batch)
+
+
+  def read_split(self, scp_file, uids = None, raw = False, alloc = None):
+    '''
+    input:
+      scp_file: a split scp file
+      uids: if given, utterances not in it are skipped
+      raw: neither splice nor normalize, for lazy splicing with splice_batch
+      alloc: optional function (num_frames, dim) -> float32 np matrix to read into,
+             e.g. a view of a preallocated buffer
+    output:
+      list of (uid, feat), feat is np matrix [num_frames, feat_dim]; all views of one float32 buffer
+    '''
+    index = FeatureIndex(scp_file)
+    utt_ids = [ uid for uid in index.keys() if uids is None or uid in uids ]
+    lengths = [ index.num_frames(uid) for uid in utt_ids ]
+
+    if raw:
+      dim = self.feat_dim // (2 * self.splice + 1)
+    else:
+      dim = self.feat_dim
+    if alloc is None:
+      buf = numpy.empty((sum(lengths), dim), dtype = numpy.float32)
+    else:
+      buf = alloc(sum(lengths), dim)
+    utterances = []
+    start = 0
+    for uid, length in zip(utt_ids, lengths):
+      feat = buf[start:start+length]
+      if raw:
+        feat[...] = index[uid]
+      else:
+        self.splice_feats(index[uid], feat)
+      utterances.append((uid, feat))
+      start += length
+    index.close()
+
+    if not raw:
+      self.normalize(buf)
+    return utterances
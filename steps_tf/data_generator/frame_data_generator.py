@@ -2,6 +2,14 @@ from subprocess import Popen, PIPE, check_output
 import tempfile
 import kaldi_io
 import kaldi_IO
+from feature_frontend import NativeFrontend
+from cmvn_stats import compute_cmvn
+from label_store import LabelStore, read_scp_keys
+from split_prefetcher import SplitPrefetcher
+from split_workers import SplitWorkerPool
+from split_planner import plan_splits, report_split_memory
+from shuffle_buffer import ShuffleBuffer
+from generator_state import rng_state, set_rng_state, load_point, reload_split
 import pickle
 import shutil
 import numpy
@@ -24,6 +32,21 @@ class FrameDataGenerator:
     self.delta_opts = conf.get('delta_opts', '')
     self.max_split_data_size = conf.get('max_split_data_size', 5000)
     self.clean_up = conf.get('clean_up', True)
+    self.frontend = conf.get('frontend', 'kaldi')
+    self.prefetch_splits = conf.get('prefetch_splits', 0)
+    self.split_workers = conf.get('split_workers', 0)
+    self.split_slots = conf.get('split_slots', 1)
+    self.shm_dir = conf.get('shm_dir', '/dev/shm')
+    # cut the data again into splits of about this many bytes in memory, see split_bytes
+    self.split_memory_budget = conf.get('split_memory_budget', 0)
+    # keep unspliced frames and splice each batch, needs the native frontend
+    self.lazy_splice = conf.get('lazy_splice', False)
+    # mix frames across splits in a buffer of this many frames
+    self.shuffle_buffer = conf.get('shuffle_buffer', 0)
+    # look labels up per split, by a merge-join of the split scp with a LabelStore
+    self.stream_labels = conf.get('stream_labels', False)
+    if self.stream_labels and not isinstance(self.labels, LabelStore):
+      raise RuntimeError('stream_labels needs the alignments in a LabelStore')
 
     if self.name == 'train':
       self.loop = conf.get('loop_mode', False)
@@ -45,39 +68,94 @@ class FrameDataGenerator:
     shutil.copyfile("%s/feats.%s.scp" % (self.data, self.name), "%s/%s.scp" % (self.exp, self.name))
 
     if name == 'train':
-      cmd = ['copy-feats', '\'scp:head -10000 %s/%s.scp |\'' % (exp, self.name), 'ark:- |']
-      cmd.extend(['splice-feats', '--left-context='+str(self.splice),
-                  '--right-context='+str(self.splice), 'ark:- ark:- |'])
-      cmd.extend(['compute-cmvn-stats', 'ark:-', exp+'/cmvn.mat'])
+      compute_cmvn('%s/%s.scp' % (self.exp, self.name), self.splice, self.exp+'/cmvn.mat',
+                   conf.get('cmvn_utts', 10000), conf.get('cmvn_jobs', None), seed)
 
-      Popen(' '.join(cmd), shell=True).communicate()
+    if self.frontend == 'native':
+      self.native_frontend = NativeFrontend(self.exp+'/cmvn.mat', self.splice)
+    elif self.lazy_splice:
+      raise RuntimeError('lazy_splice requires frontend = native')
+    if self.lazy_splice and self.shuffle_buffer > 0:
+      raise RuntimeError('lazy_splice does not work with shuffle_buffer')
+
+    self.feat_dim = int(open('%s/feat_dim' % self.data).read()) * (2*self.splice+1)
 
     self.num_split = int(open('%s/num_split.%s' % (self.data, self.name)).read())
-    for i in range(self.num_split):
-      shutil.copyfile("%s/feats.%s.%d.scp" % (self.data, self.name, (i+1)), "%s/split.%s.%d.scp" % (self.tmp_dir, self.name, i))
+    # utterances without labels are left out of the splits
+    split_scps = [ "%s/feats.%s.%d.scp" % (self.data, self.name, (i+1)) for i in range(self.num_split) ]
+    self.num_split = plan_splits(split_scps, "%s/split.%s" % (self.tmp_dir, self.name),
+                                 [self.labels], self.name,
+                                 self.split_bytes, self.split_memory_budget)
 
-    numpy.random.seed(seed)
+    self.prefetcher = None
+    if self.prefetch_splits > 0:
+      self.prefetcher = SplitPrefetcher(self, self.num_split, self.prefetch_splits)
 
-    self.feat_dim = int(open('%s/feat_dim' % self.data).read()) * (2*self.splice+1)
+    numpy.random.seed(seed)
 
-    self.x = numpy.empty ((0, self.feat_dim))
+    # x is a buffer of frames, which is reused for every split; batches are drawn from the rows
+    # in order, a shuffled permutation, so the frames themselves are never shuffled
+    self.x = numpy.empty ((0, self.feat_dim), dtype='float32')
     self.y = numpy.empty (0, dtype='int32')
+    self.order = numpy.empty (0, dtype='int64')
+
+    if self.lazy_splice:
+      # x holds unspliced frames, lo/hi the first and last frame of the utterance of each frame,
+      # and order the shuffled centers to splice batches around
+      self.x = numpy.empty ((0, self.feat_dim // (2*self.splice+1)), dtype='float32')
+      self.lo = numpy.empty (0, dtype='int64')
+      self.hi = numpy.empty (0, dtype='int64')
     
     self.batch_pointer = 0
+    # state before the last split was loaded, for get_state
+    self.load_point = None
+
+    self.buffer = None
+    if self.shuffle_buffer > 0:
+      self.buffer = ShuffleBuffer(self.shuffle_buffer)
+
+    # workers are forked here, once the generator is fully set up
+    self.worker_pool = None
+    if self.split_workers > 0:
+      self.worker_pool = SplitWorkerPool(self, self.num_split, self.split_workers,
+                                         self.split_slots, seed, self.shm_dir)
 
 
   def get_feat_dim(self):
     return self.feat_dim
 
 
+  def split_bytes(self, num_frames):
+    '''
+    estimated memory of an utterance in a loaded split, for split_memory_budget:
+    the spliced float32 frames (unspliced with lazy_splice, plus lo and hi), the int32 label
+    and the int64 entry in order. Splits read ahead by the prefetcher come on top of it.
+    '''
+    if self.lazy_splice:
+      return num_frames * (self.feat_dim // (2*self.splice+1) * 4 + 4 + 8 + 16)
+    return num_frames * (self.feat_dim * 4 + 4 + 8)
+
+
   def __del__(self):
+    if self.worker_pool is not None:
+      self.worker_pool.close()
+    if self.prefetcher is not None:
+      self.prefetcher.close()
     if self.clean_up and os.path.exists(self.tmp_dir):
       shutil.rmtree(self.tmp_dir)
 
 
+  def need_split(self):
+    # not enough data for next batch
+    if self.buffer is not None:
+      drain = not self.loop and self.split_data_counter == self.num_split
+      return not self.buffer.ready(self.batch_size, drain)
+    return self.batch_pointer + self.batch_size > len(self.order)
+
+
   def has_data(self):
     # has enough data for next batch
-    if self.batch_pointer + self.batch_size > len(self.x):
+    if self.need_split():
       if self.loop and (self.split_counter+1) % self.split_per_iter == 0:
         return False
       if not self.loop and self.split_data_counter == self.num_split:
@@ -92,33 +170,218 @@ class FrameDataGenerator:
       feat_list: list of np matrix [num_frames, feat_dim]
       label_list: list of int32 np array [num_frames] 
     '''
-
-    p1 = Popen (['splice-feats', '--print-args=false', '--left-context='+str(self.splice),
-                 '--right-context='+str(self.splice), 
-                 'scp:'+self.tmp_dir+'/split.'+self.name+'.'+str(self.split_data_counter)+'.scp',
-                 'ark:-'], stdout=PIPE, stderr=DEVNULL)
-    p2 = Popen (['apply-cmvn', '--print-args=false', '--norm-vars=true', self.exp+'/cmvn.mat',
-                 'ark:-', 'ark:-'], stdin=p1.stdout, stdout=PIPE, stderr=DEVNULL)
+    if self.prefetcher is not None:
+      return self.prefetcher.get(self.split_data_counter)
+    return self.read_split_data(self.split_data_counter)
+
+
+  def read_split_data (self, split_id, alloc = None):
+    split_scp = self.tmp_dir+'/split.'+self.name+'.'+str(split_id)+'.scp'
+    labels = self.labels
+    if self.stream_labels:
+      # only the labels of this split are copied out of the store
+      labels = self.labels.join(read_scp_keys(split_scp))
+    if self.frontend == 'native':
+      utterances = self.native_frontend.read_split(split_scp, labels, raw = self.lazy_splice,
+                                                   alloc = alloc)
+    else:
+      p1 = Popen (['splice-feats', '--print-args=false', '--left-context='+str(self.splice),
+                   '--right-context='+str(self.splice), 'scp:'+split_scp,
+                   'ark:-'], stdout=PIPE, stderr=DEVNULL)
+      p2 = Popen (['apply-cmvn', '--print-args=false', '--norm-vars=true', self.exp+'/cmvn.mat',
+                   'ark:-', 'ark:-'], stdin=p1.stdout, stdout=PIPE, stderr=DEVNULL)
+      utterances = kaldi_IO.read_ark(p2.stdout)
 
     feat_list = []
     label_list = []
-    
-    while True:
-      uid, feat = kaldi_IO.read_utterance (p2.stdout)
-      if uid == None:
-        break;
-      if uid in self.labels:
+
+    for uid, feat in utterances:
+      if uid in labels:
         feat_list.append (feat)
-        label_list.append (self.labels[uid])
+        label_list.append (labels[uid])
+
+    if self.frontend != 'native':
+      p1.stdout.close()
 
-    p1.stdout.close()
-    
     if len(feat_list) == 0 or len(label_list) == 0:
       raise RuntimeError("No feats are loaded! please check feature and labels, and make sure they are matched.")
 
     return (feat_list, label_list)
 
+
+  def prepare_split (self, split_id, random_state):
+    '''
+    read and shuffle a split, in a worker process of SplitWorkerPool
+    output:
+      x: np matrix [num_frames, feat_dim]
+      y: np array [num_frames]
+      with lazy_splice, unspliced x, y and the utterance lengths, not shuffled
+    '''
+    x, y = self.read_split_data(split_id)
+    if self.lazy_splice:
+      # shuffling is done on the centers in load_split_lazy
+      return numpy.vstack(x), numpy.hstack(y), numpy.array([len(i) for i in y])
+    x = numpy.vstack(x)
+    # labels may come as int16 from a LabelStore, the graph takes int32
+    y = numpy.hstack(y).astype('int32')
+    randomInd = random_state.permutation(len(x))
+    return x[randomInd], y[randomInd]
+
+
+  def load_split_lazy (self):
+    '''
+    append the next split to the frames left over, keeping them unspliced.
+    Each left over center is kept as a block of its 2*splice+1 context frames,
+    so the rest of the old split can be dropped.
+    '''
+    if self.worker_pool is not None:
+      x, y, lengths = self.worker_pool.get(self.split_data_counter)
+    else:
+      x, y = self.get_next_split_data()
+      lengths = numpy.array([len(i) for i in y])
+      x = numpy.vstack(x)
+      y = numpy.hstack(y)
+
+    left_x, left_y, left_lo, left_hi, left_order = self.lazy_left()
+    num_left_frames = len(left_x)
+
+    utt_start = numpy.cumsum(lengths) - lengths + num_left_frames
+    self.x = numpy.concatenate ((left_x, x))
+    self.y = numpy.append (left_y, y)
+    self.lo = numpy.append (left_lo, numpy.repeat(utt_start, lengths))
+    self.hi = numpy.append (left_hi, numpy.repeat(utt_start + lengths - 1, lengths))
+    self.order = numpy.append (left_order, numpy.arange(len(x)) + num_left_frames)
+    self.batch_pointer = 0
+
+    ## Shuffle data
+    randomInd = numpy.array(range(len(self.order)))
+    numpy.random.shuffle(randomInd)
+    self.order = self.order[randomInd]
+    report_split_memory(self.name, self.split_data_counter, [self.x, self.y, self.lo, self.hi, self.order])
+
+
+  def lazy_left (self):
+    '''
+    the centers not batched yet, each with a block of its 2*splice+1 context frames
+    output:
+      x, y, lo, hi, order of the blocks, as load_split_lazy keeps them
+    '''
+    context = 2 * self.splice + 1
+    left = self.order[self.batch_pointer:]
+    offsets = numpy.arange(-self.splice, self.splice + 1)
+    rows = numpy.clip(left[:, None] + offsets, self.lo[left][:, None], self.hi[left][:, None])
+    block_start = numpy.arange(len(left)) * context
+    return (self.x[rows.reshape(-1)], numpy.repeat(self.y[left], context),
+            numpy.repeat(block_start, context), numpy.repeat(block_start + context - 1, context),
+            block_start + self.splice)
+
+
+  def reserve (self, num_frames):
+    # grow the frame buffer; what it holds is not needed any more
+    if num_frames > len(self.x):
+      num_frames += num_frames // 8
+      feat_dim = self.x.shape[1]
+      self.x = None
+      self.y = None
+      self.x = numpy.empty ((num_frames, feat_dim), dtype='float32')
+      self.y = numpy.empty (num_frames, dtype='int32')
+
+
+  def load_split_ring (self):
+    '''
+    move the frames left over to the front of the frame buffer and put the next split behind them.
+    The native frontend reads straight into the buffer, so a split is held once.
+    '''
+    left = self.order[self.batch_pointer:]
+    num_left = len(left)
+    left_x = self.x[left]
+    left_y = self.y[left]
+
+    def alloc(num_frames, feat_dim):
+      self.reserve(num_left + num_frames)
+      return self.x[num_left:num_left+num_frames]
+
+    in_place = self.prefetcher is None and self.frontend == 'native'
+    if in_place:
+      x, y = self.read_split_data(self.split_data_counter, alloc)
+    else:
+      x, y = self.get_next_split_data()
+
+    num_frames = num_left + sum(len(i) for i in y)
+    self.reserve(num_frames)
+    self.x[:num_left] = left_x
+    self.y[:num_left] = left_y
+    start = num_left
+    for feat, lab in zip(x, y):
+      if not in_place:
+        self.x[start:start+len(lab)] = feat
+      self.y[start:start+len(lab)] = lab
+      start += len(lab)
+    self.batch_pointer = 0
+
+    ## Shuffle data
+    self.order = numpy.arange(num_frames)
+    numpy.random.shuffle(self.order)
+    report_split_memory(self.name, self.split_data_counter,
+                        [self.x[:num_frames], self.y[:num_frames], self.order])
+
+
+
+  def load_split_buffer (self):
+    # the buffer shuffles, a split from the workers is shuffled anyway
+    if self.worker_pool is not None:
+      x, y = self.worker_pool.get(self.split_data_counter)
+    else:
+      x, y = self.get_next_split_data()
+      x = numpy.vstack(x)
+      y = numpy.hstack(y).astype('int32')
+    report_split_memory(self.name, self.split_data_counter, [x, y])
+    self.buffer.add((x, y))
+
           
+  def load_split (self):
+    ''' load split split_data_counter behind the frames left '''
+    if self.buffer is not None:
+      self.load_split_buffer()
+      return
+    self.load_point = load_point(self)
+    if self.lazy_splice:
+      self.load_split_lazy()
+    elif self.worker_pool is not None:
+      # already shuffled by the worker; use the shared memory directly if nothing is left over
+      x, y = self.worker_pool.get(self.split_data_counter)
+      if self.batch_pointer < len(self.order):
+        left = self.order[self.batch_pointer:]
+        x = numpy.concatenate ((self.x[left], x))
+        y = numpy.append (self.y[left], y)
+      self.x = x
+      self.y = y
+      self.order = numpy.arange(len(x))
+      self.batch_pointer = 0
+      report_split_memory(self.name, self.split_data_counter, [self.x, self.y, self.order])
+    else:
+      self.load_split_ring()
+
+
+  def left_state(self):
+    ''' the frames not batched yet, less than a batch when a split is loaded, see load_point '''
+    if self.lazy_splice:
+      x, y, lo, hi, order = self.lazy_left()
+      return { 'left_x': x, 'left_y': y, 'left_lo': lo, 'left_hi': hi, 'left_order': order }
+    left = self.order[self.batch_pointer:]
+    return { 'left_x': self.x[left], 'left_y': self.y[left] }
+
+
+  def set_left(self, state):
+    self.x = state['left_x']
+    self.y = state['left_y']
+    if self.lazy_splice:
+      self.lo, self.hi, self.order = state['left_lo'], state['left_hi'], state['left_order']
+    else:
+      self.order = numpy.arange(len(self.y))
+    self.batch_pointer = 0
+
+
   ## Retrive a mini batch
   def get_batch_frames (self):
     '''
@@ -127,30 +390,27 @@ class FrameDataGenerator:
       y_mini: np array [num_frames]
     '''
     # read split data until we have enough for this batch
-    while (self.batch_pointer + self.batch_size > len (self.x)):
+    while (self.need_split()):
       if not self.has_data():
         # not loop mode and we arrive the end, do not read anymore
         return None, None
 
-      x,y = self.get_next_split_data()
-
-      self.x = numpy.concatenate ((self.x[self.batch_pointer:], numpy.vstack(x)))
-      self.y = numpy.append (self.y[self.batch_pointer:], numpy.hstack(y))
-      self.batch_pointer = 0
-
-      ## Shuffle data
-      randomInd = numpy.array(range(len(self.x)))
-      numpy.random.shuffle(randomInd)
-      self.x = self.x[randomInd]
-      self.y = self.y[randomInd]
+      self.load_split()
 
       self.split_counter += 1
       self.split_data_counter += 1
       if self.loop and self.split_data_counter == self.num_split:
         self.split_data_counter = 0
     
-    x_mini = self.x[self.batch_pointer:self.batch_pointer+self.batch_size]
-    y_mini = self.y[self.batch_pointer:self.batch_pointer+self.batch_size]
+    if self.buffer is not None:
+      _, (x_mini, y_mini) = self.buffer.sample(self.batch_size)
+    else:
+      index = self.order[self.batch_pointer:self.batch_pointer+self.batch_size]
+      if self.lazy_splice:
+        x_mini = self.native_frontend.splice_batch(self.x, index, self.lo, self.hi)
+      else:
+        x_mini = self.x[index]
+      y_mini = self.y[index]
     
     self.batch_pointer += self.batch_size
     self.last_batch_frames = len(y_mini)
@@ -158,6 +418,36 @@ class FrameDataGenerator:
     return x_mini, y_mini
 
   
+  def get_state(self):
+    '''
+    where the generator is in the data, for a step checkpoint: the split counters, the random
+    state, and the load point of the current split with the batches taken from it since;
+    set_state reads the split again instead of keeping its frames. Only the shuffle buffer
+    is kept as it is, it mixes many splits.
+    '''
+    state = rng_state()
+    state['split_counter'] = self.split_counter
+    state['split_data_counter'] = self.split_data_counter
+    if self.buffer is not None:
+      state.update(self.buffer.get_state())
+    elif self.load_point is not None:
+      state.update(self.load_point)
+      state['batch_pointer'] = self.batch_pointer
+    return state
+
+
+  def set_state(self, state):
+    ''' continue from get_state, with the batch after the last one before it '''
+    if self.buffer is not None:
+      self.buffer.set_state(state)
+    elif 'load_split_id' in state:
+      reload_split(self, state)
+      self.batch_pointer = int(state['batch_pointer'])
+    set_rng_state(state)
+    self.split_counter = int(state['split_counter'])
+    self.split_data_counter = int(state['split_data_counter'])
+
+
   def get_batch_size(self):
     return self.batch_size
 
@@ -179,9 +469,12 @@ class FrameDataGenerator:
 
   def save_target_counts(self, num_targets, output_file):
     # here I'm assuming training data is less than 10,000 hours
-    counts = numpy.zeros(num_targets, dtype='int64')
-    for alignment in self.labels.values():
-      counts += numpy.bincount(alignment, minlength = num_targets)
+    if isinstance(self.labels, LabelStore):
+      counts = self.labels.target_counts(num_targets)
+    else:
+      counts = numpy.zeros(num_targets, dtype='int64')
+      for alignment in self.labels.values():
+        counts += numpy.bincount(alignment, minlength = num_targets)
     # add a ``half-frame'' to all the elements to avoid zero-counts (decoding issue)
     counts = counts.astype(float) + 0.5
     numpy.savetxt(output_file, counts, fmt = '%.1f')
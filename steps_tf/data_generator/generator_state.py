@@ -0,0 +1,58 @@
+import os
+import numpy
+
+
+def rng_state(prefix = ''):
+  ''' the state of numpy.random, as a dict of np arrays, keys start with prefix '''
+  name, keys, pos, has_gauss, cached_gaussian = numpy.random.get_state()
+  return { prefix+'rng_keys': keys, prefix+'rng_pos': pos, prefix+'rng_has_gauss': has_gauss,
+           prefix+'rng_cached_gaussian': cached_gaussian }
+
+
+def set_rng_state(state, prefix = ''):
+  numpy.random.set_state(('MT19937', state[prefix+'rng_keys'], int(state[prefix+'rng_pos']),
+                          int(state[prefix+'rng_has_gauss']),
+                          float(state[prefix+'rng_cached_gaussian'])))
+
+
+def load_point(generator):
+  '''
+  where a generator is right before it loads a split: the split, the random state, the seq its
+  worker pool shuffles it with, and what is left of the splits before, less than a batch
+  (generator.left_state()). A checkpoint keeps this instead of the frames of the split.
+  '''
+  state = rng_state('load_')
+  state['load_split_id'] = generator.split_data_counter
+  if generator.worker_pool is not None:
+    state['load_seq'] = generator.worker_pool.next_seq()
+  state.update(generator.left_state())
+  return state
+
+
+def reload_split(generator, state):
+  '''
+  read the split of a load point again and load it on top of what was left, so the generator
+  holds what it held when the load point was kept; generator.load_split() does the load
+  '''
+  generator.set_left(state)
+  set_rng_state(state, 'load_')
+  generator.split_data_counter = int(state['load_split_id'])
+  if 'load_seq' in state:
+    generator.worker_pool.restart(generator.split_data_counter, int(state['load_seq']))
+  generator.load_split()
+
+
+def save_state(path, state):
+  '''
+  write the state of a data generator, a dict of np arrays and numbers, as an npz file;
+  the file is replaced in one step, a crash leaves the previous one
+  '''
+  tmp_path = path + '.tmp.npz'
+  numpy.savez(tmp_path, **state)
+  os.rename(tmp_path, path)
+
+
+def load_state(path):
+  ''' the dict written by save_state, numbers come back as 0-d np arrays '''
+  with numpy.load(path) as data:
+    return dict((key, data[key]) for key in data.files)
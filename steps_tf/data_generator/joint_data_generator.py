@@ -2,6 +2,17 @@ from subprocess import Popen, PIPE, check_output
 import tempfile
 import kaldi_io
 import kaldi_IO
+from feature_frontend import NativeFrontend
+from cmvn_stats import compute_cmvn
+from label_store import LabelStore, read_scp_keys
+from split_prefetcher import SplitPrefetcher
+from split_workers import SplitWorkerPool
+from split_planner import plan_splits, report_split_memory
+from shuffle_buffer import ShuffleBuffer
+from augment import make_augmenter
+from generator_state import rng_state, set_rng_state, load_point, reload_split
+from windowed_split import WindowedSplit, flatten_split, window_starts
+from bucket_scheduler import BucketScheduler
 import pickle
 import shutil
 import numpy
@@ -27,14 +38,29 @@ class JointDNNDataGenerator:
     self.feat_type = conf.get('feat_type', 'raw')
     self.fit_buckets = conf.get('fit_buckets', True)
     self.clean_up = conf.get('clean_up', True)
+    self.frontend = conf.get('frontend', 'kaldi')
+    self.prefetch_splits = conf.get('prefetch_splits', 0)
+    self.split_workers = conf.get('split_workers', 0)
+    self.split_slots = conf.get('split_slots', 1)
+    self.shm_dir = conf.get('shm_dir', '/dev/shm')
+    # cut the data again into splits of about this many bytes in memory, see split_bytes
+    self.split_memory_budget = conf.get('split_memory_budget', 0)
+    # mix segments across splits in a buffer of this many frames, with a pool per bucket
+    self.shuffle_buffer = conf.get('shuffle_buffer', 0)
+    # look labels up per split, by a merge-join of the split scp with a LabelStore
+    self.stream_labels = conf.get('stream_labels', False)
+    if self.stream_labels and not isinstance(self.asr_labels, LabelStore):
+      raise RuntimeError('stream_labels needs the alignments in a LabelStore')
     self.buckets = buckets
 
     if self.name == 'train':
       self.loop = conf.get('loop_mode', False)
       self.split_per_iter = conf.get('split_per_iter', None)
+      self.augmenter = make_augmenter(conf, self.splice)
     else:
       self.loop = False
       self.split_per_iter = None
+      self.augmenter = None
     self.split_counter = 0        # keep increasing
     self.split_data_counter = 0   # loop from 0 to num_split
     if self.loop and self.split_per_iter is None:
@@ -52,44 +78,81 @@ class JointDNNDataGenerator:
     shutil.copyfile("%s/feats.%s.scp" % (self.data, self.name), "%s/%s.scp" % (self.exp, self.name))
 
     if name == 'train':
-      cmd = ['copy-feats', '\'scp:head -10000 %s/%s.scp |\'' % (exp, self.name), 'ark:- |']
+      compute_cmvn('%s/%s.scp' % (self.exp, self.name), self.splice, self.exp+'/cmvn.mat',
+                   conf.get('cmvn_utts', 10000), conf.get('cmvn_jobs', None), seed)
 
-      cmd.extend(['splice-feats', '--left-context='+str(self.splice), 
-                  '--right-context='+str(self.splice), 'ark:- ark:- |'])
-      
-      cmd.extend(['compute-cmvn-stats', 'ark:-', exp+'/cmvn.mat'])
+    if self.frontend == 'native':
+      self.native_frontend = NativeFrontend(self.exp+'/cmvn.mat', self.splice)
 
-      Popen(' '.join(cmd), shell=True).communicate()
+    self.feat_dim = int(open('%s/feat_dim' % self.data).read()) * (2*self.splice+1)
 
     self.num_split = int(open('%s/num_split.%s' % (self.data, self.name)).read())
 
-    for i in range(self.num_split):
-      shutil.copyfile("%s/feats.%s.%d.scp" % (self.data, self.name, (i+1)), "%s/split.%s.%d.scp" % (self.tmp_dir, self.name, i))
+    # utterances without labels are left out of the splits
+    split_scps = [ "%s/feats.%s.%d.scp" % (self.data, self.name, (i+1)) for i in range(self.num_split) ]
+    self.num_split = plan_splits(split_scps, "%s/split.%s" % (self.tmp_dir, self.name),
+                                 [self.asr_labels, self.sid_labels], self.name,
+                                 self.split_bytes, self.split_memory_budget)
+
+    self.prefetcher = None
+    if self.prefetch_splits > 0:
+      self.prefetcher = SplitPrefetcher(self, self.num_split, self.prefetch_splits)
 
     numpy.random.seed(seed)
 
-    self.feat_dim = int(open('%s/feat_dim' % self.data).read()) * (2*self.splice+1)
     
-    self.x = numpy.empty ((0, self.max_length, self.feat_dim))  # features
-    self.y = numpy.empty ((0, self.max_length), dtype='int32')  # asr_labels
-    self.z = numpy.empty (0, dtype='int32')                     # sid_labels
-    self.mask = numpy.empty ((0, self.max_length), dtype='float32')
+    # segments of the current split, of all buckets; batches are gathered into batch_buffers
+    self.scheduler = BucketScheduler(self.buckets, self.batch_size)
+    self.batch_buffers = {}
+
+    # state before the last split was loaded, for get_state
+    self.load_point = None
 
-    self.batch_pointer = 0
+    self.buffer = None
+    if self.shuffle_buffer > 0:
+      self.buffer = ShuffleBuffer(self.shuffle_buffer)
+
+    # workers are forked here, once the generator is fully set up
+    self.worker_pool = None
+    if self.split_workers > 0:
+      self.worker_pool = SplitWorkerPool(self, self.num_split, self.split_workers,
+                                         self.split_slots, seed, self.shm_dir)
 
     
   def get_feat_dim(self):
     return self.feat_dim
 
 
+  def split_bytes(self, num_frames):
+    '''
+    estimated memory of an utterance in a loaded split, for split_memory_budget:
+    the float32 frames and int32 labels, and 40 bytes of records per segment for the smallest
+    bucket, which has the most. Splits read ahead by the prefetcher come on top of it.
+    '''
+    num_windows = len(window_starts(num_frames, min(self.buckets), self.sliding_window))
+    return num_frames * (self.feat_dim * 4 + 4) + num_windows * 40
+
+
   def __del__(self):
+    if self.worker_pool is not None:
+      self.worker_pool.close()
+    if self.prefetcher is not None:
+      self.prefetcher.close()
     if self.clean_up and os.path.exists(self.tmp_dir):
       shutil.rmtree(self.tmp_dir)
 
 
+  def need_split(self):
+    # not enough data for next batch
+    if self.buffer is not None:
+      drain = not self.loop and self.split_data_counter == self.num_split
+      return not self.buffer.ready(self.batch_size, drain)
+    return not self.scheduler.ready()
+
+
   def has_data(self):
     # has enough data for next batch
-    if self.batch_pointer + self.batch_size > len(self.x):
+    if self.need_split():
       if self.loop and (self.split_counter+1) % self.split_per_iter == 0:
         return False
       if not self.loop and self.split_data_counter == self.num_split:
@@ -113,85 +176,142 @@ class JointDNNDataGenerator:
       asr_label_list: list of int32 np array [num_frames] 
       sid_label_list: list of int32
     '''
-    p1 = Popen (['splice-feats', '--print-args=false', '--left-context='+str(self.splice),
-                 '--right-context='+str(self.splice), 
-                 'scp:'+self.tmp_dir+'/split.'+self.name+'.'+str(self.split_data_counter)+'.scp',
-                 'ark:-'], stdout=PIPE, stderr=DEVNULL)
-    p2 = Popen (['apply-cmvn', '--print-args=false', '--norm-vars=true', self.exp+'/cmvn.mat',
-                 'ark:-', 'ark:-'], stdin=p1.stdout, stdout=PIPE, stderr=DEVNULL)
+    if self.prefetcher is not None:
+      return self.prefetcher.get(self.split_data_counter)
+    return self.read_split_data(self.split_data_counter)
+
+
+  def read_split_data (self, split_id):
+    split_scp = self.tmp_dir+'/split.'+self.name+'.'+str(split_id)+'.scp'
+    asr_labels = self.asr_labels
+    if self.stream_labels:
+      # only the labels of this split are copied out of the store
+      asr_labels = self.asr_labels.join(read_scp_keys(split_scp))
+    if self.frontend == 'native':
+      utterances = self.native_frontend.read_split(split_scp, asr_labels)
+    else:
+      p1 = Popen (['splice-feats', '--print-args=false', '--left-context='+str(self.splice),
+                   '--right-context='+str(self.splice), 'scp:'+split_scp,
+                   'ark:-'], stdout=PIPE, stderr=DEVNULL)
+      p2 = Popen (['apply-cmvn', '--print-args=false', '--norm-vars=true', self.exp+'/cmvn.mat',
+                   'ark:-', 'ark:-'], stdin=p1.stdout, stdout=PIPE, stderr=DEVNULL)
+      utterances = kaldi_IO.read_ark(p2.stdout)
 
     feat_list = []
     asr_label_list = []
     sid_label_list = []
-    
-    while True:
-      uid, feat = kaldi_IO.read_utterance (p2.stdout)
-      if uid == None:
-        break;
-      if uid in self.asr_labels and uid in self.sid_labels:
+
+    for uid, feat in utterances:
+      if uid in asr_labels and uid in self.sid_labels:
         feat_list.append (feat)
-        asr_label_list.append (self.asr_labels[uid])
+        asr_label_list.append (asr_labels[uid])
         sid_label_list.append (self.sid_labels[uid])
 
-    p2.stdout.close()
-    
+    if self.frontend != 'native':
+      p2.stdout.close()
+
     if len(feat_list) == 0 or len(asr_label_list) == 0:
       raise RuntimeError("No feats are loaded! please check feature and labels, and make sure they are matched.")
 
     return (feat_list, asr_label_list, sid_label_list)
 
 
-  def pack_utt_data(self, features, asr_labels, sid_labels, bucket_id):
+  def pack_utt_data(self, features, asr_labels, sid_labels, bucket_ids):
     '''
     for each utterance, we use a rolling window to generate enough segments for speaker ID modeling
+    The segments are records over the frames of the split, nothing is copied per segment.
     input:
       features: list of np 2d-array [num_frames, feat_dim]
       asr_labels: list of np array [num_frames]
       sid_labels: list of int32
+      bucket_ids: np array, the bucket of each utterance
     output:
-      features_packed: np 3d-array [batch_size, max_length, feat_dim]
-      asr_labels_packed: matrix[batch_size, max_length]
-      sid_labels_packed: array[batch_size]
+      WindowedSplit, segments of buckets[bucket_ids[i]] frames for utterance i, with asr labels,
+      and the speaker as extra
+      np array, the bucket of each segment
     '''
     assert len(features) == len(asr_labels)
 
-    features_packed = []
-    asr_labels_packed = []
-    sid_labels_packed = []
-    mask = []
-    max_length = self.buckets[bucket_id]
     sliding_window = self.sliding_window
+    frames, flat_labels, utt_offset = flatten_split(features, asr_labels)
+    split = WindowedSplit(frames, flat_labels, max(self.buckets))
 
-    for feat, asr_lab, sid_lab in zip(features, asr_labels, sid_labels):
+    offset = []
+    length = []
+    extra = []
+    window_bucket = []
+    for feat, asr_lab, sid_lab, utt_start, bucket_id in zip(features, asr_labels, sid_labels,
+                                                            utt_offset, bucket_ids):
 
       assert len(feat) == len(asr_lab)
-      start_index = 0
-
-      while start_index + max_length < len(feat):
-        # cut utterances into pieces
-        end_index = start_index + max_length
-        features_packed.append(feat[start_index:end_index])
-        asr_labels_packed.append(asr_lab[start_index:end_index])
-        mask.append(numpy.ones(max_length))
-        sid_labels_packed.append(sid_lab)
-        start_index += sliding_window
-
-      # last part, if long enough (bigger than max_length/2), pad the features
-      if len(feat) - start_index >= sliding_window:
-        num_zero = max_length + start_index - len(feat)
-        zeros2pad = numpy.zeros((num_zero, len(feat[0])))
-        features_packed.append(numpy.concatenate((feat[start_index:], zeros2pad)))
-        asr_labels_packed.append(numpy.append(asr_lab[start_index:], 
-                                              numpy.zeros(num_zero,dtype='int32')))
-        mask.append(numpy.append(numpy.ones(len(feat)-start_index), numpy.zeros(num_zero)))
-        sid_labels_packed.append(sid_lab)
-
-    features_packed = numpy.array(features_packed)
-    mask = numpy.array(mask)
-    asr_labels_packed = numpy.array(asr_labels_packed)
-    sid_labels_packed = numpy.array(sid_labels_packed)
-
-    return features_packed, asr_labels_packed, sid_labels_packed, mask
+      max_length = self.buckets[bucket_id]
+      starts = window_starts(len(feat), max_length, sliding_window)
+      # last part, if long enough (bigger than sliding_window), pad the features
+      if len(feat) - starts[-1] < sliding_window:
+        starts = starts[:-1]
+      offset.append(utt_start + starts)
+      length.append(numpy.minimum(len(feat) - starts, max_length))
+      extra.append(numpy.full(len(starts), sid_lab, dtype = 'int32'))
+      window_bucket.append(numpy.full(len(starts), bucket_id, dtype = 'int64'))
+
+    split.add_windows(numpy.concatenate(offset), numpy.concatenate(length),
+                      extra = numpy.concatenate(extra))
+    return split, numpy.concatenate(window_bucket)
+
+
+  def prepare_split (self, split_id, random_state):
+    '''
+    read, pack and shuffle a split, in a worker process of SplitWorkerPool
+    output:
+      the arrays of the shuffled WindowedSplit, and the bucket of each segment
+    '''
+    feats, asr_labels, sid_labels = self.read_split_data(split_id)
+    if self.augmenter is not None:
+      feats, asr_labels = self.augmenter.apply(feats, asr_labels, random_state)
+    bucket_ids = random_state.randint(0, len(self.buckets), len(feats))
+    split, window_bucket = self.pack_utt_data(feats, asr_labels, sid_labels, bucket_ids)
+    order = random_state.permutation(len(split))
+    split.permute(order)
+    return split.to_arrays() + (window_bucket[order],)
+
+
+  def load_split (self):
+    ''' load split split_data_counter into the scheduler, behind the segments left '''
+    if self.buffer is None:
+      self.load_point = load_point(self)
+    if self.worker_pool is not None:
+      # already packed and shuffled by the worker
+      arrays = self.worker_pool.get(self.split_data_counter)
+      split = WindowedSplit(*arrays[:-1])
+      window_bucket = arrays[-1]
+    else:
+      feats, asr_labels, sid_labels = self.get_next_split_data()
+      if self.augmenter is not None:
+        feats, asr_labels = self.augmenter.apply(feats, asr_labels, numpy.random)
+
+      # pick a random bucket for every utterance to prepare the data
+      bucket_ids = numpy.random.randint(0, len(self.buckets), len(feats))
+      split, window_bucket = self.pack_utt_data(feats, asr_labels, sid_labels, bucket_ids)
+    report_split_memory(self.name, self.split_data_counter, split.to_arrays() + (window_bucket,))
+
+    if self.buffer is not None:
+      # the buffer shuffles, and keeps what is left of the split, a pool per bucket
+      for bucket_id in numpy.unique(window_bucket):
+        index = numpy.where(window_bucket == bucket_id)[0]
+        x_packed, y_packed, mask_packed, _, z_packed = split.take(index, {}, self.buckets[bucket_id])
+        self.buffer.add((x_packed, y_packed, z_packed, mask_packed), self.buckets[bucket_id], bucket_id)
+    else:
+      # segments that did not fill a batch are carried over; shuffle data, utterance base,
+      # unless the worker did
+      self.scheduler.add(split, window_bucket, self.worker_pool is None)
+
+
+  def left_state(self):
+    return self.scheduler.left_state()
+
+
+  def set_left(self, state):
+    self.scheduler.set_left(state)
 
 
   def get_batch_utterances (self):
@@ -200,49 +320,62 @@ class JointDNNDataGenerator:
       x_mini: np matrix [batch_size, max_length, feat_dim]
       y_mini: np matrix [batch_size]
       mask: np matrix [batch_size, max_length]
+      x_mini, y_mini and mask are reused by the next call
     '''
     # read split data until we have enough for this batch
-    while (self.batch_pointer + self.batch_size > len(self.x)):
+    while (self.need_split()):
       if not self.has_data():
-        # let's just throw away the last few samples
+        # segments left at the very end do not fill a batch
         return None, None, None, None, 0
 
-      feats, asr_labels, sid_labels = self.get_next_split_data()
-
-      # pick a random bucket to prepare the data
-      bucket_id = numpy.random.randint(0, len(self.buckets))
-      x_packed, y_packed, z_packed, mask_packed = self.pack_utt_data(feats, asr_labels, 
-                                                          sid_labels, bucket_id)
-      
-      self.bucket_id = bucket_id
-
-      # We just throw away data left, and shuffle data, utterance base
-      randomInd = numpy.array(range(len(x_packed)))
-      numpy.random.shuffle(randomInd)
-      self.x = x_packed[randomInd]
-      self.y = y_packed[randomInd]
-      self.z = z_packed[randomInd]
-      self.mask = mask_packed[randomInd]
-      
-      self.batch_pointer = 0
+      self.load_split()
 
       self.split_counter += 1
       self.split_data_counter += 1
       if self.loop and self.split_data_counter == self.num_split:
         self.split_data_counter = 0
     
-    x_mini = self.x[self.batch_pointer:self.batch_pointer+self.batch_size]
-    y_mini = self.y[self.batch_pointer:self.batch_pointer+self.batch_size]
-    z_mini = self.z[self.batch_pointer:self.batch_pointer+self.batch_size]
-    mask_mini = self.mask[self.batch_pointer:self.batch_pointer+self.batch_size]
+    if self.buffer is not None:
+      self.bucket_id, (x_mini, y_mini, z_mini, mask_mini) = self.buffer.sample(self.batch_size)
+    else:
+      self.bucket_id, (x_mini, y_mini, mask_mini, _, z_mini) = self.scheduler.next_batch(self.batch_buffers)
 
     self.last_batch_utts = len(y_mini)
     self.last_batch_frames = mask_mini.sum()
-    self.batch_pointer += self.batch_size
 
     return x_mini, y_mini, z_mini, mask_mini, self.bucket_id
 
 
+  def get_state(self):
+    '''
+    where the generator is in the data, for a step checkpoint: the split counters, the random
+    state, and the load point of the current split with the segments batched from it since;
+    set_state reads the split again instead of keeping its segments. Only the shuffle buffer
+    is kept as it is, it mixes many splits.
+    '''
+    state = rng_state()
+    state['split_counter'] = self.split_counter
+    state['split_data_counter'] = self.split_data_counter
+    if self.buffer is not None:
+      state.update(self.buffer.get_state())
+    elif self.load_point is not None:
+      state.update(self.load_point)
+      state.update(self.scheduler.get_state())
+    return state
+
+
+  def set_state(self, state):
+    ''' continue from get_state, with the batch after the last one before it '''
+    if self.buffer is not None:
+      self.buffer.set_state(state)
+    elif 'load_split_id' in state:
+      reload_split(self, state)
+      self.scheduler.set_state(state)
+    set_rng_state(state)
+    self.split_counter = int(state['split_counter'])
+    self.split_data_counter = int(state['split_data_counter'])
+
+
   def get_batch_size(self):
     return self.batch_size
 
@@ -267,9 +400,12 @@ class JointDNNDataGenerator:
 
   def save_target_counts(self, num_targets, output_file):
     # here I'm assuming training data is less than 10,000 hours
-    counts = numpy.zeros(num_targets, dtype='int64')
-    for alignment in self.asr_labels.values():
-      counts += numpy.bincount(alignment, minlength = num_targets)
+    if isinstance(self.asr_labels, LabelStore):
+      counts = self.asr_labels.target_counts(num_targets)
+    else:
+      counts = numpy.zeros(num_targets, dtype='int64')
+      for alignment in self.asr_labels.values():
+        counts += numpy.bincount(alignment, minlength = num_targets)
     # add a ``half-frame'' to all the elements to avoid zero-counts (decoding issue)
     counts = counts.astype(float) + 0.5
     numpy.savetxt(output_file, counts, fmt = '%.1f')
@@ -2,6 +2,16 @@ from subprocess import Popen, PIPE, check_output
 import tempfile
 import kaldi_io
 import kaldi_IO
+from feature_frontend import NativeFrontend
+from cmvn_stats import compute_cmvn
+from split_prefetcher import SplitPrefetcher
+from split_workers import SplitWorkerPool
+from split_planner import plan_splits, report_split_memory
+from shuffle_buffer import ShuffleBuffer
+from augment import make_augmenter
+from generator_state import rng_state, set_rng_state, load_point, reload_split
+from windowed_split import WindowedSplit, flatten_split, window_starts
+from bucket_scheduler import BucketScheduler
 import pickle
 import shutil
 import numpy
@@ -24,8 +34,20 @@ class SeqDataGenerator:
     self.max_length = conf.get('max_length', 1000)
     self.feat_type = conf.get('feat_type', 'raw')
     self.clean_up = conf.get('clean_up', True)
+    self.frontend = conf.get('frontend', 'kaldi')
+    self.prefetch_splits = conf.get('prefetch_splits', 0)
+    self.split_workers = conf.get('split_workers', 0)
+    self.split_slots = conf.get('split_slots', 1)
+    self.shm_dir = conf.get('shm_dir', '/dev/shm')
+    # cut the data again into splits of about this many bytes in memory, see split_bytes
+    self.split_memory_budget = conf.get('split_memory_budget', 0)
+    # mix segments across splits in a buffer of this many frames, with a pool per bucket
+    self.shuffle_buffer = conf.get('shuffle_buffer', 0)
     self.variable_length = conf.get('variable_length', False)
     self.buckets = [self.max_length ] if buckets is None else buckets
+    # fixed length splits are made of utterances of one length, they must not be cut again
+    if self.split_memory_budget > 0 and not self.variable_length:
+      raise RuntimeError('split_memory_budget needs variable_length')
 
     # in loop mode, we keep looping over dataset
     # and decide iteration by split_per_iter
@@ -33,11 +55,14 @@ class SeqDataGenerator:
     if self.name == 'train':
       self.loop = conf.get('loop_mode', False)
       self.split_per_iter = conf.get('split_per_iter', None)
-      self.noise_ratio = conf.get('noise_ratio', 0.0)   # add random noise to training data
+      # stddev of the noise added to the training batches, in the graph, see get_noise_ratio
+      self.noise_ratio = conf.get('noise_ratio', 0.0)
+      self.augmenter = make_augmenter(conf, self.splice)
     else:
       self.loop = False
       self.split_per_iter = None
       self.noise_ratio = 0.0
+      self.augmenter = None
     self.split_counter = 0        # keep increasing
     self.split_data_counter = 0   # loop from 0 to num_split
     if self.loop and self.split_per_iter is None:
@@ -52,44 +77,81 @@ class SeqDataGenerator:
     shutil.copyfile("%s/feats.%s.scp" % (self.data, self.name), "%s/%s.scp" % (self.exp, self.name))
 
     if name == 'train':
-      cmd = ['copy-feats', '\'scp:head -10000 %s/%s.scp |\'' % (self.exp, self.name), 'ark:- |']
+      compute_cmvn('%s/%s.scp' % (self.exp, self.name), self.splice, self.exp+'/cmvn.mat',
+                   conf.get('cmvn_utts', 10000), conf.get('cmvn_jobs', None), seed)
 
-      cmd.extend(['splice-feats', '--left-context='+str(self.splice), 
-                  '--right-context='+str(self.splice), 'ark:- ark:- |'])
+    if self.frontend == 'native':
+      self.native_frontend = NativeFrontend(self.exp+'/cmvn.mat', self.splice)
 
-      cmd.extend(['compute-cmvn-stats', 'ark:-', exp+'/cmvn.mat'])
-
-      Popen(' '.join(cmd), shell=True).communicate()
+    self.feat_dim = int(open('%s/feat_dim' % self.data).read()) * (2*self.splice+1)
 
     self.num_split = int(open('%s/num_split.%s' % (self.data, self.name)).read())
   
-    for i in range(self.num_split):
-      shutil.copyfile("%s/feats.%s.%d.scp" % (self.data, self.name, (i+1)), "%s/split.%s.%d.scp" % (self.tmp_dir, self.name, i))
+    # utterances without labels are left out of the splits
+    split_scps = [ "%s/feats.%s.%d.scp" % (self.data, self.name, (i+1)) for i in range(self.num_split) ]
+    self.num_split = plan_splits(split_scps, "%s/split.%s" % (self.tmp_dir, self.name),
+                                 [self.labels], self.name,
+                                 self.split_bytes, self.split_memory_budget)
+
+    self.prefetcher = None
+    if self.prefetch_splits > 0:
+      self.prefetcher = SplitPrefetcher(self, self.num_split, self.prefetch_splits)
 
     self.num_samples = int(open('%s/num_samples.%s' % (self.data, self.name)).read())
 
     numpy.random.seed(seed)
-
-    self.feat_dim = int(open('%s/feat_dim' % self.data).read()) * (2*self.splice+1)
-    
-    self.x = numpy.empty ((0, self.max_length, self.feat_dim))
-    self.y = numpy.empty (0, dtype='int32')
-    self.mask = numpy.empty ((0, self.max_length), dtype='float32')
     
-    self.batch_pointer = 0
+    # segments of the current split, of all buckets; batches are gathered into batch_buffers
+    self.scheduler = BucketScheduler(self.buckets, self.batch_size)
+    self.batch_buffers = {}
+
+    # state before the last split was loaded, for get_state
+    self.load_point = None
+
+    self.buffer = None
+    if self.shuffle_buffer > 0:
+      self.buffer = ShuffleBuffer(self.shuffle_buffer)
+
+    # workers are forked here, once the generator is fully set up
+    self.worker_pool = None
+    if self.split_workers > 0:
+      self.worker_pool = SplitWorkerPool(self, self.num_split, self.split_workers,
+                                         self.split_slots, seed, self.shm_dir)
     
   def get_feat_dim(self):
     return self.feat_dim
 
 
+  def split_bytes(self, num_frames):
+    '''
+    estimated memory of an utterance in a loaded split, for split_memory_budget:
+    the float32 frames, and 40 bytes of records per segment for the smallest bucket,
+    which has the most. Splits read ahead by the prefetcher come on top of it.
+    '''
+    num_windows = len(window_starts(num_frames, min(self.buckets), self.sliding_window))
+    return num_frames * self.feat_dim * 4 + num_windows * 40
+
+
   def __del__(self):
+    if self.worker_pool is not None:
+      self.worker_pool.close()
+    if self.prefetcher is not None:
+      self.prefetcher.close()
     if self.clean_up:
       shutil.rmtree(self.tmp_dir)
 
 
+  def need_split(self):
+    # not enough data for next batch
+    if self.buffer is not None:
+      drain = not self.loop and self.split_data_counter == self.num_split
+      return not self.buffer.ready(self.batch_size, drain)
+    return not self.scheduler.ready()
+
+
   def has_data(self):
     # has enough data for next batch
-    if self.batch_pointer + self.batch_size > len(self.x):
+    if self.need_split():
       if self.loop and (self.split_counter+1) % self.split_per_iter == 0:
         return False
       if not self.loop and self.split_data_counter == self.num_split:
@@ -112,25 +174,33 @@ class SeqDataGenerator:
       feat_list: list of np matrix [num_frames, feat_dim]
       label_list: list of int32 np array [num_frames] 
     '''
-    cmd = [ 'copy-feats', 'scp:' + self.tmp_dir + '/split.' + self.name + '.' + \
-           str(self.split_data_counter) + '.scp', 'ark:- |' ]
-    cmd.extend(['splice-feats', '--left-context='+str(self.splice),
-                 '--right-context='+str(self.splice), 'ark:-', 'ark:-|'])
-    cmd.extend(['apply-cmvn', '--norm-vars=true', self.exp+'/cmvn.mat', 'ark:-', 'ark:-'])
-    p1 = Popen(' '.join(cmd), shell=True, stdout=PIPE, stderr=DEVNULL)
+    if self.prefetcher is not None:
+      return self.prefetcher.get(self.split_data_counter)
+    return self.read_split_data(self.split_data_counter)
+
+
+  def read_split_data (self, split_id):
+    split_scp = self.tmp_dir + '/split.' + self.name + '.' + str(split_id) + '.scp'
+    if self.frontend == 'native':
+      utterances = self.native_frontend.read_split(split_scp, self.labels)
+    else:
+      cmd = [ 'copy-feats', 'scp:' + split_scp, 'ark:- |' ]
+      cmd.extend(['splice-feats', '--left-context='+str(self.splice),
+                   '--right-context='+str(self.splice), 'ark:-', 'ark:-|'])
+      cmd.extend(['apply-cmvn', '--norm-vars=true', self.exp+'/cmvn.mat', 'ark:-', 'ark:-'])
+      p1 = Popen(' '.join(cmd), shell=True, stdout=PIPE, stderr=DEVNULL)
+      utterances = kaldi_IO.read_ark(p1.stdout)
 
     feat_list = []
     label_list = []
 
-    while True:
-      uid, feat = kaldi_IO.read_utterance (p1.stdout)
-      if uid == None:
-        break;
+    for uid, feat in utterances:
       if uid in self.labels:
         feat_list.append (feat)
         label_list.append (self.labels[uid])
 
-    p1.stdout.close()
+    if self.frontend != 'native':
+      p1.stdout.close()
 
     if len(feat_list) == 0 or len(label_list) == 0:
       raise RuntimeError("No feats are loaded! please check feature and labels," + \
@@ -150,48 +220,44 @@ class SeqDataGenerator:
     return max_length, bucket_id
 
 
-  def pack_utt_data_variable(self, features, sid_labels, bucket_id):
+  def pack_utt_data_variable(self, features, sid_labels, bucket_ids):
     '''
     for each utterance, we use a rolling window to generate enough segments for speaker ID modeling
+    The segments are records over the frames of the split, nothing is copied per segment.
     input:
       features: list of np 2d-array [num_frames, feat_dim]
       sid_labels: list of int32
+      bucket_ids: np array, the bucket of each utterance
     output:
-      features_packed: np 3d-array [batch_size, max_length, feat_dim]
-      sid_labels_packed: array[batch_size]
+      WindowedSplit, segments of buckets[bucket_ids[i]] frames for utterance i,
+      with the speaker as extra
+      np array, the bucket of each segment
     '''
     assert len(features) == len(sid_labels)
 
-    features_packed = []
-    sid_labels_packed = []
-    mask = []
-    max_length = self.buckets[bucket_id]
     sliding_window = self.sliding_window
-
-    for feat, sid_lab in zip(features, sid_labels):
-
-      start_index = 0
-      while start_index + max_length < len(feat):
-        # cut utterances into pieces
-        end_index = start_index + max_length
-        features_packed.append(feat[start_index:end_index])
-        mask.append(numpy.ones(max_length))
-        sid_labels_packed.append(sid_lab)
-        start_index += sliding_window
-
-      # last part, if long enough (bigger than max_length/2), pad the features
-      if len(feat) - start_index >= sliding_window:
-        num_zero = max_length + start_index - len(feat)
-        zeros2pad = numpy.zeros((num_zero, len(feat[0])))
-        features_packed.append(numpy.concatenate((feat[start_index:], zeros2pad)))
-        mask.append(numpy.append(numpy.ones(len(feat)-start_index), numpy.zeros(num_zero)))
-        sid_labels_packed.append(sid_lab)
-
-    features_packed = numpy.array(features_packed)
-    mask = numpy.array(mask)
-    sid_labels_packed = numpy.array(sid_labels_packed)
-
-    return features_packed, sid_labels_packed, mask
+    frames, _, utt_offset = flatten_split(features)
+    split = WindowedSplit(frames, None, max(self.buckets))
+
+    offset = []
+    length = []
+    extra = []
+    window_bucket = []
+    for feat, sid_lab, utt_start, bucket_id in zip(features, sid_labels, utt_offset, bucket_ids):
+
+      max_length = self.buckets[bucket_id]
+      starts = window_starts(len(feat), max_length, sliding_window)
+      # last part, if long enough (bigger than sliding_window), pad the features
+      if len(feat) - starts[-1] < sliding_window:
+        starts = starts[:-1]
+      offset.append(utt_start + starts)
+      length.append(numpy.minimum(len(feat) - starts, max_length))
+      extra.append(numpy.full(len(starts), sid_lab, dtype = 'int32'))
+      window_bucket.append(numpy.full(len(starts), bucket_id, dtype = 'int64'))
+
+    split.add_windows(numpy.concatenate(offset), numpy.concatenate(length),
+                      extra = numpy.concatenate(extra))
+    return split, numpy.concatenate(window_bucket)
 
 
   def pack_utt_data_fixed(self, features, sid_labels):
@@ -200,32 +266,84 @@ class SeqDataGenerator:
     input:
       features: list of np 2d-array [num_frames, feat_dim]
     output:
-      features_pad: np 3d-array [batch_size, max_length, feat_dim]
-      labels_pad: np array [batch_size]
-      mask: matrix[batch_size, max_length]
+      WindowedSplit, one segment per utterance with the speaker as extra
+      np array, the bucket of each segment, all the same
     '''
-    features_pad = []
-    mask = []
     feat_len = len(features[0])
     max_length, bucket_id = self.get_bucket(feat_len)
 
     #we assume features from each split are of same length, so we use the same bucket
     for feat in features:
       assert feat_len == len(feat)
-      if max_length > len(feat) :
-        num_zero = max_length - len(feat)
-        zeros2pad = numpy.zeros((num_zero, len(feat[0])))
-        features_pad.append(numpy.concatenate((feat, zeros2pad)))
-        mask.append(numpy.append(numpy.ones(len(feat)), numpy.zeros(num_zero)))
-      else:
-        features_pad.append(feat[:max_length])
-        mask.append(numpy.ones(max_length))
+    frames, _, utt_offset = flatten_split(features)
+    split = WindowedSplit(frames, None, max_length)
+    split.add_windows(utt_offset, numpy.full(len(features), min(feat_len, max_length), dtype = 'int64'),
+                      extra = numpy.array(sid_labels, dtype = 'int32'))
+
+    return split, numpy.full(len(features), bucket_id, dtype = 'int64')
 
-    features_pad = numpy.array(features_pad)
-    sid_labels = numpy.array(sid_labels)
-    mask = numpy.array(mask)
 
-    return features_pad, sid_labels, mask, bucket_id
+  def pack_split(self, features, sid_labels, random_state):
+    '''
+    output:
+      WindowedSplit, and the bucket of each segment; with variable_length every utterance
+      goes to a random bucket
+    '''
+    if self.variable_length:
+      bucket_ids = random_state.randint(0, len(self.buckets), len(features))
+      return self.pack_utt_data_variable(features, sid_labels, bucket_ids)
+    return self.pack_utt_data_fixed(features, sid_labels)
+
+
+  def prepare_split (self, split_id, random_state):
+    '''
+    read, pack and shuffle a split, in a worker process of SplitWorkerPool
+    output:
+      the arrays of the shuffled WindowedSplit, and the bucket of each segment
+    '''
+    feats, sid_labels = self.read_split_data(split_id)
+    if self.augmenter is not None:
+      feats, _ = self.augmenter.apply(feats, None, random_state)
+    split, window_bucket = self.pack_split(feats, sid_labels, random_state)
+    order = random_state.permutation(len(split))
+    split.permute(order)
+    return split.to_arrays() + (window_bucket[order],)
+
+
+  def load_split (self):
+    ''' load split split_data_counter into the scheduler, behind the segments left '''
+    if self.buffer is None:
+      self.load_point = load_point(self)
+    if self.worker_pool is not None:
+      # already packed and shuffled by the worker
+      arrays = self.worker_pool.get(self.split_data_counter)
+      split = WindowedSplit(*arrays[:-1])
+      window_bucket = arrays[-1]
+    else:
+      feats, sid_labels = self.get_next_split_data()
+      if self.augmenter is not None:
+        feats, _ = self.augmenter.apply(feats, None, numpy.random)
+      split, window_bucket = self.pack_split(feats, sid_labels, numpy.random)
+    report_split_memory(self.name, self.split_data_counter, split.to_arrays() + (window_bucket,))
+
+    if self.buffer is not None:
+      # the buffer shuffles, and keeps what is left of the split, a pool per bucket
+      for bucket_id in numpy.unique(window_bucket):
+        index = numpy.where(window_bucket == bucket_id)[0]
+        x_packed, _, mask_packed, _, y_packed = split.take(index, {}, self.buckets[bucket_id])
+        self.buffer.add((x_packed, y_packed, mask_packed), self.buckets[bucket_id], bucket_id)
+    else:
+      # segments that did not fill a batch are carried over; shuffle data, utterance base,
+      # unless the worker did
+      self.scheduler.add(split, window_bucket, self.worker_pool is None)
+
+
+  def left_state(self):
+    return self.scheduler.left_state()
+
+
+  def set_left(self, state):
+    self.scheduler.set_left(state)
 
 
   def get_batch_utterances (self):
@@ -235,50 +353,65 @@ class SeqDataGenerator:
       y_mini: np matrix [batch_size]
       mask: np matrix [batch_size, max_length]
       bucket_id: an int
+      x_mini and mask are reused by the next call
     '''
     # read split data until we have enough for this batch
-    while (self.batch_pointer + self.batch_size > len(self.x)):
+    while (self.need_split()):
       if not self.has_data():
         return None, None, None, 0
 
-      feats, sid_labels = self.get_next_split_data()
-      
-      if self.variable_length:
-        bucket_id = numpy.random.randint(0, len(self.buckets))
-        x_packed, y_packed, mask_packed = self.pack_utt_data_variable(feats, sid_labels, bucket_id)
-      else:
-        x_packed, y_packed, mask_packed, bucket_id = self.pack_utt_data_fixed(feats, sid_labels)
-
-      self.bucket_id = bucket_id
-
-      ## Shuffle data, utterance base
-      randomInd = numpy.array(range(len(x_packed)))
-      numpy.random.shuffle(randomInd)
-      self.x = x_packed[randomInd]
-      self.y = y_packed[randomInd]
-      self.mask = mask_packed[randomInd]
-
-      self.batch_pointer = 0
+      self.load_split()
 
       self.split_counter += 1
       self.split_data_counter += 1
       if self.loop and self.split_data_counter == self.num_split:
         self.split_data_counter = 0
     
-    x_mini = self.x[self.batch_pointer:self.batch_pointer+self.batch_size]
-    y_mini = self.y[self.batch_pointer:self.batch_pointer+self.batch_size]
-    mask_mini = self.mask[self.batch_pointer:self.batch_pointer+self.batch_size]
-
-    if self.noise_ratio != 0.0:
-      random_noise = numpy.random.normal(0.0, self.noise_ratio, x_mini.shape)
-      x_mini += random_noise
+    if self.buffer is not None:
+      self.bucket_id, (x_mini, y_mini, mask_mini) = self.buffer.sample(self.batch_size)
+    else:
+      self.bucket_id, (x_mini, _, mask_mini, _, y_mini) = self.scheduler.next_batch(self.batch_buffers)
 
     self.last_batch_utts = len(y_mini)
-    self.batch_pointer += self.batch_size
 
     return x_mini, y_mini, mask_mini, self.bucket_id
 
 
+  def get_state(self):
+    '''
+    where the generator is in the data, for a step checkpoint: the split counters, the random
+    state, and the load point of the current split with the segments batched from it since;
+    set_state reads the split again instead of keeping its segments. Only the shuffle buffer
+    is kept as it is, it mixes many splits.
+    '''
+    state = rng_state()
+    state['split_counter'] = self.split_counter
+    state['split_data_counter'] = self.split_data_counter
+    if self.buffer is not None:
+      state.update(self.buffer.get_state())
+    elif self.load_point is not None:
+      state.update(self.load_point)
+      state.update(self.scheduler.get_state())
+    return state
+
+
+  def set_state(self, state):
+    ''' continue from get_state, with the batch after the last one before it '''
+    if self.buffer is not None:
+      self.buffer.set_state(state)
+    elif 'load_split_id' in state:
+      reload_split(self, state)
+      self.scheduler.set_state(state)
+    set_rng_state(state)
+    self.split_counter = int(state['split_counter'])
+    self.split_data_counter = int(state['split_data_counter'])
+
+
+  def get_noise_ratio(self):
+    ''' stddev of the gaussian noise the model adds to the features of the batches '''
+    return self.noise_ratio
+
+
   def get_batch_size(self):
     return self.batch_size
 
@@ -0,0 +1,163 @@
+import numpy
+
+
+class ExamplePool:
+  '''
+  examples of one shape, kept in the rows of preallocated arrays.
+  Batches are drawn at random and their rows are reused for the examples added next,
+  so examples are never moved once they are in.
+  '''
+  def __init__ (self, frames_per_example):
+    self.frames_per_example = frames_per_example
+    self.arrays = None
+    # rows[:size] hold examples, the rest are free
+    self.rows = numpy.empty(0, dtype = 'int64')
+    self.size = 0
+
+
+  def __len__(self):
+    return self.size
+
+
+  def num_frames(self):
+    return self.size * self.frames_per_example
+
+
+  def reserve(self, num_examples, template):
+    num_rows = len(self.rows)
+    if num_examples <= num_rows:
+      return
+    new_num_rows = num_examples + num_examples // 2
+    if self.arrays is None:
+      self.arrays = [ numpy.empty((new_num_rows,) + a.shape[1:], dtype = a.dtype) for a in template ]
+    else:
+      self.arrays = [ numpy.concatenate((a, numpy.empty((new_num_rows - num_rows,) + a.shape[1:],
+                                                        dtype = a.dtype)))
+                      for a in self.arrays ]
+    self.rows = numpy.append(self.rows, numpy.arange(num_rows, new_num_rows))
+
+
+  def add(self, arrays):
+    '''
+    input:
+      arrays: tuple of np arrays, the first axis runs over examples
+    '''
+    num_examples = len(arrays[0])
+    if num_examples == 0:
+      return
+    self.reserve(self.size + num_examples, arrays)
+    rows = self.rows[self.size:self.size+num_examples]
+    for pool_array, array in zip(self.arrays, arrays):
+      pool_array[rows] = array
+    self.size += num_examples
+
+
+  def sample(self, batch_size):
+    '''
+    draw batch_size examples uniformly without replacement and remove them
+    output:
+      tuple of np arrays, like the ones added
+    '''
+    # distinct positions, the repeated ones are drawn again; numpy.random.choice without
+    # replacement would permute all of rows[:size] for every batch
+    positions = numpy.empty(0, dtype = 'int64')
+    while len(positions) < batch_size:
+      more = numpy.random.random_sample(batch_size - len(positions)) * self.size
+      positions = numpy.sort(numpy.append(positions, more.astype('int64')))
+      positions = positions[numpy.append(True, positions[1:] != positions[:-1])]
+    numpy.random.shuffle(positions)
+    picked = self.rows[positions]
+    # the drawn rows change places with the undrawn ones at the end of rows[:size]
+    self.size -= batch_size
+    inside = positions[positions < self.size]
+    drawn_tail = numpy.zeros(batch_size, dtype = 'bool')
+    drawn_tail[positions[positions >= self.size] - self.size] = True
+    tail = self.size + numpy.flatnonzero(~drawn_tail)
+    self.rows[inside], self.rows[tail] = self.rows[tail], self.rows[inside]
+    return tuple(a[picked] for a in self.arrays)
+
+
+class ShuffleBuffer:
+  '''
+  mixes examples across splits: every split is added as a whole, and batches are drawn
+  at random from all examples in the buffer, so consecutive batches mix several splits.
+  Batches are only drawn once the buffer holds capacity frames, or when the data is drained;
+  memory is bounded by capacity frames plus one split, whatever the split size.
+  Examples of different shapes (e.g. buckets) go to separate pools, a batch comes from one pool.
+  enabled with "shuffle_buffer = <number of frames>" in the [feature] section
+  '''
+  def __init__ (self, capacity):
+    self.capacity = capacity
+    self.pools = {}
+
+
+  def num_frames(self):
+    return sum(pool.num_frames() for pool in self.pools.values())
+
+
+  def add(self, arrays, frames_per_example = 1, key = 0):
+    '''
+    input:
+      arrays: tuple of np arrays, the first axis runs over examples
+      frames_per_example: frames an example takes up, e.g. max_length for padded sequences
+      key: pool to add to, e.g. bucket_id
+    '''
+    if key not in self.pools:
+      self.pools[key] = ExamplePool(frames_per_example)
+    self.pools[key].add(arrays)
+
+
+  def ready(self, batch_size, drain = False):
+    ''' whether a batch can be drawn; unless drain, only with a full buffer '''
+    if not drain and self.num_frames() < self.capacity:
+      return False
+    return self.choose_key(batch_size) is not None
+
+
+  def choose_key(self, batch_size):
+    '''
+    output:
+      a pool with at least batch_size examples, picked with probability proportional to its size;
+      None if there is none
+    '''
+    keys = sorted(key for key, pool in self.pools.items() if len(pool) >= batch_size)
+    if len(keys) == 0:
+      return None
+    if len(keys) == 1:
+      return keys[0]
+    sizes = numpy.array([ len(self.pools[key]) for key in keys ], dtype = 'float64')
+    return keys[numpy.random.choice(len(keys), p = sizes / sizes.sum())]
+
+
+  def get_state(self):
+    ''' the examples in the buffer as a dict of np arrays, for a generator checkpoint '''
+    # pools that never had examples have no arrays
+    keys = sorted(key for key, pool in self.pools.items() if pool.arrays is not None)
+    state = { 'buffer_keys': numpy.array(keys, dtype = 'int64'),
+              'buffer_frames_per_example': numpy.array([ self.pools[key].frames_per_example
+                                                         for key in keys ], dtype = 'int64') }
+    for i, key in enumerate(keys):
+      pool = self.pools[key]
+      for j, array in enumerate(pool.arrays):
+        state['buffer_%d_%d' % (i, j)] = array[pool.rows[:pool.size]]
+    return state
+
+
+  def set_state(self, state):
+    ''' refill the buffer from get_state, the examples in the same order '''
+    self.pools = {}
+    for i, key in enumerate(state['buffer_keys']):
+      arrays = []
+      while 'buffer_%d_%d' % (i, len(arrays)) in state:
+        arrays.append(state['buffer_%d_%d' % (i, len(arrays))])
+      self.add(tuple(arrays), int(state['buffer_frames_per_example'][i]), int(key))
+
+
+  def sample(self, batch_size):
+    '''
+    output:
+      key: pool the batch is drawn from
+      batch: tuple of np arrays, like the ones added
+    '''
+    key = self.choose_key(batch_size)
+    return key, self.pools[key].sample(batch_size)
@@ -0,0 +1,181 @@
+import logging
+import numpy
+from feature_index import FeatureIndex
+
+logger = logging.getLogger('__main__')
+
+
+def read_scp_lines(scp_file):
+  '''
+  output:
+    list of (uid, line)
+  '''
+  entries = []
+  with open(scp_file) as f:
+    for line in f:
+      fields = line.split(None, 1)
+      if len(fields) == 2:
+        entries.append((fields[0], line if line.endswith('\n') else line + '\n'))
+  return entries
+
+
+def count_frames(index, uid):
+  # frames from the ark header, None if it would have to be decoded
+  header = index.get_header(uid)
+  if header is None:
+    return None
+  begin, end = index.get_row_range(uid, header[1])
+  return end - begin
+
+
+def report_skipped(index, name, k, skipped, num_entries):
+  ''' log the utterances of scp file k skipped for having no labels, and their frames '''
+  # only the skipped ones, from the ark headers where they can be mapped
+  frames = [ count_frames(index, uid) for uid in skipped ]
+  known = [ n for n in frames if n is not None ]
+  message = 'split %d of %s: skipped %d of %d utterances without labels, %d frames' % \
+            (k, name, len(skipped), num_entries, sum(known))
+  if len(known) < len(frames):
+    message += ' (not counted for %d compressed or piped entries)' % (len(frames) - len(known))
+  logger.info(message)
+
+
+def balanced_bounds(sizes, memory_budget):
+  '''
+  output:
+    ends of the splits that cut sizes, in order, into the fewest splits of about equal size
+    that each fit memory_budget (unless a single utterance is bigger)
+  '''
+  sizes = numpy.array(sizes, dtype = 'float64')
+  total = sizes.sum()
+  # an utterance goes to the split its middle falls in
+  middle = numpy.cumsum(sizes) - sizes / 2
+  num_split = max(1, int(numpy.ceil(total / memory_budget)))
+  while num_split < len(sizes):
+    cuts = numpy.searchsorted(middle, total * numpy.arange(1, num_split) / num_split)
+    bounds = numpy.unique(numpy.append(cuts[cuts > 0], len(sizes)))
+    starts = numpy.append(0, bounds[:-1])
+    split_sizes = numpy.add.reduceat(sizes, starts)
+    if all(size <= memory_budget or end - start == 1
+           for size, start, end in zip(split_sizes, starts, bounds)):
+      return list(bounds)
+    num_split += 1
+  return list(range(1, len(sizes) + 1))
+
+
+def reshard(scp_files, split_prefix, label_sets, name, split_bytes, memory_budget):
+  '''
+  cut the labeled utterances of scp_files, in order, into splits of about equal size and at
+  most memory_budget bytes in memory each (unless a single utterance is bigger): as few
+  splits as the total size needs, more if an uneven cut takes one over the budget
+  input:
+    split_bytes: function of the number of frames of an utterance, its estimated memory
+                 once loaded, packed and windowed by the generator
+  output:
+    number of splits written
+  '''
+  lines = []
+  sizes = []
+  num_skipped = 0
+  for k, scp_file in enumerate(scp_files):
+    index = FeatureIndex(scp_file)
+    entries = read_scp_lines(scp_file)
+    skipped = []
+    for uid, line in entries:
+      if not all(uid in labels for labels in label_sets):
+        skipped.append(uid)
+        continue
+      num_frames = count_frames(index, uid)
+      if num_frames is None:
+        num_frames = index.num_frames(uid)
+      lines.append(line)
+      sizes.append(split_bytes(num_frames))
+    if len(skipped) > 0:
+      report_skipped(index, name, k, skipped, len(entries))
+    num_skipped += len(skipped)
+    index.close()
+  if len(lines) == 0:
+    raise RuntimeError("No feats are loaded! please check feature and labels, and make sure they are matched.")
+
+  bounds = balanced_bounds(sizes, memory_budget)
+  start = 0
+  split_sizes = []
+  for i, end in enumerate(bounds):
+    with open('%s.%d.scp' % (split_prefix, i), 'w') as f:
+      f.writelines(lines[start:end])
+    split_sizes.append(sum(sizes[start:end]))
+    start = end
+
+  logger.info('%s: %d utterances in %d splits of %.1f to %.1f MB for a budget of %.1f MB, '
+              '%d utterances without labels skipped' %
+              (name, len(lines), len(bounds), min(split_sizes) / 2.0**20, max(split_sizes) / 2.0**20,
+               memory_budget / 2.0**20, num_skipped))
+  return len(bounds)
+
+
+# generators whose split memory was logged at info level already
+reported_memory = set()
+
+
+def report_split_memory(name, split_id, arrays):
+  '''
+  log the memory of a loaded split, next to what it would take with the float64 features
+  and int64 labels and records numpy makes by default; at info level for the first split
+  of each generator, at debug level for the others
+  input:
+    arrays: the np arrays the generator holds for the split
+  '''
+  level = logging.DEBUG if name in reported_memory else logging.INFO
+  if not logger.isEnabledFor(level):
+    return
+  reported_memory.add(name)
+  arrays = [ a for a in arrays if isinstance(a, numpy.ndarray) ]
+  nbytes = sum(a.nbytes for a in arrays)
+  wide_nbytes = sum(a.size * max(8, a.itemsize) for a in arrays)
+  logger.log(level, 'split %d of %s: %.1f MB in memory, %.1f MB with 64-bit types' %
+             (split_id, name, nbytes / 2.0**20, wide_nbytes / 2.0**20))
+
+
+def plan_splits(scp_files, split_prefix, label_sets, name = '', split_bytes = None, memory_budget = 0):
+  '''
+  write the split lists the generators read, keeping only the utterances that have labels,
+  so the others are never decoded, spliced and normalized.
+  input:
+    scp_files: feats.<name>.<k>.scp, one per split
+    split_prefix: the splits are written to <split_prefix>.<i>.scp, i from 0
+    label_sets: utterances must be in all of them, e.g. [labels] or [asr_labels, sid_labels]
+    name: for the report
+    split_bytes, memory_budget: if memory_budget is given, the splits of scp_files are not kept
+                                but cut again by size, see reshard
+  output:
+    number of splits written; splits left without utterances are dropped
+  '''
+  if memory_budget > 0:
+    return reshard(scp_files, split_prefix, label_sets, name, split_bytes, memory_budget)
+
+  num_split = 0
+  total_skipped = 0
+  for k, scp_file in enumerate(scp_files):
+    entries = read_scp_lines(scp_file)
+    kept = [ line for uid, line in entries if all(uid in labels for labels in label_sets) ]
+    skipped = [ uid for uid, line in entries if not all(uid in labels for labels in label_sets) ]
+
+    if len(skipped) > 0:
+      index = FeatureIndex(scp_file)
+      report_skipped(index, name, k, skipped, len(entries))
+      index.close()
+    total_skipped += len(skipped)
+
+    if len(kept) == 0:
+      logger.info('split %d of %s has no labeled utterances, dropped' % (k, name))
+      continue
+    with open('%s.%d.scp' % (split_prefix, num_split), 'w') as f:
+      f.writelines(kept)
+    num_split += 1
+
+  if total_skipped > 0:
+    logger.info('%s: skipped %d utterances without labels, %d splits left of %d' %
+                (name, total_skipped, num_split, len(scp_files)))
+  if num_split == 0:
+    raise RuntimeError("No feats are loaded! please check feature and labels, and make sure they are matched.")
+  return num_split
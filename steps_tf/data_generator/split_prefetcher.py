@@ -0,0 +1,105 @@
+import threading
+import weakref
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+
+
+class SplitPrefetcher:
+  '''
+  loads splits in a background thread so the next split is ready when the current one runs out.
+  Splits are requested by index; after split k the thread goes on with k+1, k+2, ... (mod num_split),
+  which is the order both loop mode and a reset_batch() back to split 0 ask for.
+  A request for any other split drops what was prefetched and restarts from there.
+  Shuffling stays with the caller, so the random state is only touched in the main thread.
+  enabled with "prefetch_splits = <queue depth>" in the [feature] section
+  '''
+  def __init__ (self, generator, num_split, depth = 1):
+    '''
+    input:
+      generator: data generator, splits are loaded by generator.read_split_data(split_id)
+      num_split: number of splits
+      depth: number of splits to keep ready
+    '''
+    # weak reference, so the generator can still be deleted and clean up its tmp_dir
+    self.generator = weakref.ref(generator)
+    self.num_split = num_split
+    self.depth = depth
+    self.queue = queue.Queue()
+    self.lock = threading.Lock()
+    self.stop_event = threading.Event()
+    self.thread = None
+    self.next_split = 0       # next split the thread will load
+    self.expected = None      # split at the head of the queue
+
+
+  def start(self):
+    # call with self.lock held
+    self.thread = threading.Thread(target = self.fill)
+    self.thread.daemon = True
+    self.thread.start()
+
+
+  def fill(self):
+    # the thread exits once depth splits are ready, get() starts it again
+    while True:
+      with self.lock:
+        if self.stop_event.is_set() or self.queue.qsize() >= self.depth:
+          self.thread = None
+          return
+        split_id = self.next_split
+        self.next_split = (split_id + 1) % self.num_split
+      generator = self.generator()
+      if generator is None:
+        return
+      try:
+        result = (split_id, generator.read_split_data(split_id), None)
+      except Exception as e:
+        result = (split_id, None, e)
+      del generator
+      self.queue.put(result)
+      if result[2] is not None:
+        # get() raises it and restarts from there next time
+        with self.lock:
+          self.thread = None
+        return
+
+
+  def close(self):
+    self.stop_event.set()
+    thread = self.thread
+    if thread is not None and thread is not threading.current_thread():
+      thread.join()
+    self.thread = None
+
+
+  def restart(self, split_id):
+    self.close()
+    while not self.queue.empty():
+      self.queue.get()
+    self.stop_event.clear()
+    with self.lock:
+      self.next_split = split_id
+      self.start()
+    self.expected = split_id
+
+
+  def get(self, split_id):
+    '''
+    output:
+      data of split split_id, as returned by read_split_data
+    '''
+    if self.expected != split_id:
+      self.restart(split_id)
+    loaded_id, data, error = self.queue.get()
+    assert loaded_id == split_id
+    if error is not None:
+      self.close()
+      self.expected = None
+      raise error
+    self.expected = (split_id + 1) % self.num_split
+    with self.lock:
+      if self.thread is None:
+        self.start()
+    return data
@@ -0,0 +1,207 @@
+import multiprocessing
+import traceback
+import tempfile
+import weakref
+import shutil
+import numpy
+import os
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+
+ALIGNMENT = 64
+
+# workers get the generator as a weakref, which only resolves in a forked child;
+# python 2 has no get_context and always forks on posix
+try:
+  fork_context = multiprocessing.get_context('fork')
+except AttributeError:
+  fork_context = multiprocessing
+
+
+def split_owner(split_id, num_workers):
+  return split_id % num_workers
+
+
+def write_slot(path, data):
+  '''
+  write the arrays of a prepared split into a shared memory file
+  output:
+    layout: per item of data, ('array', offset, dtype, shape) or ('value', item)
+  '''
+  layout = []
+  size = 0
+  for item in data:
+    if isinstance(item, numpy.ndarray):
+      layout.append(('array', size, item.dtype.str, item.shape))
+      size += (item.nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+    else:
+      layout.append(('value', item))
+  buf = numpy.memmap(path, dtype = numpy.uint8, mode = 'w+', shape = (max(size, 1),))
+  for item, entry in zip(data, layout):
+    if entry[0] == 'array' and item.nbytes > 0:
+      buf[entry[1]:entry[1]+item.nbytes] = numpy.ascontiguousarray(item).reshape(-1).view(numpy.uint8)
+  del buf
+  return layout
+
+
+def read_slot(path, layout):
+  '''
+  map a slot written by write_slot; arrays are copy-on-write views of the shared memory,
+  the file is unlinked right away and the memory goes away with the last view
+  '''
+  buf = numpy.memmap(path, dtype = numpy.uint8, mode = 'c')
+  os.unlink(path)
+  data = []
+  for entry in layout:
+    if entry[0] == 'array':
+      _, offset, dtype, shape = entry
+      dtype = numpy.dtype(dtype)
+      nbytes = int(numpy.prod(shape)) * dtype.itemsize
+      data.append(buf[offset:offset+nbytes].view(dtype).reshape(shape))
+    else:
+      data.append(entry[1])
+  return tuple(data)
+
+
+def worker_loop(generator_ref, worker_id, num_workers, num_split, seed, slot_dir,
+                command_queue, result_queue):
+  '''
+  body of a worker process; forked, so generator_ref still resolves in here.
+  After a ('start', generation, start_split, start_seq) command, prepares the splits this
+  worker owns in sequence order, until the next command. None stops the worker.
+  '''
+  generator = generator_ref()
+  command = command_queue.get()
+  while command is not None:
+    _, generation, start_split, start_seq = command
+    command = None
+    seq = start_seq
+    while command is None:
+      try:
+        command = command_queue.get_nowait()
+        break
+      except queue.Empty:
+        pass
+      split_id = (start_split + seq - start_seq) % num_split
+      if split_owner(split_id, num_workers) == worker_id:
+        path = '%s/slot.%d.%d' % (slot_dir, generation, seq)
+        try:
+          # the shuffle only depends on seed and seq, not on which worker does it
+          random_state = numpy.random.RandomState([seed, seq])
+          layout = write_slot(path, generator.prepare_split(split_id, random_state))
+          result = (generation, seq, path, layout, None)
+        except Exception:
+          result = (generation, seq, None, None, traceback.format_exc())
+        result_queue.put(result)
+      seq += 1
+    if command is None:
+      command = command_queue.get()
+
+
+class SplitWorkerPool:
+  '''
+  prepares splits in worker processes: worker w owns the splits k with k % num_workers == w,
+  reads them, packs and shuffles them with generator.prepare_split(split_id, random_state)
+  and writes the arrays to a shared memory slot in shm_dir.
+  The main process maps the slots, so the arrays are never pickled or copied.
+  At most num_workers * num_slots prepared splits wait in shared memory.
+  Results depend on seed but not on timing; splits are shuffled with RandomState([seed, seq]),
+  seq counting the splits handed out, across restarts of the sequence at another split.
+  enabled with "split_workers = <number of processes>" in the [feature] section.
+  The workers are forked whatever the default start method, so they need a platform with fork
+  '''
+  def __init__ (self, generator, num_split, num_workers, num_slots = 1, seed = 777,
+                shm_dir = '/dev/shm'):
+    self.num_split = num_split
+    # a worker without splits would spin forever
+    self.num_workers = min(num_workers, num_split)
+    self.slot_dir = tempfile.mkdtemp(prefix = 'split_slots.', dir = shm_dir)
+    self.generation = 0
+    self.start_split = None
+    self.start_seq = 0
+    self.seq = 0
+    self.command_queues = []
+    self.result_queues = []
+    self.workers = []
+    for worker_id in range(self.num_workers):
+      command_queue = fork_context.Queue()
+      result_queue = fork_context.Queue(maxsize = num_slots)
+      worker = fork_context.Process(target = worker_loop,
+                                    args = (weakref.ref(generator), worker_id, self.num_workers,
+                                            num_split, seed, self.slot_dir,
+                                            command_queue, result_queue))
+      worker.daemon = True
+      worker.start()
+      self.command_queues.append(command_queue)
+      self.result_queues.append(result_queue)
+      self.workers.append(worker)
+
+
+  def __del__(self):
+    self.close()
+
+
+  def close(self):
+    for command_queue in self.command_queues:
+      command_queue.put(None)
+    for worker in self.workers:
+      # a worker blocked on a full result queue does not see the stop command
+      worker.join(timeout = 1)
+      if worker.is_alive():
+        worker.terminate()
+    self.workers = []
+    self.command_queues = []
+    if os.path.exists(self.slot_dir):
+      shutil.rmtree(self.slot_dir)
+
+
+  def restart(self, split_id, seq = None):
+    '''
+    go on with the splits from split_id, the first of them shuffled with seq; by default
+    with the seq the next split would have had, so a restart changes no shuffle
+    '''
+    if seq is None:
+      seq = self.seq
+    self.generation += 1
+    self.start_split = split_id
+    self.start_seq = seq
+    self.seq = seq
+    for command_queue in self.command_queues:
+      command_queue.put(('start', self.generation, split_id, seq))
+
+
+  def next_split(self):
+    # the split the workers are preparing next, None before the first get
+    if self.start_split is None:
+      return None
+    return (self.start_split + self.seq - self.start_seq) % self.num_split
+
+
+  def next_seq(self):
+    ''' the seq the next get shuffles its split with, whichever split it asks for '''
+    return self.seq
+
+
+  def get(self, split_id):
+    '''
+    output:
+      prepare_split(split_id, ...) of the generator, arrays mapped from shared memory
+    '''
+    if self.next_split() != split_id:
+      self.restart(split_id)
+    worker_id = split_owner(split_id, self.num_workers)
+    while True:
+      generation, seq, path, layout, error = self.result_queues[worker_id].get()
+      if generation == self.generation:
+        break
+      # left over from before a restart
+      if path is not None and os.path.exists(path):
+        os.unlink(path)
+    if error is not None:
+      self.start_split = None
+      raise RuntimeError('split worker %d failed on split %d:\n%s' % (worker_id, split_id, error))
+    assert seq == self.seq
+    self.seq += 1
+    return read_slot(path, layout)
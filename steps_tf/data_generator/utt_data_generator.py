@@ -2,6 +2,16 @@ from subprocess import Popen, PIPE, check_output
 import tempfile
 import kaldi_io
 import kaldi_IO
+from feature_frontend import NativeFrontend
+from cmvn_stats import compute_cmvn
+from label_store import LabelStore, read_scp_keys
+from split_prefetcher import SplitPrefetcher
+from split_workers import SplitWorkerPool
+from split_planner import plan_splits, report_split_memory
+from shuffle_buffer import ShuffleBuffer
+from augment import make_augmenter
+from generator_state import rng_state, set_rng_state, load_point, reload_split
+from windowed_split import WindowedSplit, flatten_split, window_starts, split_state, split_from_state
 import pickle
 import shutil
 import numpy
@@ -12,7 +22,7 @@ DEVNULL = open(os.devnull, 'w')
 
 class UttDataGenerator:
   def __init__ (self, data, labels, trans_dir, exp, name, conf, 
-                seed=777, shuffle=False, num_gpus = 1):
+                seed=777, shuffle=False, num_gpus = 1, buckets=None):
     
     self.data = data
     self.labels = labels
@@ -23,17 +33,34 @@ class UttDataGenerator:
     self.max_length = conf.get('max_length', 2000)
     self.sliding_window = conf.get('sliding_window', 20)
     self.jitter_window = conf.get('jitter_window', 0)
+    # windows are batched with windows of similar length, each batch is padded to its bucket
+    self.buckets = [ b for b in sorted(buckets or []) if b < self.max_length ] + [self.max_length]
     self.feat_type = conf.get('feat_type', 'raw')
     self.delta_opts = conf.get('delta_opts', '')
     self.max_split_data_size = conf.get('max_split_data_size', 2000)
     self.clean_up = conf.get('clean_up', True)
+    self.frontend = conf.get('frontend', 'kaldi')
+    self.prefetch_splits = conf.get('prefetch_splits', 0)
+    self.split_workers = conf.get('split_workers', 0)
+    self.split_slots = conf.get('split_slots', 1)
+    self.shm_dir = conf.get('shm_dir', '/dev/shm')
+    # cut the data again into splits of about this many bytes in memory, see split_bytes
+    self.split_memory_budget = conf.get('split_memory_budget', 0)
+    # mix windows across splits in a buffer of this many frames
+    self.shuffle_buffer = conf.get('shuffle_buffer', 0)
+    # look labels up per split, by a merge-join of the split scp with a LabelStore
+    self.stream_labels = conf.get('stream_labels', False)
+    if self.stream_labels and not isinstance(self.labels, LabelStore):
+      raise RuntimeError('stream_labels needs the alignments in a LabelStore')
 
     if self.name == 'train':
       self.loop = conf.get('loop_mode', False)
       self.split_per_iter = conf.get('split_per_iter', None)
+      self.augmenter = make_augmenter(conf, self.splice)
     else:
       self.loop = False
       self.split_per_iter = None
+      self.augmenter = None
     self.split_counter = 0        # keep increasing
     self.split_data_counter = 0   # loop from 0 to num_split
     if self.loop and self.split_per_iter is None:
@@ -48,40 +75,84 @@ class UttDataGenerator:
     shutil.copyfile("%s/feats.%s.scp" % (self.data, self.name), "%s/%s.scp" % (self.exp, self.name))
 
     if name == 'train':
-      cmd = ['copy-feats', '\'scp:head -10000 %s/%s.scp |\'' % (exp, self.name), 'ark:- |']
-      cmd.extend(['splice-feats', '--left-context='+str(self.splice),
-                  '--right-context='+str(self.splice), 'ark:- ark:- |'])
-      cmd.extend(['compute-cmvn-stats', 'ark:-', exp+'/cmvn.mat'])
-      Popen(' '.join(cmd), shell=True).communicate()
+      compute_cmvn('%s/%s.scp' % (self.exp, self.name), self.splice, self.exp+'/cmvn.mat',
+                   conf.get('cmvn_utts', 10000), conf.get('cmvn_jobs', None), seed)
+
+    if self.frontend == 'native':
+      self.native_frontend = NativeFrontend(self.exp+'/cmvn.mat', self.splice)
+
+    self.feat_dim = int(open('%s/feat_dim' % self.data).read()) * (2*self.splice+1)
 
     self.num_split = int(math.ceil(1.0 * self.num_utts / self.max_split_data_size))
-    for i in range(self.num_split):
-      shutil.copyfile("%s/feats.%s.%d.scp" % (self.data, self.name, (i+1)), "%s/split.%s.%d.scp" % (self.tmp_dir, self.name, i))
+    # utterances without labels are left out of the splits
+    split_scps = [ "%s/feats.%s.%d.scp" % (self.data, self.name, (i+1)) for i in range(self.num_split) ]
+    self.num_split = plan_splits(split_scps, "%s/split.%s" % (self.tmp_dir, self.name),
+                                 [self.labels], self.name,
+                                 self.split_bytes, self.split_memory_budget)
+
+    self.prefetcher = None
+    if self.prefetch_splits > 0:
+      self.prefetcher = SplitPrefetcher(self, self.num_split, self.prefetch_splits)
  
     numpy.random.seed(seed)
 
-    self.feat_dim = int(open('%s/feat_dim' % self.data).read()) * (2*self.splice+1)
-
-    self.x = numpy.empty ((0, self.max_length, self.feat_dim))
-    self.y = numpy.empty ((0, self.max_length), dtype='int32')
-    self.seq_length = numpy.empty (0, dtype='int32')
-    self.mask = numpy.empty ((0, self.max_length), dtype='float32')
+    # windows of the current split, batches are gathered into batch_buffers
+    self.split = WindowedSplit(numpy.zeros((1, self.feat_dim), dtype='float32'),
+                               numpy.zeros(1, dtype='int32'), self.max_length)
+    self.batch_buffers = {}
     
     self.batch_pointer = 0
+    # state before the last split was loaded, for get_state
+    self.load_point = None
+    # frames and padded frames of the batches since the last reset_batch
+    self.real_frames = 0
+    self.padded_frames = 0
+
+    self.buffer = None
+    if self.shuffle_buffer > 0:
+      self.buffer = ShuffleBuffer(self.shuffle_buffer)
+
+    # workers are forked here, once the generator is fully set up
+    self.worker_pool = None
+    if self.split_workers > 0:
+      self.worker_pool = SplitWorkerPool(self, self.num_split, self.split_workers,
+                                         self.split_slots, seed, self.shm_dir)
 
 
   def get_feat_dim(self):
     return self.feat_dim
 
 
+  def split_bytes(self, num_frames):
+    '''
+    estimated memory of an utterance in a loaded split, for split_memory_budget:
+    the float32 frames and int32 labels, and 40 bytes of records per window.
+    Splits read ahead by the prefetcher come on top of it.
+    '''
+    num_windows = len(window_starts(num_frames, self.max_length, self.sliding_window))
+    return num_frames * (self.feat_dim * 4 + 4) + num_windows * 40
+
+
   def __del__(self):
-    if self.clean_up and os.path.exists(self.feat_dir):
+    if self.worker_pool is not None:
+      self.worker_pool.close()
+    if self.prefetcher is not None:
+      self.prefetcher.close()
+    if self.clean_up and os.path.exists(self.tmp_dir):
       shutil.rmtree(self.tmp_dir)
 
 
+  def need_split(self):
+    # not enough data for next batch
+    if self.buffer is not None:
+      drain = not self.loop and self.split_data_counter == self.num_split
+      return not self.buffer.ready(self.batch_size, drain)
+    return self.batch_pointer + self.batch_size > len(self.split)
+
+
   def has_data(self):
     # has enough data for next batch
-    if self.batch_pointer + self.batch_size > len(self.x):
+    if self.need_split():
       if self.loop and (self.split_counter+1) % self.split_per_iter == 0:
         return False
       if not self.loop and self.split_data_counter == self.num_split:
@@ -96,27 +167,38 @@ class UttDataGenerator:
       feat_list: list of np matrix [num_frames, feat_dim]
       label_list: list of int32 np array [num_frames] 
     '''
-
-    p1 = Popen (['splice-feats', '--print-args=false', '--left-context='+str(self.splice),
-                 '--right-context='+str(self.splice), 
-                 'scp:'+self.tmp_dir+'/split.'+self.name+'.'+str(self.split_data_counter)+'.scp',
-                 'ark:-'], stdout=PIPE, stderr=DEVNULL)
-    p2 = Popen (['apply-cmvn', '--print-args=false', '--norm-vars=true', self.exp+'/cmvn.mat',
-                 'ark:-', 'ark:-'], stdin=p1.stdout, stdout=PIPE, stderr=DEVNULL)
+    if self.prefetcher is not None:
+      return self.prefetcher.get(self.split_data_counter)
+    return self.read_split_data(self.split_data_counter)
+
+
+  def read_split_data (self, split_id):
+    split_scp = self.tmp_dir+'/split.'+self.name+'.'+str(split_id)+'.scp'
+    labels = self.labels
+    if self.stream_labels:
+      # only the labels of this split are copied out of the store
+      labels = self.labels.join(read_scp_keys(split_scp))
+    if self.frontend == 'native':
+      utterances = self.native_frontend.read_split(split_scp, labels)
+    else:
+      p1 = Popen (['splice-feats', '--print-args=false', '--left-context='+str(self.splice),
+                   '--right-context='+str(self.splice), 'scp:'+split_scp,
+                   'ark:-'], stdout=PIPE, stderr=DEVNULL)
+      p2 = Popen (['apply-cmvn', '--print-args=false', '--norm-vars=true', self.exp+'/cmvn.mat',
+                   'ark:-', 'ark:-'], stdin=p1.stdout, stdout=PIPE, stderr=DEVNULL)
+      utterances = kaldi_IO.read_ark(p2.stdout)
 
     feat_list = []
     label_list = []
-    
-    while True:
-      uid, feat = kaldi_IO.read_utterance (p2.stdout)
-      if uid == None:
-        break;
-      if uid in self.labels:
+
+    for uid, feat in utterances:
+      if uid in labels:
         feat_list.append (feat)
-        label_list.append (self.labels[uid])
+        label_list.append (labels[uid])
+
+    if self.frontend != 'native':
+      p1.stdout.close()
 
-    p1.stdout.close()
-    
     if len(feat_list) == 0 or len(label_list) == 0:
       raise RuntimeError("No feats are loaded! please check feature and labels, and make sure they are matched.")
 
@@ -127,119 +209,203 @@ class UttDataGenerator:
     '''
     for each utterance, we use a rolling window to predict the output posterior. 
     Reference: Deep Bi-Directional Recurrent Network over Spectral Windows
+    The windows are records over the frames of the split, nothing is copied per window.
     input:
       features: list of np 2d-array [num_frames, feat_dim]
       labels: list of np array [num_frames]
     output:
-      features_pad: np 3d-array [batch_size, max_length, feat_dim]
-      labels_pad: matrix[batch_size, max_length]
-      seq_length: np array [batch_size]
-      mask: matrix[batch_size, max_length]
+      WindowedSplit, windows of max_length frames every sliding_window frames;
+      the last window of an utterance is shorter and padded when gathered
     '''
     assert len(features) == len(labels)
 
-    features_pad = []
-    labels_pad = []
-    mask = []
-    seq_length = []
     max_length = self.max_length
-    sliding_window = self.sliding_window
     jitter_window = self.jitter_window
+    frames, flat_labels, utt_offset = flatten_split(features, labels)
+    split = WindowedSplit(frames, flat_labels, max_length)
 
-    for feat, lab in zip(features, labels):
+    offset = []
+    length = []
+    mask_start = []
+    mask_end = []
+    for feat, lab, utt_start in zip(features, labels, utt_offset):
 
       assert len(feat) == len(lab)
-      start_index = 0
-
-      pick_start = 0
-      pick_end = (max_length + jitter_window) // 2
-      while start_index + max_length < len(feat):
-        # cut utterances into pieces
-        end_index = start_index + max_length
-        features_pad.append(feat[start_index:end_index])
-        labels_pad.append(lab[start_index:end_index])
-        seq_length.append(max_length)
-        if jitter_window != 0:
-          this_mask = numpy.zeros(max_length)
-          this_mask[pick_start:pick_end] = 1
-          mask.append(this_mask)
-          # only the first window starts from 0, all others start from (max_length - jitter_window) / 2
-          pick_start = (max_length - jitter_window) // 2
-          start_index += sliding_window
-        else:
-          mask.append(numpy.ones(max_length))
-          start_index += sliding_window
-
-      # last part, pad zero
-      num_zero = max_length + start_index - len(feat)
-      zeros2pad = numpy.zeros((num_zero, len(feat[0])))
-      features_pad.append(numpy.concatenate((feat[start_index:], zeros2pad)))
-      labels_pad.append(numpy.append(lab[start_index:], numpy.zeros(num_zero)))
-      seq_length.append(len(feat) - start_index)
+      starts = window_starts(len(feat), max_length, self.sliding_window)
+      win_length = numpy.minimum(len(feat) - starts, max_length)
+      offset.append(utt_start + starts)
+      length.append(win_length)
       if jitter_window != 0:
-        # our last window goes till the end of the utterance
-        this_mask = numpy.zeros(max_length)
-        this_mask[pick_start:(len(feat) - start_index)] = 1
-        mask.append(this_mask)
+        # only the first window starts from 0, all others start from (max_length - jitter_window) / 2
+        # and our last window goes till the end of the utterance
+        this_start = numpy.full(len(starts), (max_length - jitter_window) // 2, dtype = 'int64')
+        this_start[0] = 0
+        this_end = numpy.full(len(starts), (max_length + jitter_window) // 2, dtype = 'int64')
+        this_end[-1] = win_length[-1]
       else:
-        mask.append(numpy.append(numpy.ones(len(feat) - start_index), numpy.zeros(num_zero)))
+        this_start = numpy.zeros(len(starts), dtype = 'int64')
+        this_end = win_length
+      mask_start.append(this_start)
+      mask_end.append(this_end)
+
+    split.add_windows(numpy.concatenate(offset), numpy.concatenate(length),
+                      numpy.concatenate(mask_start), numpy.concatenate(mask_end))
+    return split
+
+
+  def bucket_length(self, length):
+    ''' the smallest bucket that holds windows of length, np array or int '''
+    return numpy.array(self.buckets)[numpy.searchsorted(self.buckets, length)]
+
+
+  def bucket_order(self, split, random_state):
+    '''
+    output:
+      permutation of the (shuffled) windows of split that puts windows of the same bucket
+      next to each other, in batches of batch_size in random order; the windows
+      of the last partial batch stay at the end, they are carried to the next split
+    '''
+    order = numpy.argsort(numpy.searchsorted(self.buckets, split.length), kind = 'mergesort')
+    num_batches = len(order) // self.batch_size
+    num_full = num_batches * self.batch_size
+    batches = order[:num_full].reshape(num_batches, self.batch_size)[random_state.permutation(num_batches)]
+    return numpy.append(batches.reshape(-1), order[num_full:])
 
-    features_pad = numpy.array(features_pad)
-    labels_pad = numpy.array(labels_pad)
-    seq_length = numpy.array(seq_length)
-    mask = numpy.array(mask)
 
-    return features_pad, labels_pad, seq_length, mask
+  def prepare_split (self, split_id, random_state):
+    '''
+    read, pack and shuffle a split, in a worker process of SplitWorkerPool; the windows are
+    put in bucket order by load_split, once the windows left over are in front of them
+    output:
+      the arrays of the shuffled WindowedSplit
+    '''
+    x, y = self.read_split_data(split_id)
+    if self.augmenter is not None:
+      x, y = self.augmenter.apply(x, y, random_state)
+    split = self.pack_utt_data(x, y)
+    split.permute(random_state.permutation(len(split)))
+    return split.to_arrays()
+
+
+  def load_split (self):
+    ''' load split split_data_counter behind the windows left '''
+    if self.buffer is None:
+      self.load_point = load_point(self)
+    if self.worker_pool is not None:
+      # already packed and shuffled by the worker
+      split = WindowedSplit(*self.worker_pool.get(self.split_data_counter))
+    else:
+      x, y = self.get_next_split_data()
+      if self.augmenter is not None:
+        x, y = self.augmenter.apply(x, y, numpy.random)
+      split = self.pack_utt_data(x, y)
+    report_split_memory(self.name, self.split_data_counter, split.to_arrays())
+
+    if self.buffer is not None:
+      # the buffer shuffles, it keeps windows padded to their bucket, a pool per bucket
+      bucket = self.bucket_length(split.length)
+      for length in numpy.unique(bucket):
+        x_pad, y_pad, mask, seq_length, _ = split.take(numpy.where(bucket == length)[0], {}, length)
+        self.buffer.add((x_pad, y_pad, seq_length, mask), length, length)
+    else:
+      if self.batch_pointer < len(self.split):
+        split = split.prepend(self.split, numpy.arange(self.batch_pointer, len(self.split)))
+      self.split = split
+      self.batch_pointer = 0
+
+      if self.worker_pool is None:
+        ## Shuffle data, utterance base
+        randomInd = numpy.array(range(len(self.split)))
+        numpy.random.shuffle(randomInd)
+        self.split.permute(randomInd)
+      # with the windows left over, so that they are batched with their bucket too
+      if len(self.buckets) > 1:
+        self.split.permute(self.bucket_order(self.split, numpy.random))
+
+
+  def left_state(self):
+    ''' the windows not batched yet, less than a batch when a split is loaded, see load_point '''
+    return split_state(self.split.select(numpy.arange(self.batch_pointer, len(self.split))), 'left_')
+
+
+  def set_left(self, state):
+    self.split = split_from_state(state, 'left_')
+    self.batch_pointer = 0
 
 
   def get_batch_utterances (self):
     '''
     output:
-      x_mini: np matrix [batch_size, max_length, feat_dim]
-      y_mini: np matrix [batch_size, max_length]
+      x_mini: np matrix [batch_size, length, feat_dim]
+      y_mini: np matrix [batch_size, length]
       seq_length: np array [batch_size]
-      mask: np matrix [batch_size, max_length]
+      mask: np matrix [batch_size, length]
+      length is the bucket of the longest window of the batch, max_length without buckets;
+      x_mini, y_mini and mask are reused by the next call
     '''
     # read split data until we have enough for this batch
-    while (self.batch_pointer + self.batch_size > len (self.x)):
+    while (self.need_split()):
       if not self.has_data():
         # not loop mode and we arrive the end, do not read anymore
         return None, None, None, None
 
-      x, y = self.get_next_split_data()
-      x_pad, y_pad, seq_length, mask = self.pack_utt_data(x, y)
-
-      self.x = numpy.concatenate ((self.x[self.batch_pointer:], x_pad))
-      self.y = numpy.concatenate ((self.y[self.batch_pointer:], y_pad))
-      self.seq_length = numpy.append(self.seq_length[self.batch_pointer:], seq_length)
-      self.mask = numpy.concatenate ((self.mask[self.batch_pointer:], mask))
-      
-      self.batch_pointer = 0
-
-      ## Shuffle data, utterance base
-      randomInd = numpy.array(range(len(self.x)))
-      numpy.random.shuffle(randomInd)
-      self.x = self.x[randomInd]
-      self.y = self.y[randomInd]
-      self.seq_length = self.seq_length[randomInd]
-      self.mask = self.mask[randomInd]
+      self.load_split()
 
       self.split_counter += 1
       self.split_data_counter += 1
       if self.loop and self.split_data_counter == self.num_split:
         self.split_data_counter = 0
     
-    x_mini = self.x[self.batch_pointer:self.batch_pointer+self.batch_size]
-    y_mini = self.y[self.batch_pointer:self.batch_pointer+self.batch_size]
-    seq_mini = self.seq_length[self.batch_pointer:self.batch_pointer+self.batch_size]
-    mask_mini = self.mask[self.batch_pointer:self.batch_pointer+self.batch_size]
+    if self.buffer is not None:
+      _, (x_mini, y_mini, seq_mini, mask_mini) = self.buffer.sample(self.batch_size)
+    else:
+      index = numpy.arange(self.batch_pointer, self.batch_pointer+self.batch_size)
+      # only as many time steps as the longest window of the batch needs
+      length = self.bucket_length(self.split.length[index].max())
+      x_mini, y_mini, mask_mini, seq_mini, _ = self.split.take(index, self.batch_buffers, length)
 
     self.batch_pointer += self.batch_size
     self.last_batch_frames = mask_mini.sum()
+    self.real_frames += seq_mini.sum()
+    self.padded_frames += seq_mini.size * mask_mini.shape[1]
 
     return x_mini, y_mini, seq_mini, mask_mini
 
 
+  def get_state(self):
+    '''
+    where the generator is in the data, for a step checkpoint: the split counters, the random
+    state, and the load point of the current split with the batches taken from it since;
+    set_state reads the split again instead of keeping its windows. Only the shuffle buffer
+    is kept as it is, it mixes many splits.
+    '''
+    state = rng_state()
+    state['split_counter'] = self.split_counter
+    state['split_data_counter'] = self.split_data_counter
+    if self.buffer is not None:
+      state.update(self.buffer.get_state())
+    elif self.load_point is not None:
+      state.update(self.load_point)
+      state['batch_pointer'] = self.batch_pointer
+    state['real_frames'] = self.real_frames
+    state['padded_frames'] = self.padded_frames
+    return state
+
+
+  def set_state(self, state):
+    ''' continue from get_state, with the batch after the last one before it '''
+    if self.buffer is not None:
+      self.buffer.set_state(state)
+    elif 'load_split_id' in state:
+      reload_split(self, state)
+      self.batch_pointer = int(state['batch_pointer'])
+    set_rng_state(state)
+    self.split_counter = int(state['split_counter'])
+    self.split_data_counter = int(state['split_data_counter'])
+    self.real_frames = int(state['real_frames'])
+    self.padded_frames = int(state['padded_frames'])
+
+
   def get_batch_size(self):
     return self.batch_size
 
@@ -252,7 +418,19 @@ class UttDataGenerator:
     return 'frames'
 
 
+  def get_padding_waste(self):
+    '''
+    output:
+      fraction of the time steps of the batches since the last reset_batch that are padding
+    '''
+    if self.padded_frames == 0:
+      return 0.0
+    return 1.0 - 1.0 * self.real_frames / self.padded_frames
+
+
   def reset_batch(self):
+    self.real_frames = 0
+    self.padded_frames = 0
     if self.loop:
       self.split_counter += 1
     else:
@@ -261,9 +439,12 @@ class UttDataGenerator:
 
   def save_target_counts(self, num_targets, output_file):
     # here I'm assuming training data is less than 10,000 hours
-    counts = numpy.zeros(num_targets, dtype='int64')
-    for alignment in self.labels.values():
-      counts += numpy.bincount(alignment, minlength = num_targets)
+    if isinstance(self.labels, LabelStore):
+      counts = self.labels.target_counts(num_targets)
+    else:
+      counts = numpy.zeros(num_targets, dtype='int64')
+      for alignment in self.labels.values():
+        counts += numpy.bincount(alignment, minlength = num_targets)
     # add a ``half-frame'' to all the elements to avoid zero-counts (decoding issue)
     counts = counts.astype(float) + 0.5
     numpy.savetxt(output_file, counts, fmt = '%.1f')
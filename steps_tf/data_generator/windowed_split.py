@@ -0,0 +1,212 @@
+import numpy
+
+
+def flatten_split(features, labels = None):
+  '''
+  input:
+    features: list of np matrix [num_frames, feat_dim]
+    labels: optional list of np array [num_frames], frame labels
+  output:
+    frames: float32 np matrix [total_frames + 1, feat_dim], the last row is zeros for padding
+    flat_labels: int32 np array [total_frames + 1], or None without labels
+    utt_offset: np array [num_utts], first frame of each utterance
+  '''
+  lengths = numpy.array([ len(feat) for feat in features ], dtype = 'int64')
+  utt_offset = numpy.cumsum(lengths) - lengths
+  total = lengths.sum()
+  frames = numpy.empty((total + 1, features[0].shape[1]), dtype = 'float32')
+  for feat, offset in zip(features, utt_offset):
+    frames[offset:offset+len(feat)] = feat
+  frames[total] = 0.0
+  flat_labels = None
+  if labels is not None:
+    flat_labels = numpy.empty(total + 1, dtype = 'int32')
+    for lab, offset in zip(labels, utt_offset):
+      flat_labels[offset:offset+len(lab)] = lab
+    flat_labels[total] = 0
+  return frames, flat_labels, utt_offset
+
+
+def batch_buffer(buffers, name, shape, dtype):
+  # a reusable array, one per name and shape
+  key = (name, shape)
+  if key not in buffers:
+    buffers[key] = numpy.empty(shape, dtype = dtype)
+  return buffers[key]
+
+
+# names of the arrays of WindowedSplit.to_arrays
+SPLIT_ARRAYS = ['frames', 'labels', 'max_length', 'offset', 'length', 'mask_start', 'mask_end', 'extra']
+
+
+def split_state(split, prefix = 'split_'):
+  ''' the arrays of split as a dict, for a generator checkpoint; labels left out if None '''
+  state = {}
+  for name, array in zip(SPLIT_ARRAYS, split.to_arrays()):
+    if array is not None:
+      state[prefix + name] = array
+  return state
+
+
+def split_from_state(state, prefix = 'split_'):
+  ''' the WindowedSplit saved with split_state '''
+  arrays = [ state.get(prefix + name) for name in SPLIT_ARRAYS ]
+  arrays[2] = int(arrays[2])
+  return WindowedSplit(*arrays)
+
+
+def window_starts(num_frames, max_length, sliding_window):
+  '''
+  output:
+    np array, start of each window; all but the last satisfy start + max_length < num_frames
+  '''
+  num_full = max(0, -(-(num_frames - max_length) // sliding_window))
+  return numpy.arange(num_full + 1, dtype = 'int64') * sliding_window
+
+
+class WindowedSplit:
+  '''
+  a split kept as one flat frame buffer with windows over it, stored as (offset, length) records
+  instead of padded copies of the frames. Batches are gathered with one vectorized take
+  into reusable arrays; padding and masks are made on the fly.
+  '''
+  def __init__ (self, frames, labels, max_length, offset = None, length = None,
+                mask_start = None, mask_end = None, extra = None):
+    '''
+    input:
+      frames, labels: as returned by flatten_split
+      max_length: window length, the time dimension of the batches
+      offset, length, mask_start, mask_end, extra: records, see add_windows
+    '''
+    self.frames = frames
+    self.labels = labels
+    self.max_length = max_length
+    self.offset = numpy.empty(0, dtype = 'int64') if offset is None else offset
+    self.length = numpy.empty(0, dtype = 'int64') if length is None else length
+    self.mask_start = numpy.empty(0, dtype = 'int64') if mask_start is None else mask_start
+    self.mask_end = numpy.empty(0, dtype = 'int64') if mask_end is None else mask_end
+    self.extra = numpy.empty(0, dtype = 'int32') if extra is None else extra
+
+
+  def __len__(self):
+    return len(self.offset)
+
+
+  def add_windows(self, offset, length, mask_start = None, mask_end = None, extra = None):
+    '''
+    input:
+      offset: np array, first frame of each window in frames
+      length: np array, frames of each window, the rest up to max_length is padding
+      mask_start, mask_end: np array, frames of the window the mask is 1 for; default [0, length)
+      extra: np array, a per-window int label, e.g. the speaker
+    '''
+    if mask_start is None:
+      mask_start = numpy.zeros(len(offset), dtype = 'int64')
+    if mask_end is None:
+      mask_end = length
+    if extra is None:
+      extra = numpy.zeros(len(offset), dtype = 'int32')
+    self.offset = numpy.append(self.offset, offset)
+    self.length = numpy.append(self.length, length)
+    self.mask_start = numpy.append(self.mask_start, mask_start)
+    self.mask_end = numpy.append(self.mask_end, mask_end)
+    self.extra = numpy.append(self.extra, extra).astype('int32')
+
+
+  def permute(self, order):
+    ''' reorder the windows, the frames stay where they are '''
+    self.offset = self.offset[order]
+    self.length = self.length[order]
+    self.mask_start = self.mask_start[order]
+    self.mask_end = self.mask_end[order]
+    self.extra = self.extra[order]
+
+
+  def prepend(self, split, index):
+    '''
+    output:
+      a new WindowedSplit with the windows index of split in front of the windows of this one;
+      the frames are copied, but only once and not per window
+    '''
+    feats, labels = split.window_frames(index)
+    if self.labels is not None:
+      labels.append(self.labels)
+    frames, flat_labels, utt_offset = flatten_split(feats + [self.frames], labels)
+    joined = WindowedSplit(frames, flat_labels, self.max_length)
+    joined.add_windows(utt_offset[:-1], split.length[index], split.mask_start[index],
+                       split.mask_end[index], split.extra[index])
+    joined.add_windows(self.offset + utt_offset[-1], self.length, self.mask_start,
+                       self.mask_end, self.extra)
+    return joined
+
+
+  def select(self, index):
+    '''
+    output:
+      a new WindowedSplit with only the windows index, in that order, and only their frames;
+      prepend takes its windows as it would take them from this split
+    '''
+    feats, labels = self.window_frames(index)
+    if len(feats) == 0:
+      feats = [ self.frames[:0] ]
+      labels = None if labels is None else [ self.labels[:0] ]
+    frames, flat_labels, utt_offset = flatten_split(feats, labels)
+    selected = WindowedSplit(frames, flat_labels, self.max_length)
+    selected.add_windows(utt_offset[:len(index)], self.length[index], self.mask_start[index],
+                         self.mask_end[index], self.extra[index])
+    return selected
+
+
+  def to_arrays(self):
+    # for SplitWorkerPool, rebuilt with WindowedSplit(*arrays)
+    return (self.frames, self.labels, self.max_length, self.offset, self.length,
+            self.mask_start, self.mask_end, self.extra)
+
+
+  def window_frames(self, index):
+    '''
+    output:
+      list of np matrix, the frames of the windows index, unpadded copies
+      list of np array, their frame labels, or None without labels
+    '''
+    feats = [ self.frames[o:o+l].copy() for o, l in zip(self.offset[index], self.length[index]) ]
+    if self.labels is None:
+      return feats, None
+    labels = [ self.labels[o:o+l].copy() for o, l in zip(self.offset[index], self.length[index]) ]
+    return feats, labels
+
+
+  def take(self, index, buffers, max_length = None):
+    '''
+    input:
+      index: np array, windows of the batch
+      buffers: dict kept by the caller, the batch arrays are reused across calls
+      max_length: time dimension of the batch, at least the longest window of it;
+                  default self.max_length
+    output:
+      x: float32 np matrix [batch_size, max_length, feat_dim], zero padded
+      y: int32 np matrix [batch_size, max_length], frame labels, or None without labels
+      mask: float32 np matrix [batch_size, max_length]
+      length: int32 np array [batch_size]
+      extra: int32 np array [batch_size]
+      x, y and mask are only valid until the next call with the same buffers
+    '''
+    if max_length is None:
+      max_length = self.max_length
+    num_windows = len(index)
+    time = numpy.arange(max_length)
+    length = self.length[index]
+    rows = self.offset[index][:, None] + time
+    # the padding points to the zero row at the end
+    rows[time >= length[:, None]] = len(self.frames) - 1
+
+    x = batch_buffer(buffers, 'x', (num_windows, max_length, self.frames.shape[1]), 'float32')
+    numpy.take(self.frames, rows, axis = 0, out = x)
+    y = None
+    if self.labels is not None:
+      y = batch_buffer(buffers, 'y', (num_windows, max_length), 'int32')
+      numpy.take(self.labels, rows, out = y)
+    mask = batch_buffer(buffers, 'mask', (num_windows, max_length), 'float32')
+    mask[...] = (time >= self.mask_start[index][:, None]) & (time < self.mask_end[index][:, None])
+    return x, y, mask, length.astype('int32'), self.extra[index]
+
@@ -1,15 +1,26 @@
+import numpy as np
 import tensorflow as tf
 import nnet
 import make_nnet_proto
 
 class DNN(object):
 
-  def __init__(self, input_dim, output_dim, batch_size, num_towers = 1):
+  def __init__(self, input_dim, output_dim, batch_size, num_towers = 1, input_queue = 0,
+               steps_per_run = 1):
     self.type = 'dnn'
     self.input_dim = input_dim
     self.output_dim = output_dim
     self.batch_size = batch_size
     self.num_towers = num_towers
+    # capacity of the input queue in front of the placeholders, 0 to feed them
+    self.input_queue = input_queue
+    self.enqueue_op = None
+    self.enqueue_holders = []
+    # training steps per run, see init_training_steps
+    self.steps_per_run = steps_per_run
+    self.nnet_proto = None
+    self.steps_run = False
+    self.last_steps = 0
 
 
   def get_input_dim(self):
@@ -30,6 +41,11 @@ class DNN(object):
       self.init_dnn_single(graph, nnet_proto_file, seed)
     else:
       self.init_dnn_multi(graph, nnet_proto_file, seed)
+    self.enqueue_op, self.enqueue_holders = nnet.read_input_queue(graph)
+    # kept in the graph, the training steps of a run build the model again from it
+    self.nnet_proto = '\n'.join(nnet.proto_lines(nnet_proto_file))
+    with graph.as_default():
+      tf.add_to_collection('nnet_proto', self.nnet_proto)
 
 
   def init_dnn_single(self, graph, nnet_proto_file, seed = 777):
@@ -38,6 +54,9 @@ class DNN(object):
     with graph.as_default():
       tf.set_random_seed(seed)
       feats_holder, labels_holder = nnet.placeholder_dnn(self.input_dim, self.batch_size)
+      if self.input_queue > 0:
+        feats_holder, labels_holder = nnet.input_queue([feats_holder, labels_holder],
+                                                       self.input_queue)
 
       keep_prob_holder = tf.placeholder(tf.float32, shape=[], name = 'keep_prob')
       
@@ -66,6 +85,9 @@ class DNN(object):
       feats_holder, labels_holder = nnet.placeholder_dnn(
                                       self.input_dim, 
                                       self.batch_size * self.num_towers)
+      if self.input_queue > 0:
+        feats_holder, labels_holder = nnet.input_queue([feats_holder, labels_holder],
+                                                       self.input_queue)
       
       keep_prob_holder = tf.placeholder(tf.float32, shape=[], name = 'keep_prob')
 
@@ -118,6 +140,8 @@ class DNN(object):
       self.read_dnn_single(graph)
     else:
       self.read_dnn_multi(graph, load_towers)
+    self.enqueue_op, self.enqueue_holders = nnet.read_input_queue(graph)
+    self.nnet_proto = nnet.read_nnet_proto(graph)
 
 
   def read_dnn_single(self, graph):
@@ -184,6 +208,53 @@ class DNN(object):
 
     self.init_train_op = init_train_op
 
+    if self.steps_per_run > 1:
+      self.init_training_steps(graph, optimizer_conf, opt)
+
+
+  def init_training_steps(self, graph, optimizer_conf, opt):
+    '''
+    up to steps_per_run training steps in one run, in a tf.while_loop (nnet.train_steps):
+    the batches are fed at once as a super-batch, or dequeued one per step from the input queue.
+    The loop body builds the model again, from the proto kept in the graph, on its variables;
+    the train op above has created the slots of the optimizer already.
+    The learning rate is fed once per run: with exponential decay, computed by the trainer from
+    global_step, all steps of a run share the rate at its start while global_step moves by one
+    per step.
+    '''
+    if self.nnet_proto is None:
+      raise RuntimeError("steps_per_run needs the nnet proto in the graph, "
+                         "which models created before it do not have")
+
+    with graph.as_default():
+      if self.input_queue > 0:
+        self.steps_feats_holder, self.steps_labels_holder = None, None
+        self.num_steps_holder = tf.placeholder(tf.int32, shape=[], name = 'num_steps')
+        num_steps = self.num_steps_holder
+        get_batch = lambda step: nnet.dequeue_input(self.enqueue_op)
+      else:
+        self.steps_feats_holder = tf.placeholder(tf.float32, shape=(None, self.input_dim),
+                                                 name = 'steps_feature')
+        self.steps_labels_holder = tf.placeholder(tf.int32, shape=(None,), name = 'steps_target')
+        self.num_steps_holder = None
+        batch_feats = tf.reshape(self.steps_feats_holder, [-1, self.batch_size, self.input_dim])
+        batch_labels = tf.reshape(self.steps_labels_holder, [-1, self.batch_size])
+        num_steps = tf.shape(batch_labels)[0]
+        get_batch = lambda step: (batch_feats[step], batch_labels[step])
+
+      getter = nnet.graph_variable_getter(graph)
+      def inference(feats):
+        with tf.variable_scope(tf.get_variable_scope(), custom_getter = getter):
+          return nnet.inference_dnn(feats, self.nnet_proto, self.keep_prob_holder, reuse = True)
+
+      run_steps, sum_loss, sum_acc = nnet.train_steps(num_steps, get_batch, inference, opt,
+                                                      optimizer_conf)
+
+    # fetching any of them runs the loop
+    self.run_steps = run_steps
+    self.steps_loss = sum_loss
+    self.steps_eval_acc = sum_acc
+
 
   def init_training_dnn_multi(self, graph, optimizer_conf):
     tower_losses = []
@@ -236,18 +307,40 @@ class DNN(object):
 
 
   def get_loss(self):
-    return self.loss
+    # of the training steps of a run, summed, after prep_steps_feed
+    return self.steps_loss if self.steps_run else self.loss
 
 
   def get_eval_acc(self):
-    return self.eval_acc
+    return self.steps_eval_acc if self.steps_run else self.eval_acc
 
 
   def get_train_op(self):
-    return self.train_op
+    return self.run_steps if self.steps_run else self.train_op
+
+
+  def get_bucket_metrics(self):
+    '''
+    [loss, eval acc] of each bucket, the loss as get_loss returns it; one bucket here,
+    and the training steps of a run with steps_per_run
+    '''
+    if self.steps_per_run > 1:
+      return [ [self.loss, self.eval_acc], [self.steps_loss, self.steps_eval_acc] ]
+    return [ [self.loss, self.eval_acc] ]
+
+
+  def get_run_steps(self):
+    ''' number of steps a run of the training steps took, int32 tensor '''
+    return self.run_steps
+
+
+  def get_last_steps(self):
+    ''' number of batches the last prep_steps_feed or prep_queued_steps_feed took '''
+    return self.last_steps
 
 
   def prep_feed(self, data_gen, params = None):
+    self.steps_run = False
     x, y = data_gen.get_batch_frames()
 
     feed_dict = { self.feats_holder: x,
@@ -259,12 +352,67 @@ class DNN(object):
                   self.learning_rate_holder: params.get('learning_rate', 0.0),
                   self.keep_prob_holder: 1.0})
 
-    return feed_dict, x is not None
+    return nnet.check_feed(feed_dict), x is not None
 
   
+  def has_input_queue(self):
+    return self.enqueue_op is not None
+
+
+  def get_enqueue_op(self):
+    return self.enqueue_op
+
+
+  def prep_enqueue_feed(self, data_gen):
+    x, y = data_gen.get_batch_frames()
+    feed_dict = dict(zip(self.enqueue_holders, [x, y]))
+    return nnet.check_feed(feed_dict), x is not None
+
+
+  def prep_params_feed(self, params = None):
+    ''' feed_dict for a step on a queued batch, i.e. everything prep_feed feeds but the batch '''
+    self.steps_run = False
+    feed_dict = { self.keep_prob_holder: 1.0 }
+
+    if params is not None:
+      feed_dict.update({
+                  self.learning_rate_holder: params.get('learning_rate', 0.0)})
+
+    return feed_dict
+
+
+  def prep_steps_feed(self, data_gen, params):
+    ''' feed_dict for the training steps of a run, a super-batch of up to steps_per_run batches '''
+    xs, ys = [], []
+    while len(xs) < self.steps_per_run:
+      x, y = data_gen.get_batch_frames()
+      if x is None:
+        break
+      xs.append(x)
+      ys.append(y)
+    self.last_steps = len(xs)
+    if len(xs) == 0:
+      return None, False
+
+    feed_dict = self.prep_params_feed(params)
+    feed_dict.update({ self.steps_feats_holder: np.vstack(xs),
+                       self.steps_labels_holder: np.concatenate(ys) })
+    self.steps_run = True
+    return nnet.check_feed(feed_dict), True
+
+
+  def prep_queued_steps_feed(self, params, num_steps):
+    ''' feed_dict for the training steps of a run on the next num_steps queued batches '''
+    feed_dict = self.prep_params_feed(params)
+    feed_dict[self.num_steps_holder] = num_steps
+    self.last_steps = num_steps
+    self.steps_run = True
+    return feed_dict
+
+
   def prep_forward_feed(self, x):
     feed_dict = { self.feats_holder: x}
-    return feed_dict
+    return nnet.check_feed(feed_dict)
   
   
   def get_outputs(self):
@@ -0,0 +1,141 @@
+import struct
+import numpy
+from kaldi_io import kaldi_io_numpy
+
+# binary header of an uncompressed matrix: "\0B" + "FM " + "\4" rows + "\4" cols
+HEADER_SIZE = 15
+HEADER_DTYPES = { b'\0BFM ': numpy.dtype('<f4'),
+                  b'\0BDM ': numpy.dtype('<f8') }
+
+
+class FeatureIndex(object):
+  '''
+  random access to the features listed in a Kaldi scp file ("uid foo.ark:offset").
+  The scp is parsed once and the ark files are memory-mapped, so an utterance or a range of
+  frames is a numpy view on the page cache, without forking copy-feats or decoding the ark.
+  Entries that cannot be mapped (compressed matrices, pipes) are decoded with kaldi_io_numpy.
+
+  usage:
+    index = FeatureIndex(data + '/feats.scp')
+    feat = index[uid]                    # [num_frames, feat_dim]
+    chunk = index.get(uid, start, n)     # same as index[uid][start:start+n]
+  '''
+
+  def __init__(self, scp_file):
+    self.scp_file = scp_file
+    self.utt_ids = []
+    self.locations = {}   # uid -> (ark, offset, row range) or (rxfilename, None, None)
+    self.headers = {}     # uid -> (dtype, rows, cols, data offset), None if not mappable
+    self.arks = {}        # ark file -> numpy.memmap
+    self.open_files = {}  # file handles for the entries we have to decode
+
+    with open(scp_file) as f:
+      for line in f:
+        fields = line.strip().split(None, 1)
+        if len(fields) != 2:
+          continue
+        uid, rxfilename = fields
+        self.utt_ids.append(uid)
+        self.locations[uid] = self.parse_location(rxfilename)
+
+
+  def parse_location(self, rxfilename):
+    if rxfilename.endswith('|'):
+      return rxfilename, None, None
+    row_range = None
+    if rxfilename.endswith(']') and '[' in rxfilename:
+      rxfilename, row_range = rxfilename[:-1].split('[', 1)
+    if ':' not in rxfilename:
+      return rxfilename, 0, row_range
+    ark, offset = rxfilename.rsplit(':', 1)
+    if not offset.isdigit():
+      return rxfilename, None, row_range
+    return ark, int(offset), row_range
+
+
+  def __len__(self):
+    return len(self.utt_ids)
+
+
+  def __contains__(self, uid):
+    return uid in self.locations
+
+
+  def keys(self):
+    return self.utt_ids
+
+
+  def get_ark(self, ark):
+    if ark not in self.arks:
+      self.arks[ark] = numpy.memmap(ark, dtype=numpy.uint8, mode='r')
+    return self.arks[ark]
+
+
+  def get_header(self, uid):
+    if uid not in self.headers:
+      ark, offset, row_range = self.locations[uid]
+      header = None
+      if offset is not None and (row_range is None or ',' not in row_range):
+        mapped = self.get_ark(ark)
+        head = mapped[offset:offset+HEADER_SIZE].tobytes()
+        if head[:5] in HEADER_DTYPES:
+          _, rows, _, cols = struct.unpack('<bibi', head[5:])
+          header = (HEADER_DTYPES[head[:5]], rows, cols, offset + HEADER_SIZE)
+      self.headers[uid] = header
+    return self.headers[uid]
+
+
+  def get_row_range(self, uid, num_rows):
+    row_range = self.locations[uid][2]
+    if row_range is None or row_range.strip() in ['', ':']:
+      return 0, num_rows
+    begin, end = row_range.split(':')
+    begin = int(begin) if begin != '' else 0
+    end = int(end) + 1 if end != '' else num_rows
+    return begin, end
+
+
+  def num_frames(self, uid):
+    header = self.get_header(uid)
+    if header is None:
+      return len(self.decode(uid))
+    begin, end = self.get_row_range(uid, header[1])
+    return end - begin
+
+
+  def decode(self, uid):
+    ark, offset, row_range = self.locations[uid]
+    rxfilename = ark if offset is None else '%s:%d' % (ark, offset)
+    if row_range is not None:
+      rxfilename += '[%s]' % row_range
+    return kaldi_io_numpy.read_kaldi_object(rxfilename, open_files = self.open_files)
+
+
+  def __getitem__(self, uid):
+    '''
+    output:
+      feat: np matrix [num_frames, feat_dim]; a read-only view into the ark when possible
+    '''
+    header = self.get_header(uid)
+    if header is None:
+      return self.decode(uid)
+    dtype, rows, cols, data_offset = header
+    mapped = self.get_ark(self.locations[uid][0])
+    feat = mapped[data_offset:data_offset + rows * cols * dtype.itemsize]
+    feat = feat.view(dtype).reshape((rows, cols))
+    begin, end = self.get_row_range(uid, rows)
+    return feat[begin:end]
+
+
+  def get(self, uid, start = 0, num_frames = None):
+    ''' frames [start, start+num_frames) of an utterance '''
+    feat = self[uid]
+    end = len(feat) if num_frames is None else start + num_frames
+    return feat[start:end]
+
+
+  def close(self):
+    for f in self.open_files.values():
+      f.close()
+    self.open_files = {}
+    self.arks = {}
@@ -477,16 +477,21 @@ class JOINTDNN(object):
   def get_init_train_op(self):
     return self.init_train_op
 
-  def get_loss(self):
+  def get_mode_losses(self):
+    ''' the loss of each bucket that the mode trains '''
     if self.mode == 'joint':
-      return self.bucket_tr_loss[self.last_bucket_id]
+      return self.bucket_tr_loss
     elif self.mode in ['sid', 'joint-sid']:
-      return self.bucket_tr_sid_loss[self.last_bucket_id]
+      return self.bucket_tr_sid_loss
     elif self.mode in ['asr', 'joint-asr']:
-      return self.bucket_tr_asr_loss[self.last_bucket_id]
+      return self.bucket_tr_asr_loss
     else:
       raise RuntimeError('mode %s not supported' % self.mode)
 
+
+  def get_loss(self):
+    return self.get_mode_losses()[self.last_bucket_id]
+
   def get_asr_loss(self):
     return self.bucket_tr_asr_loss[self.last_bucket_id]
 
@@ -507,6 +512,20 @@ class JOINTDNN(object):
   def get_sid_eval_acc(self):
     return self.bucket_tr_sid_eval_acc[self.last_bucket_id]
 
+
+  def get_bucket_metrics(self):
+    '''
+    [loss, asr loss, sid loss, asr eval acc, sid eval acc] of each bucket, or [loss, eval acc]
+    in the modes that train a single task; the loss as get_loss returns it
+    '''
+    if self.mode == 'asr':
+      return [ list(metrics) for metrics in zip(self.bucket_tr_asr_loss, self.bucket_tr_asr_eval_acc) ]
+    elif self.mode == 'sid':
+      return [ list(metrics) for metrics in zip(self.bucket_tr_sid_loss, self.bucket_tr_sid_eval_acc) ]
+    return [ list(metrics) for metrics in zip(self.get_mode_losses(), self.bucket_tr_asr_loss,
+                                              self.bucket_tr_sid_loss, self.bucket_tr_asr_eval_acc,
+                                              self.bucket_tr_sid_eval_acc) ]
+
   def get_train_op(self):
     if self.mode == 'joint':
       return self.bucket_tr_train_op[self.last_bucket_id]
@@ -569,7 +588,7 @@ class JOINTDNN(object):
                   self.alpha_holder: train_params.get('alpha', 1.0),
                   self.beta_holder: train_params.get('beta', 0.0)})
 
-    return feed_dict, x is not None
+    return nnet.check_feed(feed_dict), x is not None
 
 
   def prep_forward_feed(self, x):
@@ -577,7 +596,7 @@ class JOINTDNN(object):
     self.last_bucket_id = 0
     feed_dict = { self.bucket_tr_feats_holders[0]: x}
 
-    return feed_dict
+    return nnet.check_feed(feed_dict)
     
   def prep_forward_sid(self, x, mask, bucket_id, embedding_index):
     bucket_feats_holder = self.bucket_feats_holders[bucket_id]
@@ -587,4 +606,4 @@ class JOINTDNN(object):
     feed_dict = { bucket_feats_holder: x,
                   bucket_mask_holder: mask}
 
-    return feed_dict, embedding
+    return nnet.check_feed(feed_dict), embedding
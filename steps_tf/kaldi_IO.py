@@ -1,5 +1,6 @@
 import numpy
 import struct
+from kaldi_io.kaldi_io_numpy import ArkInputStream
 
 def read_utterance (ark):
     ## Read utterance ID
@@ -18,6 +19,17 @@ def read_utterance (ark):
     return uid, feat.reshape((rows,cols))
 
 
+def read_ark (ark):
+    ## Iterate over (uid, feat) in an archive stream; the stream is read in
+    ## chunks, and double / compressed matrices are converted to float32
+    reader = ArkInputStream(ark)
+    while True:
+        uid = reader.read_token()
+        if not uid:
+            return
+        yield uid, reader.read_matrix(numpy.float32)
+
+
 def write_utterance (uid, feat, ark, encoding):
     feat = numpy.asarray (feat, dtype=numpy.float32)
     m,n = feat.shape
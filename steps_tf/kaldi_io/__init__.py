@@ -172,6 +172,15 @@ should be written sorted in the `C order`.
         
         Implement the `with` context protocol   
 
+Backends
+========
+
+The classes are provided by the compiled `kaldi_io_internal` extension if it is built.
+Otherwise (or if the environment variable `KALDI_IO_BACKEND` is set to `numpy`) they come
+from `kaldi_io_numpy`, a pure numpy implementation that reads binary, text and compressed
+(`CM`, `CM2`, `CM3`) archives and writes `ark` and `ark,scp` tables. It implements matrices,
+vectors and int32 vectors; the other types are only available with the compiled backend.
+
 Transformed Readers
 ===================
 
@@ -241,8 +250,18 @@ Created on Jul 31, 2014
 '''
 
 
+import os
 import numpy as np
-from kaldi_io_internal import *
+
+# The compiled boost-python wrappers are used when available. The pure numpy backend
+# (kaldi_io_numpy) is used when they are not built, or when KALDI_IO_BACKEND=numpy.
+if os.environ.get('KALDI_IO_BACKEND', '') == 'numpy':
+    from .kaldi_io_numpy import *
+else:
+    try:
+        from .kaldi_io_internal import *
+    except ImportError:
+        from .kaldi_io_numpy import *
 
 if KALDI_BASE_FLOAT()==np.float64:
     RandomAccessBaseFloatMatrixReader = RandomAccessFloat64MatrixReader
@@ -0,0 +1,768 @@
+'''Pure numpy implementation of the Kaldi table IO (:kaldi:`io.html`)
+
+This module is a drop-in replacement for the compiled `kaldi_io_internal` extension. It
+provides the same Sequential, RandomAccess and Writer classes for matrices, vectors and
+int32 vectors, so decoding and embedding hosts can run without building the C++ code.
+
+Archives are parsed by :class:`ArkInputStream`, which reads the stream in large chunks
+(`readinto` into a reusable buffer) instead of byte by byte, and reads matrix payloads
+directly into preallocated numpy arrays. Supported binary objects are:
+
+* `FM`, `DM`: float and double matrices
+* `FV`, `DV`: float and double vectors
+* `CM`, `CM2`, `CM3`: compressed matrices, decoded with vectorized lookups
+* std::vector<int32>
+
+Text archives (`ark,t:`) are supported for all of the above except compressed matrices.
+
+rspecifiers may be `ark:` or `scp:` with the usual options (`s`, `cs`, `o`, `p` are accepted
+and ignored), filenames may be `-` or pipes (`cmd |`). scp entries may carry byte offsets
+(`foo.ark:123`) and row/column ranges (`foo.ark:123[0:9]`). wspecifiers may be `ark:`,
+`ark,t:` or `ark,scp:foo.ark,foo.scp`, writing to files, `-` or pipes (`| cmd`).
+
+Created on top of the format description in Kaldi's matrix/kaldi-matrix.cc,
+matrix/compressed-matrix.cc and util/kaldi-table.h
+'''
+
+import re
+import sys
+import struct
+import subprocess
+import numpy as np
+
+__all__ = ['KALDI_BASE_FLOAT', 'ArkInputStream', 'read_kaldi_object', 'write_kaldi_object',
+           'SequentialFloat32MatrixReader', 'SequentialFloat64MatrixReader',
+           'RandomAccessFloat32MatrixReader', 'RandomAccessFloat64MatrixReader',
+           'RandomAccessFloat32MatrixMapped', 'RandomAccessFloat64MatrixMapped',
+           'Float32MatrixWriter', 'Float64MatrixWriter',
+           'SequentialFloat32VectorReader', 'SequentialFloat64VectorReader',
+           'RandomAccessFloat32VectorReader', 'RandomAccessFloat64VectorReader',
+           'RandomAccessFloat32VectorReaderMapped', 'RandomAccessFloat64VectorReaderMapped',
+           'Float32VectorWriter', 'Float64VectorWriter',
+           'SequentialInt32VectorReader', 'RandomAccessInt32VectorReader', 'Int32VectorWriter']
+
+_BUFFER_SIZE = 1 << 20
+
+# binary std::vector<int32>: every element is prefixed by its size in bytes
+_INT32_ELEMENT = np.dtype([('size', 'i1'), ('value', '<i4')])
+
+_SCP_OFFSET = re.compile(r'^(.*):(\d+)$')
+_SCP_RANGE = re.compile(r'^(.*)\[([^\[\]]*)\]$')
+
+
+def KALDI_BASE_FLOAT():
+    return np.float32
+
+
+def _to_str(key):
+    if isinstance(key, str):
+        return key
+    return key.decode('utf-8')
+
+
+def _to_bytes(key):
+    if isinstance(key, bytes):
+        return key
+    return key.encode('utf-8')
+
+
+class ArkInputStream(object):
+    '''
+    Chunked parser over a Kaldi archive (or a single Kaldi object) stream.
+
+    All reads go through one reusable buffer that is refilled with `readinto`,
+    so tokens are found with `bytearray.find` and large payloads are read straight
+    into the numpy arrays returned to the caller.
+    '''
+
+    def __init__(self, stream, buffer_size=_BUFFER_SIZE):
+        self.stream = stream
+        self.buf = bytearray(buffer_size)
+        self.start = 0
+        self.end = 0
+        self.eof = False
+        self._readinto = getattr(stream, 'readinto', None)
+
+    def _raw_readinto(self, view):
+        if self._readinto is not None:
+            n = self._readinto(view)
+            return 0 if n is None else n
+        data = self.stream.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def _fill(self, size):
+        '''make sure at least size bytes are buffered, unless the stream ends'''
+        while self.end - self.start < size and not self.eof:
+            if self.start > 0:
+                remain = self.end - self.start
+                self.buf[:remain] = self.buf[self.start:self.end]
+                self.start, self.end = 0, remain
+            if size > len(self.buf):
+                self.buf.extend(bytearray(size - len(self.buf)))
+            n = self._raw_readinto(memoryview(self.buf)[self.end:])
+            if n == 0:
+                self.eof = True
+            self.end += n
+        return self.end - self.start >= size
+
+    def peek(self, size):
+        self._fill(size)
+        return bytes(self.buf[self.start:min(self.start+size, self.end)])
+
+    def read(self, size):
+        if not self._fill(size):
+            raise IOError('unexpected end of Kaldi stream')
+        data = bytes(self.buf[self.start:self.start+size])
+        self.start += size
+        return data
+
+    def read_into(self, array):
+        '''fill a (contiguous) numpy array with the next array.nbytes bytes'''
+        view = memoryview(array.reshape(-1).view(np.uint8))
+        size = len(view)
+        buffered = min(size, self.end - self.start)
+        view[:buffered] = self.buf[self.start:self.start+buffered]
+        self.start += buffered
+        while buffered < size:
+            n = self._raw_readinto(view[buffered:])
+            if n == 0:
+                raise IOError('unexpected end of Kaldi stream')
+            buffered += n
+        return array
+
+    def skip_space(self):
+        while True:
+            if not self._fill(1):
+                return False
+            while self.start < self.end and self.buf[self.start:self.start+1].isspace():
+                self.start += 1
+            if self.start < self.end:
+                return True
+
+    def _find_space(self, scan):
+        pos = -1
+        for sep in (b' ', b'\n', b'\t'):
+            found = self.buf.find(sep, scan, self.end)
+            if found != -1 and (pos == -1 or found < pos):
+                pos = found
+        return pos
+
+    def read_token(self):
+        '''read a whitespace delimited token and the single space after it; None at eof'''
+        if not self.skip_space():
+            return None
+        scan = self.start
+        while True:
+            pos = self._find_space(scan)
+            if pos != -1:
+                token = bytes(self.buf[self.start:pos])
+                self.start = pos + 1
+                return token
+            if self.eof:
+                token = bytes(self.buf[self.start:self.end])
+                self.start = self.end
+                return token
+            scanned = self.end - self.start
+            self._fill(scanned + 1)
+            scan = self.start + scanned
+
+    def read_until(self, delimiter):
+        '''read everything up to and including delimiter'''
+        scan = self.start
+        while True:
+            pos = self.buf.find(delimiter, scan, self.end)
+            if pos != -1:
+                data = bytes(self.buf[self.start:pos+len(delimiter)])
+                self.start = pos + len(delimiter)
+                return data
+            if self.eof:
+                raise IOError('unexpected end of Kaldi stream, expecting %r' % delimiter)
+            scanned = self.end - self.start
+            self._fill(scanned + 1)
+            scan = self.start + scanned
+
+    def read_binary_header(self):
+        '''consume the "\\0B" binary marker if present; return True for binary objects'''
+        if self.peek(2) == b'\0B':
+            self.start += 2
+            return True
+        return False
+
+    def read_int32(self):
+        size, value = struct.unpack('<bi', self.read(5))
+        if size != 4:
+            raise IOError('expected int32 in Kaldi stream, got size %d' % size)
+        return value
+
+    def read_matrix(self, dtype):
+        if not self.read_binary_header():
+            return self._read_text_matrix(dtype)
+        token = self.read_token()
+        if token in (b'FM', b'DM'):
+            rows = self.read_int32()
+            cols = self.read_int32()
+            mat = np.empty((rows, cols), dtype='<f4' if token == b'FM' else '<f8')
+            self.read_into(mat)
+        elif token in (b'CM', b'CM2', b'CM3'):
+            mat = self._read_compressed_matrix(token)
+        else:
+            raise IOError('unsupported matrix token %r in Kaldi stream' % token)
+        return mat.astype(dtype, copy=False)
+
+    def read_vector(self, dtype):
+        if not self.read_binary_header():
+            return self._read_text_vector(dtype)
+        token = self.read_token()
+        if token not in (b'FV', b'DV'):
+            raise IOError('unsupported vector token %r in Kaldi stream' % token)
+        size = self.read_int32()
+        vec = np.empty(size, dtype='<f4' if token == b'FV' else '<f8')
+        self.read_into(vec)
+        return vec.astype(dtype, copy=False)
+
+    def read_int32_vector(self, dtype=np.int32):
+        if not self.read_binary_header():
+            line = self.read_until(b'\n')
+            return np.array(line.split(), dtype=dtype)
+        size = self.read_int32()
+        elements = np.empty(size, dtype=_INT32_ELEMENT)
+        self.read_into(elements)
+        return elements['value'].astype(dtype)
+
+    def read_object(self, kind, dtype):
+        if kind == 'matrix':
+            return self.read_matrix(dtype)
+        elif kind == 'vector':
+            return self.read_vector(dtype)
+        elif kind == 'int32_vector':
+            return self.read_int32_vector(dtype)
+        raise ValueError('unsupported Kaldi object kind %s' % kind)
+
+    def _read_compressed_matrix(self, token):
+        min_value, value_range, rows, cols = struct.unpack('<ffii', self.read(16))
+        if token == b'CM':
+            # kOneByteWithColHeaders: per column 4 uint16 percentiles, then column-major bytes
+            headers = np.empty((cols, 4), dtype='<u2')
+            self.read_into(headers)
+            data = np.empty((cols, rows), dtype=np.uint8)
+            self.read_into(data)
+            return _uncompress_col_headers(min_value, value_range, headers, data)
+        elif token == b'CM2':
+            data = np.empty((rows, cols), dtype='<u2')
+            self.read_into(data)
+            increment = np.float32(value_range * (1.0 / 65535.0))
+        else:
+            data = np.empty((rows, cols), dtype=np.uint8)
+            self.read_into(data)
+            increment = np.float32(value_range * (1.0 / 255.0))
+        mat = data.astype(np.float32)
+        mat *= increment
+        mat += np.float32(min_value)
+        return mat
+
+    def _read_text_matrix(self, dtype):
+        text = self.read_until(b']')
+        text = text[text.index(b'[')+1:-1]
+        rows = [line.split() for line in text.splitlines()]
+        rows = [row for row in rows if row]
+        if len(rows) == 0:
+            return np.empty((0, 0), dtype=dtype)
+        return np.array(rows, dtype=dtype)
+
+    def _read_text_vector(self, dtype):
+        text = self.read_until(b']')
+        return np.array(text[text.index(b'[')+1:-1].split(), dtype=dtype)
+
+
+def _uncompress_col_headers(min_value, value_range, headers, data):
+    '''
+    vectorized CompressedMatrix::CopyToMat for kOneByteWithColHeaders
+    input:
+      headers: uint16 [num_cols, 4] (percentile 0, 25, 75, 100)
+      data: uint8 [num_cols, num_rows]
+    output:
+      float32 [num_rows, num_cols]
+    '''
+    p = np.float32(min_value) + np.float32(value_range * 1.52590218966964e-05) * \
+        headers.astype(np.float32)
+    p0, p25, p75, p100 = p[:, 0:1], p[:, 1:2], p[:, 2:3], p[:, 3:4]
+    # one 256-entry lookup table per column, then a single gather
+    code = np.arange(256, dtype=np.float32)[None, :]
+    table = np.where(code <= 64, p0 + (p25 - p0) * code * np.float32(1/64.0),
+                     np.where(code <= 192, p25 + (p75 - p25) * (code - 64) * np.float32(1/128.0),
+                              p75 + (p100 - p75) * (code - 192) * np.float32(1/63.0)))
+    cols = data.shape[0]
+    table = table.astype(np.float32).reshape(-1)
+    index = data.astype(np.intp)
+    index += (np.arange(cols, dtype=np.intp) * 256)[:, None]
+    return np.ascontiguousarray(table[index].T)
+
+
+def _stdin():
+    return getattr(sys.stdin, 'buffer', sys.stdin)
+
+
+def _stdout():
+    return getattr(sys.stdout, 'buffer', sys.stdout)
+
+
+class _Input(object):
+    ''' an opened rxfilename: a file, stdin or the output of a pipe '''
+
+    def __init__(self, rxfilename):
+        rxfilename = rxfilename.strip()
+        self.process = None
+        if rxfilename in ['', '-']:
+            self.stream = _stdin()
+        elif rxfilename.endswith('|'):
+            self.process = subprocess.Popen(rxfilename[:-1], shell=True,
+                                            stdout=subprocess.PIPE)
+            self.stream = self.process.stdout
+        else:
+            self.stream = open(rxfilename, 'rb')
+
+    def close(self):
+        if self.stream is not _stdin():
+            self.stream.close()
+        if self.process is not None:
+            self.process.wait()
+
+
+class _Output(object):
+    ''' an opened wxfilename: a file, stdout or the input of a pipe '''
+
+    def __init__(self, wxfilename):
+        wxfilename = wxfilename.strip()
+        self.process = None
+        if wxfilename in ['', '-']:
+            self.stream = _stdout()
+        elif wxfilename.startswith('|'):
+            self.process = subprocess.Popen(wxfilename[1:], shell=True,
+                                            stdin=subprocess.PIPE)
+            self.stream = self.process.stdin
+        else:
+            self.stream = open(wxfilename, 'wb')
+
+    def close(self):
+        if self.stream is _stdout():
+            self.stream.flush()
+        else:
+            self.stream.close()
+        if self.process is not None:
+            self.process.wait()
+
+
+def _parse_specifier(specifier):
+    '''
+    split 'ark,t,scp:foo' into ('ark', set(['t', 'scp']), 'foo')
+    '''
+    if ':' not in specifier:
+        raise ValueError('invalid Kaldi specifier %s' % specifier)
+    prefix, name = specifier.split(':', 1)
+    fields = [x.strip() for x in prefix.split(',')]
+    if 'ark' in fields:
+        table_type = 'ark'
+    elif 'scp' in fields:
+        table_type = 'scp'
+    else:
+        raise ValueError('invalid Kaldi specifier %s' % specifier)
+    options = set(fields)
+    options.discard(table_type)
+    return table_type, options, name
+
+
+def _parse_range(range_spec, shape):
+    ''' '0:9' or '0:9,3:5' (inclusive, Kaldi style) into slices '''
+    slices = []
+    for dim, part in zip(shape, range_spec.split(',')):
+        part = part.strip()
+        if part in ['', ':']:
+            slices.append(slice(None))
+            continue
+        begin, end = part.split(':')
+        begin = int(begin) if begin != '' else 0
+        end = int(end) + 1 if end != '' else dim
+        slices.append(slice(begin, end))
+    return tuple(slices)
+
+
+def read_kaldi_object(rxfilename, kind='matrix', dtype=np.float32, open_files=None):
+    '''
+    Read a single object, like Kaldi's ReadKaldiObject.
+    rxfilename can be a plain file, a pipe, or an scp-style location 'foo.ark:123[0:9]'.
+    open_files is an optional dict used to cache file handles between calls.
+    '''
+    rxfilename = rxfilename.strip()
+    range_spec = None
+    match = _SCP_RANGE.match(rxfilename)
+    if match and not rxfilename.endswith('|'):
+        rxfilename, range_spec = match.group(1), match.group(2)
+
+    offset = None
+    match = _SCP_OFFSET.match(rxfilename)
+    if match and not rxfilename.endswith('|'):
+        rxfilename, offset = match.group(1), int(match.group(2))
+
+    if offset is not None and open_files is not None:
+        if rxfilename not in open_files:
+            open_files[rxfilename] = open(rxfilename, 'rb')
+        stream = open_files[rxfilename]
+        stream.seek(offset)
+        obj = ArkInputStream(stream, buffer_size=1 << 16).read_object(kind, dtype)
+    else:
+        source = _Input(rxfilename)
+        try:
+            if offset is not None:
+                source.stream.seek(offset)
+            obj = ArkInputStream(source.stream).read_object(kind, dtype)
+        finally:
+            source.close()
+
+    if range_spec is not None:
+        obj = np.ascontiguousarray(obj[_parse_range(range_spec, obj.shape)])
+    return obj
+
+
+def _serialize(kind, value, dtype, binary):
+    '''serialize a Kaldi object (without key) into bytes'''
+    if kind == 'int32_vector':
+        value = np.asarray(value, dtype=np.int32).reshape(-1)
+        if not binary:
+            return b''.join([_to_bytes('%d ' % x) for x in value]) + b'\n'
+        elements = np.empty(len(value), dtype=_INT32_ELEMENT)
+        elements['size'] = 4
+        elements['value'] = value
+        return b'\0B' + struct.pack('<bi', 4, len(value)) + elements.tobytes()
+
+    value = np.asarray(value, dtype=dtype)
+    if kind == 'matrix':
+        if value.ndim != 2:
+            raise ValueError('expected a matrix, got array of shape %s' % str(value.shape))
+        if not binary:
+            lines = [' '.join(['%.7g' % x for x in row]) for row in value]
+            return _to_bytes(' [\n  ' + '\n  '.join(lines) + ' ]\n')
+        token = b'FM ' if value.dtype == np.float32 else b'DM '
+        header = struct.pack('<bibi', 4, value.shape[0], 4, value.shape[1])
+    else:
+        value = value.reshape(-1)
+        if not binary:
+            return _to_bytes('[ ' + ' '.join(['%.7g' % x for x in value]) + ' ]\n')
+        token = b'FV ' if value.dtype == np.float32 else b'DV '
+        header = struct.pack('<bi', 4, value.shape[0])
+    data = value.astype(value.dtype.newbyteorder('<'), copy=False).tobytes()
+    return b'\0B' + token + header + data
+
+
+def write_kaldi_object(wxfilename, value, kind='matrix', dtype=np.float32, binary=True):
+    '''Write a single object, like Kaldi's WriteKaldiObject'''
+    output = _Output(wxfilename)
+    try:
+        output.stream.write(_serialize(kind, value, dtype, binary))
+    finally:
+        output.close()
+
+
+class _SequentialReader(object):
+    _kind = 'matrix'
+    _dtype = np.float32
+
+    def __init__(self, rx_specifier):
+        self._table_type, self._options, name = _parse_specifier(rx_specifier)
+        self._open_files = {}
+        self._input = None
+        if self._table_type == 'ark':
+            self._input = _Input(name)
+            self._items = self._iter_ark(ArkInputStream(self._input.stream))
+        else:
+            self._scp = open(name) if name not in ['', '-'] else sys.stdin
+            self._items = self._iter_scp(self._scp)
+        self._is_open = True
+        self._kaldi_next()
+
+    def _iter_ark(self, ark):
+        while True:
+            key = ark.read_token()
+            if key is None or key == b'':
+                return
+            yield _to_str(key), ark.read_object(self._kind, self._dtype)
+
+    def _iter_scp(self, scp):
+        for line in scp:
+            fields = line.strip().split(None, 1)
+            if len(fields) == 0:
+                continue
+            yield fields[0], read_kaldi_object(fields[1], self._kind, self._dtype,
+                                               self._open_files)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.done():
+            raise StopIteration
+        item = (self._key, self._value)
+        self._kaldi_next()
+        return item
+
+    __next__ = next
+
+    def done(self):
+        return self._key is None
+
+    def _kaldi_next(self):
+        try:
+            self._key, self._value = next(self._items)
+        except StopIteration:
+            self._key, self._value = None, None
+
+    def _kaldi_key(self):
+        return self._key
+
+    def _kaldi_value(self):
+        return self._value
+
+    def close(self):
+        if not self._is_open:
+            return
+        if self._input is not None:
+            self._input.close()
+        for f in self._open_files.values():
+            f.close()
+        self._is_open = False
+
+    def is_open(self):
+        return self._is_open
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _RandomAccessReader(object):
+    '''
+    scp tables are indexed up front and objects are read on demand;
+    archives are read sequentially until the requested key is found.
+    '''
+    _kind = 'matrix'
+    _dtype = np.float32
+
+    def __init__(self, rx_specifier):
+        self._table_type, self._options, name = _parse_specifier(rx_specifier)
+        self._open_files = {}
+        self._values = {}
+        self._input = None
+        if self._table_type == 'ark':
+            self._input = _Input(name)
+            self._ark = ArkInputStream(self._input.stream)
+            self._ark_done = False
+        else:
+            self._index = {}
+            with open(name) as scp:
+                for line in scp:
+                    fields = line.strip().split(None, 1)
+                    if len(fields) == 2:
+                        self._index[fields[0]] = fields[1]
+        self._is_open = True
+
+    def _find(self, key):
+        if key in self._values:
+            return True
+        if self._table_type == 'scp':
+            if key not in self._index:
+                return False
+            self._values[key] = read_kaldi_object(self._index[key], self._kind,
+                                                  self._dtype, self._open_files)
+            return True
+        while not self._ark_done:
+            next_key = self._ark.read_token()
+            if next_key is None or next_key == b'':
+                self._ark_done = True
+                break
+            next_key = _to_str(next_key)
+            self._values[next_key] = self._ark.read_object(self._kind, self._dtype)
+            if next_key == key:
+                return True
+        return False
+
+    def __contains__(self, key):
+        return self._find(key)
+
+    def has_key(self, key):
+        return self._find(key)
+
+    def value(self, key):
+        if not self._find(key):
+            raise KeyError(key)
+        return self._values[key]
+
+    def __getitem__(self, key):
+        return self.value(key)
+
+    def close(self):
+        if not self._is_open:
+            return
+        if self._input is not None:
+            self._input.close()
+        for f in self._open_files.values():
+            f.close()
+        self._values = {}
+        self._is_open = False
+
+    def is_open(self):
+        return self._is_open
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _RandomAccessReaderMapped(object):
+    ''' random access reader whose keys are first mapped, e.g. through utt2spk '''
+    _reader_class = None
+
+    def __init__(self, data_rx_specifier, mapping_rx_specifier):
+        self._reader = self._reader_class(data_rx_specifier)
+        table_type, options, name = _parse_specifier(mapping_rx_specifier)
+        self._mapping = {}
+        source = _Input(name)
+        try:
+            for line in source.stream:
+                fields = _to_str(line).split()
+                if len(fields) == 2:
+                    self._mapping[fields[0]] = fields[1]
+        finally:
+            source.close()
+
+    def __contains__(self, key):
+        return key in self._mapping and self._mapping[key] in self._reader
+
+    def has_key(self, key):
+        return key in self
+
+    def value(self, key):
+        return self._reader.value(self._mapping[key])
+
+    def __getitem__(self, key):
+        return self.value(key)
+
+    def close(self):
+        self._reader.close()
+
+    def is_open(self):
+        return self._reader.is_open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _Writer(object):
+    _kind = 'matrix'
+    _dtype = np.float32
+
+    def __init__(self, wx_specifier):
+        table_type, options, name = _parse_specifier(wx_specifier)
+        self._binary = 't' not in options
+        self._flush = 'f' in options
+        self._scp = None
+        if table_type == 'ark' and 'scp' in options:
+            ark_name, scp_name = name.split(',', 1)
+            self._output = _Output(ark_name)
+            self._ark_name = ark_name.strip()
+            self._scp = open(scp_name.strip(), 'w')
+        elif table_type == 'ark':
+            self._output = _Output(name)
+        else:
+            raise ValueError('writing to scp-only specifier %s is not supported' % wx_specifier)
+        self._position = 0
+        self._is_open = True
+
+    def write(self, key, value):
+        data = _to_bytes(key) + b' '
+        self._output.stream.write(data)
+        self._position += len(data)
+        if self._scp is not None:
+            self._scp.write('%s %s:%d\n' % (_to_str(key), self._ark_name, self._position))
+        data = _serialize(self._kind, value, self._dtype, self._binary)
+        self._output.stream.write(data)
+        self._position += len(data)
+        if self._flush:
+            self.flush()
+
+    def __setitem__(self, key, value):
+        self.write(key, value)
+
+    def flush(self):
+        self._output.stream.flush()
+        if self._scp is not None:
+            self._scp.flush()
+
+    def close(self):
+        if not self._is_open:
+            return
+        self._output.close()
+        if self._scp is not None:
+            self._scp.close()
+        self._is_open = False
+
+    def is_open(self):
+        return self._is_open
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _table_class(base, kind, dtype, name):
+    return type(name, (base,), {'_kind': kind, '_dtype': dtype})
+
+
+SequentialFloat32MatrixReader = _table_class(_SequentialReader, 'matrix', np.float32,
+                                             'SequentialFloat32MatrixReader')
+SequentialFloat64MatrixReader = _table_class(_SequentialReader, 'matrix', np.float64,
+                                             'SequentialFloat64MatrixReader')
+RandomAccessFloat32MatrixReader = _table_class(_RandomAccessReader, 'matrix', np.float32,
+                                               'RandomAccessFloat32MatrixReader')
+RandomAccessFloat64MatrixReader = _table_class(_RandomAccessReader, 'matrix', np.float64,
+                                               'RandomAccessFloat64MatrixReader')
+Float32MatrixWriter = _table_class(_Writer, 'matrix', np.float32, 'Float32MatrixWriter')
+Float64MatrixWriter = _table_class(_Writer, 'matrix', np.float64, 'Float64MatrixWriter')
+
+SequentialFloat32VectorReader = _table_class(_SequentialReader, 'vector', np.float32,
+                                             'SequentialFloat32VectorReader')
+SequentialFloat64VectorReader = _table_class(_SequentialReader, 'vector', np.float64,
+                                             'SequentialFloat64VectorReader')
+RandomAccessFloat32VectorReader = _table_class(_RandomAccessReader, 'vector', np.float32,
+                                               'RandomAccessFloat32VectorReader')
+RandomAccessFloat64VectorReader = _table_class(_RandomAccessReader, 'vector', np.float64,
+                                               'RandomAccessFloat64VectorReader')
+Float32VectorWriter = _table_class(_Writer, 'vector', np.float32, 'Float32VectorWriter')
+Float64VectorWriter = _table_class(_Writer, 'vector', np.float64, 'Float64VectorWriter')
+
+SequentialInt32VectorReader = _table_class(_SequentialReader, 'int32_vector', np.int32,
+                                           'SequentialInt32VectorReader')
+RandomAccessInt32VectorReader = _table_class(_RandomAccessReader, 'int32_vector', np.int32,
+                                             'RandomAccessInt32VectorReader')
+Int32VectorWriter = _table_class(_Writer, 'int32_vector', np.int32, 'Int32VectorWriter')
+
+RandomAccessFloat32MatrixMapped = type('RandomAccessFloat32MatrixMapped',
+                                       (_RandomAccessReaderMapped,),
+                                       {'_reader_class': RandomAccessFloat32MatrixReader})
+RandomAccessFloat64MatrixMapped = type('RandomAccessFloat64MatrixMapped',
+                                       (_RandomAccessReaderMapped,),
+                                       {'_reader_class': RandomAccessFloat64MatrixReader})
+RandomAccessFloat32VectorReaderMapped = type('RandomAccessFloat32VectorReaderMapped',
+                                             (_RandomAccessReaderMapped,),
+                                             {'_reader_class': RandomAccessFloat32VectorReader})
+RandomAccessFloat64VectorReaderMapped = type('RandomAccessFloat64VectorReaderMapped',
+                                             (_RandomAccessReaderMapped,),
+                                             {'_reader_class': RandomAccessFloat64VectorReader})
@@ -0,0 +1,181 @@
+import multiprocessing
+import glob
+import os
+import numpy
+from kaldi_io import kaldi_io_numpy
+
+
+def read_alignments(model, ali_file):
+  '''
+  input:
+    model: transition model, e.g. exp/final.mdl
+    ali_file: one ali.*.gz
+  output:
+    utt_ids: list of uid
+    lengths: np array [num_utts]
+    labels: int32 np array, the pdf ids of all utterances one after another
+  '''
+  reader = kaldi_io_numpy.SequentialInt32VectorReader(
+             'ark:ali-to-pdf --print-args=false %s "ark:gunzip -c %s |" ark:- |' % (model, ali_file))
+  utt_ids = []
+  alignments = []
+  for uid, ali in reader:
+    utt_ids.append(uid)
+    alignments.append(ali)
+  reader.close()
+  lengths = numpy.array([ len(ali) for ali in alignments ], dtype = 'int64')
+  if len(alignments) == 0:
+    return utt_ids, lengths, numpy.empty(0, dtype = 'int32')
+  return utt_ids, lengths, numpy.concatenate(alignments)
+
+
+def gather_ranges(data, starts, lengths):
+  '''
+  output:
+    offsets: np array [num_ranges + 1]
+    np array, data[starts[i]:starts[i]+lengths[i]] for all i, one after another, in one gather
+  '''
+  offsets = numpy.append(0, numpy.cumsum(lengths)).astype('int64')
+  index = numpy.repeat(starts - offsets[:-1], lengths) + numpy.arange(offsets[-1])
+  return offsets, numpy.array(data[index])
+
+
+def read_scp_keys(scp_file):
+  with open(scp_file) as f:
+    return [ line.split(None, 1)[0] for line in f if line.strip() ]
+
+
+def read_alignments_job(args):
+  # Pool.map passes one argument
+  return read_alignments(*args)
+
+
+class LabelStore(object):
+  '''
+  frame labels of all utterances in one flat int16/int32 array, with the utterances sorted
+  by uid and an offset index into the array. It replaces the dict of label lists:
+  "uid in store" and store[uid] work the same, store[uid] being a zero-copy slice.
+  Saved in the exp dir as <path>.npy (the labels, memory-mapped when loaded),
+  <path>.offsets.npy and <path>.keys, so a restart loads it instead of running ali-to-pdf again.
+
+  usage:
+    labels = load_labels(exp + '/ali_labels', exp + '/final.mdl', ali_dir)
+    ali = labels[uid]                     # np array [num_frames]
+    counts = labels.target_counts(num_targets)
+  '''
+  def __init__ (self, utt_ids, offsets, data):
+    '''
+    input:
+      utt_ids: sorted np array of uid
+      offsets: np array [num_utts + 1], labels of utt_ids[i] are data[offsets[i]:offsets[i+1]]
+      data: np array [total_frames]
+    '''
+    self.utt_ids = utt_ids
+    self.offsets = offsets
+    self.data = data
+
+
+  def save(self, path):
+    numpy.save(path + '.npy', self.data)
+    numpy.save(path + '.offsets.npy', self.offsets)
+    # the keys go last, load_labels takes them as the sign of a complete store
+    with open(path + '.keys.tmp', 'w') as f:
+      for uid in self.utt_ids:
+        f.write(uid + '\n')
+    os.rename(path + '.keys.tmp', path + '.keys')
+
+
+  def find(self, uid):
+    # position of uid in utt_ids, -1 if it is not there
+    i = numpy.searchsorted(self.utt_ids, uid)
+    if i < len(self.utt_ids) and self.utt_ids[i] == uid:
+      return i
+    return -1
+
+
+  def __len__(self):
+    return len(self.utt_ids)
+
+
+  def __contains__(self, uid):
+    return self.find(uid) >= 0
+
+
+  def __getitem__(self, uid):
+    i = self.find(uid)
+    if i < 0:
+      raise KeyError(uid)
+    return self.data[self.offsets[i]:self.offsets[i+1]]
+
+
+  def keys(self):
+    return list(self.utt_ids)
+
+
+  def join(self, utt_ids):
+    '''
+    sorted merge-join of utt_ids with the utterances of the store, e.g. the keys of a split scp
+    output:
+      LabelStore of the utterances in utt_ids that have labels, the labels copied out of
+      the (memory-mapped) store into one array
+    '''
+    if len(utt_ids) == 0:
+      return LabelStore(self.utt_ids[:0], numpy.zeros(1, dtype = 'int64'), self.data[:0])
+    utt_ids = numpy.unique(numpy.array(utt_ids))
+    positions = numpy.searchsorted(self.utt_ids, utt_ids)
+    found = positions < len(self.utt_ids)
+    found[found] = self.utt_ids[positions[found]] == utt_ids[found]
+    positions = positions[found]
+    starts = self.offsets[positions]
+    offsets, data = gather_ranges(self.data, starts, self.offsets[positions + 1] - starts)
+    return LabelStore(utt_ids[found], offsets, data)
+
+
+  def target_counts(self, num_targets):
+    ''' number of frames of each target, int64 np array [num_targets] '''
+    return numpy.bincount(self.data, minlength = num_targets)
+
+
+def build_label_store(model, ali_dir, num_jobs = None):
+  ''' convert ali_dir/ali.*.gz to pdf ids, one process per file '''
+  ali_files = sorted(glob.glob(ali_dir + '/ali.*.gz'))
+  if len(ali_files) == 0:
+    raise RuntimeError('no alignments found in %s' % ali_dir)
+  if num_jobs is None:
+    num_jobs = multiprocessing.cpu_count()
+  pool = multiprocessing.Pool(max(1, min(num_jobs, len(ali_files))))
+  try:
+    results = pool.map(read_alignments_job, [ (model, ali_file) for ali_file in ali_files ])
+  finally:
+    pool.close()
+    pool.join()
+
+  utt_ids = []
+  for result in results:
+    utt_ids.extend(result[0])
+  utt_ids = numpy.array(utt_ids)
+  lengths = numpy.concatenate([ result[1] for result in results ])
+  data = numpy.concatenate([ result[2] for result in results ])
+  starts = numpy.cumsum(lengths) - lengths
+
+  # sort by uid, and move the labels along
+  order = numpy.argsort(utt_ids, kind = 'mergesort')
+  offsets, data = gather_ranges(data, starts[order], lengths[order])
+  dtype = 'int16' if len(data) == 0 or data.max() < 2**15 else 'int32'
+  return LabelStore(utt_ids[order], offsets, data.astype(dtype))
+
+
+def load_label_store(path):
+  ''' a LabelStore saved with LabelStore.save '''
+  with open(path + '.keys') as f:
+    utt_ids = numpy.array(f.read().split())
+  offsets = numpy.load(path + '.offsets.npy')
+  data = numpy.load(path + '.npy', mmap_mode = 'r')
+  return LabelStore(utt_ids, offsets, data)
+
+
+def load_labels(path, model, ali_dir, num_jobs = None):
+  ''' the LabelStore saved at path, built from ali_dir first if it is not there yet '''
+  if not os.path.exists(path + '.keys'):
+    build_label_store(model, ali_dir, num_jobs).save(path)
+  return load_label_store(path)
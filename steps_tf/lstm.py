@@ -4,13 +4,18 @@ import make_nnet_proto
 
 class LSTM(object):
 
-  def __init__(self, input_dim, output_dim, batch_size, max_length, num_towers = 1):
+  def __init__(self, input_dim, output_dim, batch_size, max_length, num_towers = 1,
+               input_queue = 0):
     self.type = 'lstm'
     self.input_dim = input_dim
     self.output_dim = output_dim
     self.batch_size = batch_size
     self.max_length = max_length
     self.num_towers = num_towers
+    # capacity of the input queue in front of the placeholders, 0 to feed them
+    self.input_queue = input_queue
+    self.enqueue_op = None
+    self.enqueue_holders = []
 
   
   def get_input_dim(self):
@@ -30,14 +35,19 @@ class LSTM(object):
       self.init_lstm_single(graph, nnet_proto_file, seed)
     else:
       self.init_lstm_multi(graph, nnet_proto_file, seed)
+    self.enqueue_op, self.enqueue_holders = nnet.read_input_queue(graph)
 
 
   def init_lstm_single(self, graph, nnet_proto_file, seed):
+    # the time dimension is left open, a batch only runs as many steps as it has frames
     with graph.as_default():
       feats_holder, seq_length_holder, \
         mask_holder, labels_holder = nnet.placeholder_lstm(self.input_dim, 
-                                                           self.max_length,
+                                                           None,
                                                            self.batch_size)
+      if self.input_queue > 0:
+        feats_holder, seq_length_holder, mask_holder, labels_holder = nnet.input_queue(
+          [feats_holder, seq_length_holder, mask_holder, labels_holder], self.input_queue)
       
       keep_in_prob_holder = tf.placeholder(tf.float32, shape=[], name = 'keep_in_prob')
       keep_out_prob_holder = tf.placeholder(tf.float32, shape=[], name = 'keep_out_prob')
@@ -74,8 +84,11 @@ class LSTM(object):
       feats_holder, seq_length_holder, \
         mask_holder, labels_holder = nnet.placeholder_lstm(
                                          self.input_dim,
-                                         self.max_length,
+                                         None,
                                          self.batch_size*self.num_towers)
+      if self.input_queue > 0:
+        feats_holder, seq_length_holder, mask_holder, labels_holder = nnet.input_queue(
+          [feats_holder, seq_length_holder, mask_holder, labels_holder], self.input_queue)
       
       keep_in_prob_holder = tf.placeholder(tf.float32, shape=[], name = 'keep_in_prob')
       keep_out_prob_holder = tf.placeholder(tf.float32, shape=[], name = 'keep_out_prob')
@@ -139,6 +152,7 @@ class LSTM(object):
       self.read_lstm_single(graph)
     else:
       self.read_lstm_multi(graph, load_towers)
+    self.enqueue_op, self.enqueue_holders = nnet.read_input_queue(graph)
 
 
   def read_lstm_single(self, graph):
@@ -274,6 +288,11 @@ class LSTM(object):
     return self.train_op
 
 
+  def get_bucket_metrics(self):
+    ''' [loss, eval acc] of each bucket, the loss as get_loss returns it; one bucket here '''
+    return [ [self.loss, self.eval_acc] ]
+
+
   def get_logits(self):
     return self.logits
 
@@ -298,7 +317,35 @@ class LSTM(object):
                   self.keep_in_prob_holder: params.get('keep_in_prob', 1.0),
                   self.keep_out_prob_holder: params.get('keep_out_prob', 1.0)})
 
-    return feed_dict, x is not None
+    return nnet.check_feed(feed_dict), x is not None
+
+
+  def has_input_queue(self):
+    return self.enqueue_op is not None
+
+
+  def get_enqueue_op(self):
+    return self.enqueue_op
+
+
+  def prep_enqueue_feed(self, data_gen):
+    x, y, seq_length, mask = data_gen.get_batch_utterances()
+    feed_dict = dict(zip(self.enqueue_holders, [x, seq_length, mask, y]))
+    return nnet.check_feed(feed_dict), x is not None
+
+
+  def prep_params_feed(self, params = None):
+    ''' feed_dict for a step on a queued batch, i.e. everything prep_feed feeds but the batch '''
+    feed_dict = { self.keep_in_prob_holder: 1.0,
+                  self.keep_out_prob_holder: 1.0}
+
+    if params is not None:
+      feed_dict.update({
+                  self.learning_rate_holder: params.get('learning_rate', 0.0),
+                  self.keep_in_prob_holder: params.get('keep_in_prob', 1.0),
+                  self.keep_out_prob_holder: params.get('keep_out_prob', 1.0)})
+
+    return feed_dict
 
 
   def prep_forward_feed(self, x, seq_length, keep_in_prob, keep_out_prob):
@@ -308,4 +355,4 @@ class LSTM(object):
                   self.keep_in_prob_holder: keep_in_prob,
                   self.keep_out_prob_holder: keep_out_prob }
 
-    return feed_dict
+    return nnet.check_feed(feed_dict)
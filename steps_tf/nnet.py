@@ -1,4 +1,5 @@
 import tensorflow as tf
+import numpy as np
 import math
 import layer
 
@@ -17,6 +18,7 @@ def placeholder_dnn(input_dim, batch_size, multi_subnnet = 0):
 
 def placeholder_lstm(input_dim, max_length, batch_size):
   '''
+  max_length may be None, then every batch can have its own number of time steps
   outputs:
     feats_holder, labels_holder, seq_length_holder, mask_holder
   '''
@@ -74,6 +76,112 @@ def placeholder_jointdnn(input_dim, max_length, batch_size, name_ext = ''):
   return feats_holder, mask_holder, asr_labels_holder, sid_labels_holder
 
 
+def check_feed(feed_dict):
+  '''
+  every array of feed_dict must have the dtype of its placeholder already, e.g. float32
+  features and masks, int32 labels; anything else would be converted on each run
+  '''
+  for holder, value in feed_dict.items():
+    if isinstance(value, np.ndarray):
+      assert value.dtype == holder.dtype.as_numpy_dtype, \
+             '%s fed with %s instead of %s' % (holder.name, value.dtype, holder.dtype.name)
+  return feed_dict
+
+
+def add_noise(feats, noise_std):
+  '''
+  gaussian noise added to the features in the graph, so it is drawn on the device
+  instead of in the data generator; nothing is drawn when noise_std is 0
+  inputs:
+    noise_std: scalar tensor
+  '''
+  return tf.cond(noise_std > 0.0,
+                 lambda: feats + tf.random_normal(tf.shape(feats), stddev = noise_std),
+                 lambda: feats)
+
+
+def input_queue(holders, capacity):
+  '''
+  puts a FIFOQueue in front of the input placeholders; a feeder thread enqueues batches
+  (NNTrainer.start_feeder) and every step dequeues one, so batches are not fed in the step itself.
+  inputs:
+    holders: list of placeholders, e.g. [feats_holder, labels_holder]
+    capacity: number of batches the queue holds
+  outputs:
+    list of tensors to build the graph on, one per holder; they default to the dequeued batch
+    but can still be fed directly (feed_dict training, decoding)
+  '''
+  # a FIFOQueue only takes fully defined shapes, e.g. not the dynamic time dimension of the lstm
+  shapes = [h.get_shape() for h in holders]
+  if not all(shape.is_fully_defined() for shape in shapes):
+    shapes = None
+  queue = tf.FIFOQueue(capacity, [h.dtype for h in holders], shapes = shapes, name = 'input_queue')
+  enqueue_op = queue.enqueue(holders, name = 'enqueue')
+  batch = queue.dequeue(name = 'dequeue')
+
+  inputs = []
+  for holder, tensor in zip(holders, batch):
+    inputs.append(tf.placeholder_with_default(tensor, holder.get_shape(), 
+                                              name = holder.op.name + '_queued'))
+
+  tf.add_to_collection('enqueue_op', enqueue_op)
+  for holder in holders:
+    tf.add_to_collection('enqueue_holders', holder)
+  return inputs
+
+
+def read_input_queue(graph):
+  '''
+  outputs:
+    enqueue_op (None if the graph has no input queue), list of enqueue holders
+  '''
+  enqueue_op = graph.get_collection('enqueue_op')
+  if len(enqueue_op) == 0:
+    return None, []
+  return enqueue_op[0], graph.get_collection('enqueue_holders')
+
+
+def dequeue_input(enqueue_op):
+  '''
+  a dequeue of its own from the input queue of enqueue_op, e.g. one per step of train_steps
+  outputs:
+    list of tensors, the next batch, in the order of the enqueue holders
+  '''
+  holders = enqueue_op.inputs[1:]
+  queue = tf.QueueBase([h.dtype for h in holders], [h.get_shape() for h in holders], None,
+                       enqueue_op.inputs[0])
+  return queue.dequeue()
+
+
+def proto_lines(nnet_proto_file):
+  ''' lines of a nnet proto, given by its file name or by its text, as kept in the graph '''
+  if nnet_proto_file.lstrip().startswith('<NnetProto>'):
+    return nnet_proto_file.splitlines()
+  with open(nnet_proto_file, 'r') as nnet_proto:
+    return nnet_proto.read().splitlines()
+
+
+def read_nnet_proto(graph):
+  ''' the proto text the graph was created from, None for graphs created without it '''
+  nnet_proto = graph.get_collection('nnet_proto')
+  if len(nnet_proto) == 0:
+    return None
+  # import_meta_graph gives it back as bytes
+  return nnet_proto[0].decode() if isinstance(nnet_proto[0], bytes) else nnet_proto[0]
+
+
+def graph_variable_getter(graph):
+  '''
+  custom getter for tf.variable_scope: tf.get_variable returns the variable of the graph of that
+  name, also in a graph read by import_meta_graph, whose variables tf.get_variable does not know
+  '''
+  variables = dict((v.op.name, v) for v in graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES))
+  # tf passes the default getter as getter=
+  def graph_getter(getter, name, *args, **kwargs):
+    return variables[name]
+  return graph_getter
+
+
 def inference_dnn(feats_holder, nnet_proto_file, keep_prob_holder = None, 
                   reuse = False, prefix = ''):
   '''
@@ -83,8 +191,8 @@ def inference_dnn(feats_holder, nnet_proto_file, keep_prob_holder = None,
     logits: np 2-d array of size [num_batch, num_targets]
   '''
   
-  nnet_proto = open(nnet_proto_file, 'r')
-  line = nnet_proto.readline().strip()
+  nnet_proto = iter(proto_lines(nnet_proto_file))
+  line = next(nnet_proto).strip()
   assert line == '<NnetProto>'
   layer_in = feats_holder
   count_layer = 1
@@ -327,7 +435,8 @@ def loss_lstm(logits, labels, mask):
   cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(
       logits=logits, labels=labels, name='xentropy')
   masked_cross_entropy = tf.multiply(cross_entropy, mask)
-  num_elements = tf.reduce_prod(mask.get_shape())
+  # the time dimension may only be known when the graph runs
+  num_elements = tf.size(mask)
   num_counts = tf.reduce_sum(mask)
   # we use this method because reduce_sum may have numeric issue
   loss = tf.reduce_mean(masked_cross_entropy, name='xentropy-mean') / num_counts * tf.to_float(num_elements)
@@ -347,6 +456,8 @@ def prep_optimizer(op_conf, learning_rate_holder):
   elif op_conf['op_type'] in ['adam', 'Adam']:
     op = tf.train.AdamOptimizer(learning_rate = learning_rate_holder)
 
+  # the trainer names the slots of the training state by it, see NNTrainer.state_names
+  tf.add_to_collection('optimizers', op)
   return op
 
 
@@ -370,6 +481,33 @@ def apply_gradients(op_conf, opt, grads):
   return train_op
 
 
+def train_steps(num_steps, get_batch, inference, opt, op_conf):
+  '''
+  num_steps optimizer steps of a frame model in one run, in a tf.while_loop
+  inputs:
+    num_steps: int32 scalar tensor
+    get_batch: function step -> feats, labels of the step, called in the loop body
+    inference: function feats -> logits, building the model again on the variables it has
+    opt: optimizer of a train op built already, so that it has its slots
+  outputs:
+    number of steps run, and the sums of the losses and of the eval accs of the steps (float64)
+  '''
+  def body(step, sum_loss, sum_acc):
+    # one step after the other: the next reads the variables this one updated
+    with tf.control_dependencies([step]):
+      feats, labels = get_batch(step)
+    logits = inference(feats)
+    loss = loss_dnn(logits, labels)
+    train_op = apply_gradients(op_conf, opt, get_gradients(opt, loss))
+    eval_acc = evaluation_dnn(logits, labels)
+    with tf.control_dependencies([train_op]):
+      return step + 1, sum_loss + tf.cast(loss, tf.float64), sum_acc + tf.cast(eval_acc, tf.float64)
+
+  start = [tf.constant(0), tf.constant(0.0, tf.float64), tf.constant(0.0, tf.float64)]
+  return tf.while_loop(lambda step, sum_loss, sum_acc: step < num_steps, body, start,
+                       parallel_iterations = 1)
+
+
 def evaluation_dnn(logits, labels, mask = None):
   '''
   args:
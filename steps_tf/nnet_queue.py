@@ -30,16 +30,17 @@ class NNSeqQueue(object):
     while start_index + self.max_length <= len(feats):
       end_index = start_index + self.max_length
       feats_packed.append(feats[start_index:end_index])
-      mask.append(np.ones(self.max_length))
+      mask.append(np.ones(self.max_length, dtype = np.float32))
       start_index += self.max_length
 
     if start_index < len(feats):
       # last segment, we shift a bit so we have a full segment
       start_index = max(len(feats) - self.max_length, 0)
       num_zeros = start_index + self.max_length - len(feats)
-      zeros2pad = np.zeros((num_zeros, len(feats[0])))
+      zeros2pad = np.zeros((num_zeros, len(feats[0])), dtype = np.float32)
       feats_packed.append(np.concatenate((feats[start_index:len(feats)], zeros2pad)))
-      mask.append(np.append(np.ones(len(feats)-start_index), np.zeros(num_zeros)))
+      mask.append(np.append(np.ones(len(feats)-start_index, dtype = np.float32),
+                            np.zeros(num_zeros, dtype = np.float32)))
     
     utt_list = [uid] * len(feats_packed)
     return feats_packed, mask, utt_list
@@ -94,9 +95,10 @@ class NNSeqQueue(object):
       batch_feats = np.array(self.feats_queue[0:self.batch_size])
       batch_mask = np.array((self.mask_queue[0:self.batch_size]))
 
-      feats_padded = np.zeros((num_seg2pad, self.max_length, len(self.feats_queue[0][0])))
+      feats_padded = np.zeros((num_seg2pad, self.max_length, len(self.feats_queue[0][0])),
+                              dtype = np.float32)
       batch_feats = np.concatenate((batch_feats, feats_padded))
-      batch_mask = np.concatenate((batch_mask, np.ones((num_seg2pad, self.max_length))))
+      batch_mask = np.concatenate((batch_mask, np.ones((num_seg2pad, self.max_length), dtype = np.float32)))
       batch_utt_list = self.utt_list_queue[0:self.batch_size] + [None]*num_seg2pad
 
       self.process_batch(batch_feats, batch_mask, batch_utt_list)
@@ -1,6 +1,11 @@
 import shutil
 import os
 import time
+import threading
+try:
+  import Queue as queue
+except ImportError:
+  import queue
 import numpy as np
 import tensorflow as tf
 from subprocess import Popen,PIPE
@@ -12,6 +17,7 @@ from bn import BN
 from lstm import LSTM
 from seq2class import SEQ2CLASS
 from jointdnn import JOINTDNN
+from data_generator.generator_state import save_state, load_state
 
 logger = logging.getLogger('__main__')
 logger.setLevel(logging.INFO)
@@ -19,6 +25,23 @@ logger.setLevel(logging.INFO)
 iter_logger = logging.getLogger(__name__)
 iter_logger.setLevel(logging.INFO)
 
+
+def passed_multiple(count, steps, interval):
+  ''' whether a run of steps steps that brought the step count to count passed a multiple of interval '''
+  return count // interval > (count - steps) // interval
+
+
+def host_copies(variables, scope):
+  ''' local variables in host memory under scope, one for each of variables and of its name '''
+  copies = []
+  with tf.device('/cpu:0'), tf.name_scope(scope):
+    for v in variables:
+      copies.append(tf.Variable(tf.zeros(v.get_shape(), v.dtype.base_dtype),
+                                trainable = False, name = v.op.name,
+                                collections = [tf.GraphKeys.LOCAL_VARIABLES]))
+  return copies
+
+
 class NNTrainer(object):
   '''
   a class for a neural network that can be used together with Kaldi.
@@ -38,6 +61,18 @@ class NNTrainer(object):
     self.batch_size = feature_conf['batch_size']
     self.max_length = feature_conf.get('max_length', 0)
     self.jitter_window = feature_conf.get('jitter_window', 0)
+    # feed: batches go through feed_dict; queue: a feeder thread fills a queue in the graph
+    self.input_pipeline = feature_conf.get('input_pipeline', 'feed')
+    if self.input_pipeline == 'queue':
+      input_queue = feature_conf.get('input_queue_capacity', 16)
+    else:
+      input_queue = 0
+    # training steps per sess.run, in a loop in the graph; frame dnns on one tower only
+    self.steps_per_run = nnet_conf.get('steps_per_run', 1)
+    # no ops are added to the graph once training runs, see finalize_graph
+    self.finalize = nnet_conf.get('finalize_graph', True)
+    # the training state is written with the models, see state_filename
+    self.full_state = nnet_conf.get('save_full_state', False)
 
     #nnet training & decoding
     self.buckets_tr = nnet_conf.get('buckets_tr', None)
@@ -47,6 +82,8 @@ class NNTrainer(object):
     # otherwise use prep_learning_rate
     self.global_step = None
     self.learning_rate = None
+    self.add_global = None
+    self.add_global_steps = None
 
     #gpu related
     self.wait_gpu = True
@@ -57,12 +94,40 @@ class NNTrainer(object):
     #summary directory
     self.summary_dir = summary_dir
 
+    # step checkpoints of training iterations, see set_checkpoint_dir
+    self.checkpoint_dir = None
+    self.checkpoint_number = 0
+
+    # saver of the model and the meta graph the models are written with, built with the
+    # graph, see init_savers, and the saver of the training state, see get_state_saver
+    self.model_saver = None
+    self.model_meta_graph = None
+    self.state_saver = None
+    # host copy of the variables that write and save_checkpoint write from, see finalize_graph
+    self.write_buffer_op = None
+
+    # running sums of the step metrics in the graph, see init_metrics
+    self.metric_sums = None
+    self.metric_updates = None
+
+    # in-memory snapshot of the accepted model, see init_snapshot
+    self.take_snapshot_op = None
+    self.snapshot_optimizer = False
+    # models and checkpoints written in the background, see start_write
+    self.writer = None
+    self.write_lock = threading.Lock()
+    self.write_pending = False
+    self.write_error = None
+    self.pending_files = []
+
     if self.arch == 'dnn':
-      self.model = DNN(input_dim, output_dim, self.batch_size, num_gpus)
+      self.model = DNN(input_dim, output_dim, self.batch_size, num_gpus, input_queue,
+                       self.steps_per_run)
     elif self.arch == 'bn':
-      self.model = BN(input_dim, output_dim, self.batch_size, num_gpus)
+      self.model = BN(input_dim, output_dim, self.batch_size, num_gpus, input_queue)
     elif self.arch == 'lstm':
-      self.model = LSTM(input_dim, output_dim, self.batch_size, self.max_length, num_gpus)
+      self.model = LSTM(input_dim, output_dim, self.batch_size, self.max_length, num_gpus,
+                        input_queue)
     elif self.arch == 'seq2class':
       self.model = SEQ2CLASS(input_dim, output_dim, self.batch_size, self.max_length, num_gpus,
                              buckets_tr = self.buckets_tr, buckets = self.buckets)
@@ -78,6 +143,16 @@ class NNTrainer(object):
                             buckets_tr = self.buckets_tr, buckets = self.buckets, mode = 'asr')
     else:
       raise RuntimeError("arch type %s not supported", self.arch)
+
+    if input_queue > 0 and self.arch not in ['dnn', 'bn', 'lstm']:
+      raise RuntimeError("input_pipeline = queue is not supported for arch type %s" % self.arch)
+    if self.steps_per_run > 1:
+      if self.arch != 'dnn' or num_gpus > 1:
+        raise RuntimeError("steps_per_run is only supported for arch type dnn on one gpu")
+      if self.steps_per_run > input_queue > 0:
+        # a run waits for all its batches to be enqueued
+        raise RuntimeError("input_queue_capacity %d is less than steps_per_run %d" % 
+                           (input_queue, self.steps_per_run))
  
 
   def get_max_length(self):
@@ -100,6 +175,7 @@ class NNTrainer(object):
     if action == 'finetune-sid':
       self.model.finetune_sid(self.graph, nnet_proto_file)
       self.sess.run(self.model.get_init_additional_op())
+      self.init_savers()
     else:
       raise RuntimeError('action %s not supported' % action)
     
@@ -109,6 +185,7 @@ class NNTrainer(object):
 
 
   def __exit__ (self):
+    self.wait_write()
     if self.sess is not None:
       self.sess.close()
 
@@ -118,11 +195,13 @@ class NNTrainer(object):
 
     first_session = True
     if self.sess is not None:
+      self.wait_write()
       self.sess.close()
       tf.reset_default_graph()
       first_session = False
 
     self.graph = tf.Graph()
+    self.take_snapshot_op = None
 
     with self.graph.as_default():
       self.saver = tf.train.import_meta_graph(filename+'.meta')
@@ -137,13 +216,113 @@ class NNTrainer(object):
 
     with self.graph.as_default():
       self.saver.restore(self.sess, filename)
+    self.init_savers(self.saver)
 
 
-  def write(self, filename):
+  def init_savers(self, saver = None):
+    '''
+    build the saver of the model (the trainable variables) once, with the graph, instead of
+    a saver for every write; the savers of the write buffer follow in finalize_graph.
+    The meta graph of every model written is exported here too, before the training ops are
+    built, so a model holds no optimizer, write buffer or snapshot and read does not pile them up.
+    input:
+      saver: the saver read imported with the model, reused instead of adding another one
+    '''
     with self.graph.as_default():
-      save_list = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)
-      saver = tf.train.Saver(save_list, max_to_keep=20)
-      saver.save(self.sess, filename)
+      if saver is None:
+        saver = tf.train.Saver(tf.trainable_variables(), max_to_keep = None)
+      self.model_saver = saver
+      self.model_meta_graph = saver.export_meta_graph()
+    self.write_buffer_op = None
+    self.state_saver = None
+
+
+  def has_full_state(self):
+    return self.full_state
+
+
+  def state_filename(self, filename):
+    '''
+    where the training state of the model filename goes with "save_full_state = true" in the
+    [nnet] section, None without: all variables, the model, the optimizer slots and the global step,
+    in the state directory next to the model. Only training resumes from it with read_state;
+    the model itself stays as lean as before, for read and for decoding.
+    '''
+    if not self.full_state:
+      return None
+    return os.path.join(os.path.dirname(filename), 'state', os.path.basename(filename))
+
+
+  def state_names(self, variables):
+    '''
+    names of variables in the training state and the step checkpoints, which do not depend on
+    the ops already in the graph when the training ops were built: a slot of the optimizer is
+    named after its variable and the slot, e.g. w/m with Adam, and the global step global_step;
+    the others keep their names
+    '''
+    names = dict((v.op.name, v.op.name) for v in variables)
+    if self.global_step is not None:
+      names[self.global_step.op.name] = 'global_step'
+    for i, opt in enumerate(self.graph.get_collection('optimizers')):
+      suffix = '' if i == 0 else '_%d' % i
+      for slot_name in opt.get_slot_names():
+        for v in self.graph.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES):
+          slot = opt.get_slot(v, slot_name)
+          if slot is not None:
+            names[slot.op.name] = '%s/%s%s' % (v.op.name, slot_name, suffix)
+    return [ names[v.op.name] for v in variables ]
+
+
+  def get_state_saver(self):
+    # built during setup, once the optimizer and the global step have their variables
+    if self.state_saver is None:
+      with self.graph.as_default():
+        variables = tf.global_variables()
+        self.state_saver = tf.train.Saver(dict(zip(self.state_names(variables), variables)),
+                                          max_to_keep = None)
+    return self.state_saver
+
+
+  def read_state(self, filename):
+    '''
+    restore the training state of state_filename into the model, after init_training, so
+    that the optimizer goes on where it was instead of starting anew
+    '''
+    logger.info("reading training state from %s", filename)
+    self.get_state_saver().restore(self.sess, filename)
+
+
+  def write(self, filename, state_filename = None):
+    '''
+    write the model to filename, and the training state to state_filename if given.
+    Once iter_data has built the write buffer, they are copied to host memory and written
+    from there in a background thread; files that refer to them use write_after
+    '''
+    # one at a time, they share the checkpoint file of the directory
+    self.wait_write()
+    if self.write_buffer_op is None:
+      state_saver = self.get_state_saver() if state_filename is not None else None
+      self.write_model(self.model_saver, filename, state_saver, state_filename)
+      return
+    state_saver = self.buffer_state_saver if state_filename is not None else None
+    self.sess.run(self.write_buffer_op)
+    self.start_write(lambda: self.write_model(self.buffer_model_saver, filename,
+                                              state_saver, state_filename))
+
+
+  def write_model(self, saver, filename, state_saver = None, state_filename = None):
+    '''
+    write the model with saver, and the meta graph of init_savers, without the training ops;
+    then the training state with state_saver, without meta graph, if state_filename is given
+    '''
+    with open(filename+'.meta', 'wb') as meta_file:
+      meta_file.write(self.model_meta_graph.SerializeToString())
+    with self.graph.as_default():
+      saver.save(self.sess, filename, write_meta_graph = False)
+      if state_filename is not None:
+        state_dir = os.path.dirname(state_filename)
+        os.path.isdir(state_dir) or os.makedirs(state_dir)
+        state_saver.save(self.sess, state_filename, write_meta_graph = False)
 
 
   def set_gpu(self):
@@ -171,6 +350,7 @@ class NNTrainer(object):
 
   def init_nnet(self, nnet_proto_file, seed = 777):
     self.graph = tf.Graph()
+    self.take_snapshot_op = None
 
     self.model.init(self.graph, nnet_proto_file, seed)
 
@@ -178,6 +358,7 @@ class NNTrainer(object):
     assert self.sess == None
     self.sess = tf.Session(graph=self.graph, config=tf.ConfigProto(allow_soft_placement=True))
     self.sess.run(self.model.get_init_all_op())
+    self.init_savers()
 
     if self.summary_dir is not None:
       self.summary_writer = tf.summary.FileWriter(self.summary_dir, self.graph)
@@ -189,7 +370,7 @@ class NNTrainer(object):
   def prep_learning_rate(self, initial_lr, decay_steps, decay_rate):
     
     with self.graph.as_default():
-      self.global_step = tf.Variable(0, trainable=False)
+      self.global_step = tf.Variable(0, trainable=False, name = 'global_step')
       self.learning_rate = tf.train.exponential_decay(initial_lr, 
                                         global_step = self.global_step,
                                         decay_steps = decay_steps, 
@@ -197,92 +378,473 @@ class NNTrainer(object):
       self.add_global = self.global_step.assign_add(1)
       step_initializer = tf.variables_initializer([self.global_step], name = 'step_initializer')
       self.sess.run(step_initializer)
+    self.write_buffer_op = None
+    self.state_saver = None
 
      
   def init_training(self, optimizer_conf):
     assert self.graph is not None
     self.model.init_training(self.graph, optimizer_conf, self.learning_rate)
     self.sess.run(self.model.get_init_train_op())
+    self.init_metrics()
+    if self.steps_per_run > 1 and self.global_step is not None:
+      with self.graph.as_default():
+        self.add_global_steps = self.global_step.assign_add(self.model.get_run_steps())
+    self.write_buffer_op = None
+    self.state_saver = None
+
+
+  def init_metrics(self):
+    '''
+    running sums of the metrics of the model (get_bucket_metrics) over the steps of an iteration,
+    as a variable in the graph: the same run as the train op adds those of the step's bucket,
+    so they are only fetched to be logged, and the accuracy covers every step
+    '''
+    with self.graph.as_default():
+      bucket_metrics = self.model.get_bucket_metrics()
+      num_metrics = len(bucket_metrics[0])
+      # local, so neither the model nor the checkpoints save it
+      self.metric_sums = tf.Variable(tf.zeros([num_metrics], dtype = tf.float64), trainable = False,
+                                     collections = [tf.GraphKeys.LOCAL_VARIABLES], name = 'metric_sums')
+      # update op of each bucket, by the loss get_loss returns for it
+      self.metric_updates = {}
+      for metrics in bucket_metrics:
+        values = tf.stack([ tf.cast(metric, tf.float64) for metric in metrics ])
+        self.metric_updates[metrics[0]] = tf.assign_add(self.metric_sums, values).op
+      self.metric_values_holder = tf.placeholder(tf.float64, [num_metrics], name = 'metric_values_holder')
+      self.set_metrics_op = tf.assign(self.metric_sums, self.metric_values_holder).op
+    self.sess.run(self.metric_sums.initializer)
+
+
+  def get_metric_update(self):
+    # to run with the train op of the next batch, after prep_feed picked its bucket
+    return self.metric_updates[self.model.get_loss()]
+
+
+  def set_metrics(self, values):
+    self.sess.run(self.set_metrics_op, feed_dict = {self.metric_values_holder: values})
 
  
+  def init_snapshot(self, with_optimizer = False):
+    '''
+    keep a snapshot of the model in memory, e.g. the accepted one of newbob, to go back to it
+    without reading it from disk and building the training graph again; taken here first.
+    The snapshot is a copy of the variables in host memory, taken and restored by ops built here.
+    input:
+      with_optimizer: restore_snapshot also restores the optimizer slots and the global step,
+                      otherwise the optimizer starts anew, as after read and init_training.
+                      The snapshot holds them anyway with save_full_state, for write_snapshot
+    '''
+    with self.graph.as_default():
+      model_variables = tf.trainable_variables()
+      if with_optimizer or self.full_state:
+        variables = tf.global_variables()
+      else:
+        variables = model_variables
+      snapshot_variables = host_copies(variables, 'snapshot')
+      model_names = set(v.op.name for v in model_variables)
+      self.take_snapshot_op = tf.group(*[ tf.assign(s, v) for s, v in zip(snapshot_variables, variables) ])
+      self.restore_snapshot_op = tf.group(*[ tf.assign(v, s) for s, v in zip(snapshot_variables, variables)
+                                             if with_optimizer or v.op.name in model_names ])
+      # the model as write saves it, and the training state, from the snapshot
+      self.snapshot_saver = tf.train.Saver(dict((v.op.name, s) for s, v in 
+                                                zip(snapshot_variables, variables) 
+                                                if v.op.name in model_names), max_to_keep = None)
+      if self.full_state:
+        self.snapshot_state_saver = tf.train.Saver(dict(zip(self.state_names(variables),
+                                                            snapshot_variables)),
+                                                   max_to_keep = None)
+    self.snapshot_optimizer = with_optimizer
+    self.write_buffer_op = None
+    self.sess.run(tf.variables_initializer(snapshot_variables))
+    self.sess.run(self.take_snapshot_op)
+
+
+  def take_snapshot(self):
+    ''' replace the snapshot by the model as it is '''
+    # the snapshot may still be being written
+    self.wait_write()
+    self.sess.run(self.take_snapshot_op)
+
+
+  def restore_snapshot(self):
+    ''' go back to the model of the snapshot '''
+    self.sess.run(self.restore_snapshot_op)
+    if not self.snapshot_optimizer:
+      self.sess.run(self.model.get_init_train_op())
+
+
+  def write_snapshot(self, filename, state_filename = None):
+    '''
+    write the model of the snapshot to filename, and its training state to state_filename if
+    given, as write does, in a background thread; training goes on meanwhile, files that refer
+    to the model are written with write_after
+    '''
+    self.wait_write()
+    state_saver = self.snapshot_state_saver if state_filename is not None else None
+    self.start_write(lambda: self.write_model(self.snapshot_saver, filename, 
+                                              state_saver, state_filename))
+
+
+  def start_write(self, write):
+    '''
+    run write, a function that writes files from host memory, in a background thread;
+    the files given to write_after meanwhile are written once it is done
+    '''
+    self.write_pending = True
+
+    def run():
+      try:
+        write()
+      except Exception as e:
+        self.write_error = e
+      with self.write_lock:
+        if self.write_error is None:
+          for path, text in self.pending_files:
+            open(path, 'w').write(text)
+        self.pending_files = []
+        self.write_pending = False
+
+    self.writer = threading.Thread(target = run)
+    self.writer.start()
+
+
+  def write_after(self, path, text):
+    ''' write text to path once the model that is being written is complete, right away if none is '''
+    with self.write_lock:
+      if self.write_pending:
+        self.pending_files.append((path, text))
+        return
+    # not if writing the model failed
+    self.wait_write()
+    open(path, 'w').write(text)
+
+
+  def wait_write(self):
+    ''' wait for the model that is being written, raising the error it failed with '''
+    if self.writer is not None:
+      self.writer.join()
+      self.writer = None
+    if self.write_error is not None:
+      error = self.write_error
+      self.write_error = None
+      raise error
+
+
+  def set_checkpoint_dir(self, checkpoint_dir):
+    '''
+    keep step checkpoints of the training iterations in checkpoint_dir, every
+    "checkpoint_steps" steps of the [nnet-train] section: all variables (the model, the
+    optimizer slots and the global step), the state of the data generator, and the sums
+    of the iteration. An interrupted iteration then resumes at the batch after the checkpoint.
+    '''
+    self.checkpoint_dir = checkpoint_dir
+    # the write buffer then holds all variables
+    self.write_buffer_op = None
+
+
+  def get_checkpoint_steps(self, params, validation_mode):
+    if validation_mode or self.checkpoint_dir is None:
+      return 0
+    return params.get('checkpoint_steps', 0)
+
+
+  def save_checkpoint(self, logfile, train_gen, sums, complete = False):
+    '''
+    the variables are copied to host memory and written from there in a background thread,
+    with the state of the generator as it is now; training goes on meanwhile
+    input:
+      sums: list of numbers, the running sums of the iteration
+      complete: the iteration is over, so the generator is not saved; the sums are
+                returned as they are if it is run again, e.g. when validation was interrupted
+    '''
+    os.path.isdir(self.checkpoint_dir) or os.makedirs(self.checkpoint_dir)
+    self.wait_write()
+    self.checkpoint_number += 1
+    checkpoint_number = self.checkpoint_number
+    # copies, the generator goes on with its arrays
+    state = {} if complete else dict((key, np.copy(value)) for key, value in 
+                                     train_gen.get_state().items())
+    state.update({ 'progress_logfile': logfile,
+                   'progress_sums': np.array(sums, dtype = 'float64'),
+                   'progress_complete': complete })
+    self.sess.run(self.write_buffer_op)
+
+    def write():
+      model_path = self.buffer_checkpoint_saver.save(self.sess, self.checkpoint_dir+'/step', 
+                                                     global_step = checkpoint_number,
+                                                     write_meta_graph = False)
+      state['progress_model'] = os.path.basename(model_path)
+      # written last, so it always points to a model that was saved with it
+      save_state(self.checkpoint_dir+'/progress.npz', state)
+
+    self.start_write(write)
+
+
+  def restore_checkpoint(self, logfile, train_gen):
+    '''
+    restore the checkpoint of the iteration that writes logfile, if there is one;
+    a checkpoint of another iteration is removed
+    output:
+      sums as given to save_checkpoint and whether the iteration was complete,
+      or None, None if there is no checkpoint to resume from
+    '''
+    # the checkpoint of the previous iteration may still be being written
+    self.wait_write()
+    self.checkpoint_number = 0
+    progress_file = self.checkpoint_dir+'/progress.npz'
+    if os.path.isfile(progress_file):
+      state = load_state(progress_file)
+      if str(state['progress_logfile']) == logfile:
+        self.get_state_saver().restore(self.sess, self.checkpoint_dir+'/'+str(state['progress_model']))
+        complete = bool(state['progress_complete'])
+        if not complete:
+          train_gen.set_state(state)
+        self.checkpoint_number = int(str(state['progress_model']).split('-')[-1])
+        logger.info("resuming %s from %s", logfile, self.checkpoint_dir)
+        return list(state['progress_sums']), complete
+    if os.path.isdir(self.checkpoint_dir):
+      shutil.rmtree(self.checkpoint_dir)
+    return None, None
+
+
+  def finalize_graph(self):
+    '''
+    build the write buffer, a host copy of the variables that write and save_checkpoint
+    write from, and finalize the graph unless "finalize_graph = false" in the [nnet] section;
+    called by the first iter_data, once the model, the training ops and the snapshot are built
+    '''
+    # restores checkpoints and training states
+    self.get_state_saver()
+    with self.graph.as_default():
+      model_variables = tf.trainable_variables()
+      if self.checkpoint_dir is not None or self.full_state:
+        variables = tf.global_variables()
+      else:
+        variables = model_variables
+      buffer_variables = host_copies(variables, 'write_buffer')
+      self.write_buffer_op = tf.group(*[ tf.assign(b, v) for b, v in zip(buffer_variables, variables) ])
+      model_names = set(v.op.name for v in model_variables)
+      self.buffer_model_saver = tf.train.Saver(dict((v.op.name, b) for b, v in
+                                                    zip(buffer_variables, variables)
+                                                    if v.op.name in model_names), max_to_keep = None)
+      # written from the buffer, restored straight into the variables by the state saver;
+      # savers of their own, the step checkpoints keep the last two only
+      if self.checkpoint_dir is not None:
+        self.buffer_checkpoint_saver = tf.train.Saver(dict(zip(self.state_names(variables),
+                                                               buffer_variables)),
+                                                      max_to_keep = 2)
+      if self.full_state:
+        self.buffer_state_saver = tf.train.Saver(dict(zip(self.state_names(variables),
+                                                          buffer_variables)),
+                                                 max_to_keep = None)
+      buffer_initializer = tf.variables_initializer(buffer_variables)
+    self.sess.run(buffer_initializer)
+
+    if self.finalize:
+      self.graph.finalize()
+    logger.info("training graph of %d ops%s", len(self.graph.get_operations()),
+                ", finalized" if self.finalize else "")
+
+
+  def report_new_ops(self, num_ops, logfile):
+    ''' warn about the ops added to the graph since it had num_ops ops, they slow down every run '''
+    new_ops = self.graph.get_operations()[num_ops:]
+    if len(new_ops) > 0:
+      logger.warning("%d ops were added to the graph during %s: %s", len(new_ops), logfile,
+                     ", ".join(op.name for op in new_ops[:10]) + 
+                     (", ..." if len(new_ops) > 10 else ""))
+
+
   def iter_data(self, logfile, train_gen, params, validation_mode = False):
+    if self.write_buffer_op is None:
+      self.finalize_graph()
+    num_ops = len(self.graph.get_operations())
+
     if self.arch == 'jointdnn':   # not a good implementation here, but let's just use it
-      return self.iter_data_joint(logfile, train_gen, params, validation_mode)
+      result = self.iter_data_joint(logfile, train_gen, params, validation_mode)
     else:
-      return self.iter_data_single(logfile, train_gen, params, validation_mode)
+      result = self.iter_data_single(logfile, train_gen, params, validation_mode)
+
+    self.report_new_ops(num_ops, logfile)
+    return result
+
+
+  def start_feeder(self, train_gen):
+    '''
+    enqueue the batches of train_gen into the input queue of the graph from a background thread
+    output:
+      feeder thread, and a python queue that gets (batch_counts, None) for every enqueued batch,
+      then (None, None) at the end of the data or (None, exception) if the feeder failed
+    '''
+    batch_queue = queue.Queue()
+
+    def feed():
+      try:
+        while True:
+          feed_dict, has_data = self.model.prep_enqueue_feed(train_gen)
+          if not has_data:
+            break
+          self.sess.run(self.model.get_enqueue_op(), feed_dict = feed_dict)
+          batch_queue.put((train_gen.get_last_batch_counts(), None))
+      except Exception as e:
+        batch_queue.put((None, e))
+        return
+      batch_queue.put((None, None))
+
+    feeder = threading.Thread(target = feed)
+    feeder.daemon = True
+    feeder.start()
+    return feeder, batch_queue
+
+
+  def get_queued_batches(self, batch_queue, max_batches):
+    '''
+    wait for up to max_batches batches from the feeder of start_feeder
+    output:
+      number of batches enqueued, 0 at the end of the data, and the sum of their counts
+    '''
+    num_batches = 0
+    sum_counts = 0
+    while num_batches < max_batches:
+      batch_counts, error = batch_queue.get()
+      if error is not None:
+        raise error
+      if batch_counts is None:
+        # back for the next call, which then ends the iteration
+        batch_queue.put((None, None))
+        break
+      num_batches += 1
+      sum_counts += batch_counts
+    return num_batches, sum_counts
 
 
   def iter_data_single(self, logfile, train_gen, params, validation_mode = False):
     '''Train/test one iteration; check if 'learning_rate' in params to specify test mode'''
     assert self.batch_size*self.num_gpus == train_gen.get_batch_size()
 
-    fh = logging.FileHandler(logfile, mode = 'w')
+    use_queue = self.model.has_input_queue()
+    checkpoint_steps = self.get_checkpoint_steps(params, validation_mode)
+    if checkpoint_steps > 0 and use_queue:
+      logger.warning("checkpoint_steps is ignored with input_pipeline = queue, "
+                     "the feeder runs ahead of the training steps")
+      checkpoint_steps = 0
+
+    sums, complete = None, False
+    if checkpoint_steps > 0:
+      sums, complete = self.restore_checkpoint(logfile, train_gen)
+
+    fh = logging.FileHandler(logfile, mode = 'w' if sums is None else 'a')
     iter_logger.addHandler(fh)
 
-    sum_avg_loss = 0
-    sum_accs = 0
     count_steps = 0
-
     sum_counts = 0        # counts could be frames or utterances
-    sum_acc_counts = 0
-
-    start_time = time.time()
-
-    while(True):
-
-      feed_dict, has_data = self.model.prep_feed(train_gen, params)
+    duration = 0
+    metric_sums = [0.0, 0.0]    # sum of avg losses and of accs, in the graph
+    if sums is not None:
+      count_steps, sum_counts, duration = sums[:3]
+      metric_sums = sums[3:]
+      count_steps = int(count_steps)
+    self.set_metrics(metric_sums)
+
+    start_time = time.time() - duration
+
+    if use_queue:
+      feeder, batch_queue = self.start_feeder(train_gen)
+
+    # several training steps in each run, see DNN.init_training_steps
+    run_steps = self.steps_per_run > 1 and not validation_mode
+    add_global = self.add_global_steps if run_steps else self.add_global
+
+    while not complete:
+
+      if use_queue:
+        # the batches themselves are dequeued inside the graph
+        num_steps, batch_counts = self.get_queued_batches(batch_queue, 
+                                                          self.steps_per_run if run_steps else 1)
+        if run_steps:
+          feed_dict = self.model.prep_queued_steps_feed(params, num_steps)
+        else:
+          feed_dict = self.model.prep_params_feed(params)
+        has_data = num_steps > 0
+      elif run_steps:
+        feed_dict, has_data = self.model.prep_steps_feed(train_gen, params)
+        num_steps = self.model.get_last_steps()
+      else:
+        feed_dict, has_data = self.model.prep_feed(train_gen, params)
+        num_steps = 1
                                                  
       if not has_data:   # no more data for training
         break
 
+      # loss and acc go to the metric sums in the graph, nothing is fetched
       if validation_mode:
         # validation mode
-        loss = self.sess.run(self.model.get_loss(), feed_dict = feed_dict)
+        self.sess.run(self.get_metric_update(), feed_dict = feed_dict)
       elif self.global_step is None:
         # training mode: learning rate scheduler
-        _, loss = self.sess.run([self.model.get_train_op(), self.model.get_loss()], feed_dict = feed_dict)
+        self.sess.run([self.model.get_train_op(), self.get_metric_update()], feed_dict = feed_dict)
       else:
         # training mode: exponential decay
-        _, loss, _ = self.sess.run([self.model.get_train_op(), self.model.get_loss(), self.add_global], feed_dict = feed_dict)
+        self.sess.run([self.model.get_train_op(), self.get_metric_update(), add_global],
+                      feed_dict = feed_dict)
 
-      sum_avg_loss += loss
-      count_steps += 1
+      count_steps += num_steps
 
-      batch_counts = train_gen.get_last_batch_counts()
+      if not use_queue:
+        # the batches of a run are all full
+        batch_counts = num_steps * train_gen.get_last_batch_counts()
       sum_counts += batch_counts
 
       duration = time.time() - start_time
 
-      if validation_mode or count_steps % 1000 == 0 or count_steps == 1:
-        acc = self.sess.run(self.model.get_eval_acc(), feed_dict = feed_dict)
-        sum_accs += 1.0 * acc
-        sum_acc_counts += 1.0 * train_gen.get_last_batch_counts()
+      # Print status to stdout.
+      if passed_multiple(count_steps, num_steps, 20) or count_steps == num_steps:
+        if not validation_mode and self.global_step is not None:
+          metric_sums, current_lr = self.sess.run([self.metric_sums, self.learning_rate])
+        else:
+          metric_sums, current_lr = self.sess.run(self.metric_sums), None
+        sum_avg_loss, sum_accs = metric_sums
+
+        message = "Step %5d: avg loss = %.6f on %6d %s (%.2f %s per sec), acc: %.2f%%" % \
+                  (count_steps, sum_avg_loss / (count_steps*self.num_gpus), 
+                  sum_counts, train_gen.count_units(), sum_counts / duration, 
+                  train_gen.count_units(), 100.0*sum_accs/sum_counts)
+
+        if current_lr is not None:
+          message += " cur_lr %.6f" % current_lr
 
-        # Print status to stdout.
-        if count_steps % 20 == 0 or count_steps == 1:
-          message = "Step %5d: avg loss = %.6f on %6d %s (%.2f %s per sec), peek acc: %.2f%%" % \
-                    (count_steps, sum_avg_loss / (count_steps*self.num_gpus), 
-                    sum_counts, train_gen.count_units(), sum_counts / duration, 
-                    train_gen.count_units(), 100.0*acc/train_gen.get_last_batch_counts())
+        iter_logger.info(message)
 
-          if not validation_mode and self.global_step is not None:
-            current_lr = self.sess.run(self.learning_rate)
-            message += " cur_lr %.6f" % current_lr
+      if checkpoint_steps > 0 and passed_multiple(count_steps, num_steps, checkpoint_steps):
+        self.save_checkpoint(logfile, train_gen, [count_steps, sum_counts, duration] +
+                                                 list(self.sess.run(self.metric_sums)))
 
-          iter_logger.info(message)
+    if use_queue:
+      feeder.join()
+
+    metric_sums = list(self.sess.run(self.metric_sums))
+    sum_avg_loss, sum_accs = metric_sums
+
+    if checkpoint_steps > 0 and not complete:
+      self.save_checkpoint(logfile, train_gen, [count_steps, sum_counts, duration] + metric_sums,
+                           complete = True)
+
+    if self.arch == 'lstm':
+      iter_logger.info("Padding: %.2f%% of the time steps run on padding", 100.0*train_gen.get_padding_waste())
 
     # reset batch_generator because it might be used again
     train_gen.reset_batch()
 
     avg_loss = sum_avg_loss / (count_steps * self.num_gpus)
-    if sum_acc_counts == 0:
+    if sum_counts == 0:
       avg_acc = None
       avg_acc_str = str(avg_acc)
     else:
-      avg_acc = sum_accs/sum_acc_counts
+      avg_acc = sum_accs/sum_counts
       avg_acc_str = "%.2f%%" % (100.0*avg_acc)
 
-    iter_logger.info("Complete: avg loss = %.6f on %d %s (%.2f sec passed, %.2f %s per sec), peek acc: %s", 
+    iter_logger.info("Complete: avg loss = %.6f on %d %s (%.2f sec passed, %.2f %s per sec), acc: %s", 
                 avg_loss, sum_counts, train_gen.count_units(), duration, 
                 sum_counts / duration, train_gen.count_units(), avg_acc_str)
 
@@ -295,89 +857,83 @@ class NNTrainer(object):
     '''Train/test one iteration; '''
     assert self.batch_size*self.num_gpus == train_gen.get_batch_size()
 
-    fh = logging.FileHandler(logfile, mode = 'w')
-    iter_logger.addHandler(fh)
+    checkpoint_steps = self.get_checkpoint_steps(params, validation_mode)
+    sums, complete = None, False
+    if checkpoint_steps > 0:
+      sums, complete = self.restore_checkpoint(logfile, train_gen)
 
-    sum_avg_loss = 0
-    sum_avg_asr_loss = 0
-    sum_avg_sid_loss = 0
-    count_steps = 0           # pair to record losses
-
-    sum_asr_accs = 0
-    sum_asr_acc_counts = 0    # pair to record asr accuracy
-
-    sum_sid_accs = 0
-    sum_sid_acc_counts = 0    # pair to record sid accuracy
+    fh = logging.FileHandler(logfile, mode = 'w' if sums is None else 'a')
+    iter_logger.addHandler(fh)
 
-    sum_counts = 0            # to record progression speed
+    count_steps = 0           # to average the losses
+    sum_frames = 0            # to average asr accuracy
+    sum_counts = 0            # utts, to average sid accuracy and to record progression speed
+    duration = 0
+    # sums of avg loss, asr & sid loss, asr & sid accs, in the graph
+    metric_sums = [0.0, 0.0, 0.0, 0.0, 0.0]
+    if sums is not None:
+      count_steps, sum_frames, sum_counts, duration = sums[:4]
+      metric_sums = sums[4:]
+      count_steps = int(count_steps)
+    self.set_metrics(metric_sums)
 
-    start_time = time.time()
+    start_time = time.time() - duration
 
-    while(True):
+    while not complete:
 
       feed_dict, has_data = self.model.prep_feed(train_gen, params)
                                                  
       if not has_data:   # no more data for training
         break
 
+      # losses and accs go to the metric sums in the graph, nothing is fetched
       if validation_mode:
-        loss, asr_loss, sid_loss = self.sess.run(
-                                            [ self.model.get_loss(),
-                                              self.model.get_asr_loss(),
-                                              self.model.get_sid_loss() ], feed_dict = feed_dict)
+        self.sess.run(self.get_metric_update(), feed_dict = feed_dict)
       elif self.global_step is None:
         # training mode: learning rate scheduler
-        _, loss, asr_loss, sid_loss = self.sess.run(
-                                            [ self.model.get_train_op(), 
-                                              self.model.get_loss(),
-                                              self.model.get_asr_loss(),
-                                              self.model.get_sid_loss() ], feed_dict = feed_dict)
+        self.sess.run([self.model.get_train_op(), self.get_metric_update()], feed_dict = feed_dict)
       else:
         # training mode: exponential decay
-        _, loss, asr_loss, sid_loss,  _ = self.sess.run(
-                                            [ self.model.get_train_op(), 
-                                              self.model.get_loss(), 
-                                              self.model.get_asr_loss(),
-                                              self.model.get_sid_loss(),
-                                              self.add_global ], feed_dict = feed_dict)
-
-      sum_avg_loss += loss
-      sum_avg_asr_loss += asr_loss
-      sum_avg_sid_loss += sid_loss
-      count_steps += 1
+        self.sess.run([self.model.get_train_op(), self.get_metric_update(), self.add_global],
+                      feed_dict = feed_dict)
 
-      batch_counts = train_gen.get_last_batch_utts()
-      sum_counts += batch_counts
+      count_steps += 1
+      sum_frames += train_gen.get_last_batch_frames()
+      sum_counts += train_gen.get_last_batch_utts()
 
       duration = time.time() - start_time
 
-      if validation_mode or count_steps % 20 == 0 or count_steps == 1:
-        # we want to check accuracy
-        asr_acc, sid_acc = self.sess.run(
-                                [ self.model.get_asr_eval_acc(),
-                                  self.model.get_sid_eval_acc() ], feed_dict = feed_dict)
+      # Print status to stdout.
+      if count_steps % 20 == 0 or count_steps == 1:
+        if not validation_mode and self.global_step is not None:
+          metric_sums, current_lr = self.sess.run([self.metric_sums, self.learning_rate])
+        else:
+          metric_sums, current_lr = self.sess.run(self.metric_sums), None
+        sum_avg_loss, sum_avg_asr_loss, sum_avg_sid_loss, sum_asr_accs, sum_sid_accs = metric_sums
 
-        sum_asr_accs += 1.0 * asr_acc
-        sum_asr_acc_counts += 1.0 * train_gen.get_last_batch_frames()
-        
-        sum_sid_accs += 1.0 * sid_acc
-        sum_sid_acc_counts += 1.0 * train_gen.get_last_batch_utts()
+        message = "Step %5d: avg loss = %.6f (asr %.6f & sid %.6f) on %6d utts (%.2f utts per sec), asr acc: %.2f%% & sid acc: %.2f%%" % \
+                  (count_steps, sum_avg_loss / (count_steps*self.num_gpus),
+                  sum_avg_asr_loss / (count_steps * self.num_gpus),
+                  sum_avg_sid_loss / (count_steps * self.num_gpus), 
+                  sum_counts, sum_counts / duration,  
+                  100.0*sum_asr_accs/sum_frames,
+                  100.0*sum_sid_accs/sum_counts)
+
+        if current_lr is not None:
+          message += " cur_lr %.6f" % current_lr
+
+        iter_logger.info(message)
 
-        # Print status to stdout.
-        if count_steps % 20 == 0 or count_steps == 1:
-          message = "Step %5d: avg loss = %.6f (asr %.6f & sid %.6f) on %6d utts (%.2f utts per sec), peek asr acc: %.2f%% & sid acc: %.2f%%" % \
-                    (count_steps, sum_avg_loss / (count_steps*self.num_gpus),
-                    sum_avg_asr_loss / (count_steps * self.num_gpus),
-                    sum_avg_sid_loss / (count_steps * self.num_gpus), 
-                    sum_counts, sum_counts / duration,  
-                    100.0*asr_acc/train_gen.get_last_batch_frames(),
-                    100.0*sid_acc/train_gen.get_last_batch_utts())
+      if checkpoint_steps > 0 and count_steps % checkpoint_steps == 0:
+        self.save_checkpoint(logfile, train_gen, [count_steps, sum_frames, sum_counts, duration] +
+                                                 list(self.sess.run(self.metric_sums)))
 
-          if not validation_mode and self.global_step is not None:
-            current_lr = self.sess.run(self.learning_rate)
-            message += " cur_lr %.6f" % current_lr
+    metric_sums = list(self.sess.run(self.metric_sums))
+    sum_avg_loss, sum_avg_asr_loss, sum_avg_sid_loss, sum_asr_accs, sum_sid_accs = metric_sums
 
-          iter_logger.info(message)
+    if checkpoint_steps > 0 and not complete:
+      self.save_checkpoint(logfile, train_gen, [count_steps, sum_frames, sum_counts, duration] +
+                                               metric_sums, complete = True)
 
     # reset batch_generator because it might be used again
     train_gen.reset_batch()
@@ -386,17 +942,17 @@ class NNTrainer(object):
     avg_asr_loss = sum_avg_asr_loss / (count_steps * self.num_gpus)
     avg_sid_loss = sum_avg_sid_loss / (count_steps * self.num_gpus)
 
-    if sum_asr_acc_counts == 0:
+    if sum_frames == 0:
       avg_acc = None
       avg_acc_str = str(avg_acc)
     else:
-      avg_asr_acc = sum_asr_accs/sum_asr_acc_counts
+      avg_asr_acc = sum_asr_accs/sum_frames
       avg_asr_acc_str = "%.2f%%" % (100.0*avg_asr_acc)
-      avg_sid_acc = sum_sid_accs/sum_sid_acc_counts
+      avg_sid_acc = sum_sid_accs/sum_counts
       avg_sid_acc_str = "%.2f%%" % (100.0*avg_sid_acc)
       avg_acc_str = "asr " + avg_asr_acc_str + " sid " + avg_sid_acc_str
 
-    iter_logger.info("Complete: avg loss = %.6f (asr %.6f & sid %.6f) on %d %s (%.2f sec passed, %.2f %s per sec), peek acc: %s", 
+    iter_logger.info("Complete: avg loss = %.6f (asr %.6f & sid %.6f) on %d %s (%.2f sec passed, %.2f %s per sec), acc: %s", 
                 avg_loss, avg_asr_loss, avg_sid_loss, sum_counts, train_gen.count_units(), duration, 
                 sum_counts / duration, train_gen.count_units(), avg_acc_str)
 
@@ -415,8 +971,8 @@ class NNTrainer(object):
     if len(feats) % self.batch_size == 0:
       return feats
     row2pad = self.batch_size - (len(feats) % self.batch_size)
-    feat_dim = len(feats[0])
-    feats_padded = np.vstack([feats, np.zeros([row2pad, feat_dim])])
+    feats_padded = np.zeros([len(feats) + row2pad, feats.shape[1]], dtype = np.float32)
+    feats_padded[:len(feats)] = feats
     return feats_padded
  
  
@@ -425,46 +981,43 @@ class NNTrainer(object):
     args:
       feats: list of array, i.e. matrix of size [num_frames, feat_dim]
     output:
-      feat_packs: np 3-d array of size [num_batches, max_length, feat_dim]
-      seq_length: np array of size [num_batches]
+      feat_packs: float32 np 3-d array of size [num_batches, max_length, feat_dim]
+      seq_length: int32 np array of size [num_batches]
     '''
     batch_size = self.batch_size
     max_length = self.max_length if max_length else None
     jitter_window = self.jitter_window
     start_index = 0
-    feats_packed = []
+    starts = []
     seq_length = []
     post_pick = []
     pick_start = 0
     pick_end = (max_length + jitter_window) // 2
     while start_index + max_length < len(feats):
-      end_index = start_index + max_length
-      feats_packed.append(feats[start_index:end_index])
+      starts.append(start_index)
       seq_length.append(max_length)
       post_pick.append([pick_start, pick_end])
       # only the first window starts from 0, all others start from (max_length - jittter_window) / 2
       pick_start = (max_length - jitter_window) // 2      
       start_index += jitter_window
 
-    num_zero = max_length + start_index - len(feats)
-    zeros2pad = np.zeros((num_zero, len(feats[0])))
-    feats_packed.append(np.concatenate((feats[start_index:], zeros2pad)))
+    starts.append(start_index)
     seq_length.append(len(feats) - start_index)
     # our last window goes till the end of the utterance
     post_pick.append([pick_start, len(feats) - start_index])
 
-    
     # now we need to pad more zeros to fit the place holder, because each place holder can only host [ batch_size x max_length x feat_dim ] this many data
-    batches2pad = batch_size - len(feats_packed) % batch_size
+    batches2pad = batch_size - len(starts) % batch_size
     if batches2pad != 0:
-      zeros2pad = np.zeros((max_length, len(feats[0])))
       for i in range(batches2pad):
-        feats_packed.append(zeros2pad)
         seq_length.append(0)
         post_pick.append([0, 0])
 
-    feats_packed = np.array(feats_packed)
-    seq_length = np.array(seq_length)
+    # windows are copied into one zero padded float32 array, without intermediate copies
+    feats_packed = np.zeros((len(seq_length), max_length, feats.shape[1]), dtype = np.float32)
+    for i, start in enumerate(starts):
+      feats_packed[i, :seq_length[i]] = feats[start:start+seq_length[i]]
+    seq_length = np.array(seq_length, dtype = np.int32)
 
     return feats_packed, seq_length, post_pick
 
@@ -474,31 +1027,20 @@ class NNTrainer(object):
     args:
       feats: list of array, i.e. matrix of size [num_frames, feat_dim]
     output:
-      feat_packs: np 3-d array of size [num_batches, max_length, feat_dim]
+      feat_packs: float32 np 3-d array of size [num_batches, max_length, feat_dim]
     '''
     if max_length is None:
       max_length = self.max_length
-    start_index = 0
-    feats_packed = []
-    while start_index + max_length < len(feats):
-      end_index = start_index + max_length
-      feats_packed.append(feats[start_index:end_index])
-      start_index += max_length
-
-    num_zero = max_length + start_index - len(feats)
-    zeros2pad = np.zeros((num_zero, len(feats[0])))
-    feats_packed.append(np.concatenate((feats[start_index:], zeros2pad)))
+    # windows of max_length frames one after another, the last one zero padded
+    num_windows = max(1, -(-len(feats) // max_length))
     
     # now we need to pad more zeros to fit the place holder, because each place holder can only host [ batch_size, max_length, feat_dim ] this many data
-    batches2pad = self.batch_size - len(feats_packed) % self.batch_size
-    if batches2pad != 0:
-      zeros2pad = np.zeros((max_length, len(feats[0])))
-      for i in range(batches2pad):
-        feats_packed.append(zeros2pad)
+    num_windows += self.batch_size - num_windows % self.batch_size
 
-    feats_packed = np.array(feats_packed)
+    feats_packed = np.zeros((num_windows * max_length, feats.shape[1]), dtype = np.float32)
+    feats_packed[:len(feats)] = feats
 
-    return feats_packed
+    return feats_packed.reshape(num_windows, max_length, feats.shape[1])
 
 
   def predict(self, feats, no_softmax = False):
@@ -678,7 +1220,7 @@ class NNTrainer(object):
     embedding_acc = None
     embedding_count = 0
 
-    mask = np.ones(bucket_size)
+    mask = np.ones(bucket_size, dtype = np.float32)
     while start_index + bucket_size <= len(feats):
       end_index = start_index + bucket_size
       bucket_feats = feats[start_index:end_index]
@@ -694,12 +1236,13 @@ class NNTrainer(object):
     if start_index < len(feats):
       start_index = max(0, len(feats) - bucket_size)
       num_zeros = start_index + bucket_size - len(feats)
-      zeros2pad = np.zeros((num_zeros, len(feats[0])))
       if num_zeros == 0:
         bucket_feats = feats[start_index:]
       else:
-        bucket_feats = np.concatenate((feats[start_index:],zeros2pad))
-        mask = np.append(np.ones(len(feats)-start_index), np.zeros(num_zeros))
+        bucket_feats = np.zeros((bucket_size, feats.shape[1]), dtype = np.float32)
+        bucket_feats[:len(feats)-start_index] = feats[start_index:]
+        mask = np.zeros(bucket_size, dtype = np.float32)
+        mask[:len(feats)-start_index] = 1.0
       embedding = self.gen_embedding(bucket_feats, mask, bucket_id, embedding_index)
       if embedding_acc is None:
         embedding_acc = embedding
@@ -9,6 +9,7 @@ from six.moves import configparser
 from subprocess import Popen, PIPE, check_output
 from nnet_trainer import NNTrainer
 from data_generator import SeqDataGenerator, FrameDataGenerator, UttDataGenerator, JointDNNDataGenerator
+from label_store import load_labels
 import section_config   # my own config parser after configparser
 from scheduler import run_scheduler
 
@@ -31,14 +32,8 @@ def load_utt2label(utt2label_file, convert_int = False):
   return utt2label, labels
 
 def get_alignments(exp, ali_dir):
-  p1 = Popen (['ali-to-pdf', '%s/final.mdl' % exp, 'ark:gunzip -c %s/ali.*.gz |' % ali_dir,
-               'ark,t:-'], stdout = PIPE)
-  ali_labels = {}
-  for line in p1.stdout:
-    line = line.split()
-    utt = line[0]
-    ali_labels[utt] = [int(i) for i in line[1:]]
-  return ali_labels
+  # pdf ids of all utterances in a LabelStore, cached in exp and only built on the first run
+  return load_labels(exp+'/ali_labels', exp+'/final.mdl', ali_dir)
 
 def assign_spk_label(spks):
   spk2label = {}
@@ -143,9 +138,10 @@ num_gpus = nnet_train_conf.get('num_gpus', 1)
 # prepare training data generator
 if nnet_arch == 'lstm':
   tr_gen = UttDataGenerator(data, ali_labels, ali_dir, 
-                            exp, 'train', feature_conf, shuffle=True, num_gpus = num_gpus)
+                            exp, 'train', feature_conf, shuffle=True, num_gpus = num_gpus,
+                            buckets=buckets_tr)
   cv_gen = UttDataGenerator(data, ali_labels, ali_dir, 
-                            exp, 'valid', feature_conf, num_gpus = num_gpus)
+                            exp, 'valid', feature_conf, num_gpus = num_gpus, buckets=buckets_tr)
 elif nnet_arch in ['dnn', 'bn']:
   tr_gen = FrameDataGenerator(data, ali_labels, ali_dir, 
                               exp, 'train', feature_conf, shuffle=True, num_gpus = num_gpus)
@@ -183,6 +179,8 @@ if max_length is not None:
 nnet = NNTrainer(nnet_conf, input_dim, output_dim, feature_conf, 
                  gpu_ids = nnet_train_conf.get('gpu_ids', '-1'),
                  num_gpus = num_gpus, summary_dir = summary_dir)
+# step checkpoints within an iteration, with "checkpoint_steps" in [nnet-train]
+nnet.set_checkpoint_dir(exp+'/checkpoint')
 
 mlp_init = exp+'/model.init'
 
@@ -214,6 +212,11 @@ else:
 
 nnet.init_training(optimizer_conf)
 
+# the optimizer goes on where it was, with save_full_state
+mlp_state = nnet.state_filename(mlp_best)
+if mlp_state is not None and os.path.isfile(mlp_state+'.index'):
+  nnet.read_state(mlp_state)
+
 nnet_valid_conf = {
   'alpha': nnet_train_conf.get('alpha', None),
   'beta': nnet_train_conf.get('beta', None)
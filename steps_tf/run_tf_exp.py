@@ -132,6 +132,8 @@ if 'init_file' in scheduler_conf:
 nnet = NNTrainer(nnet_conf, input_dim, output_dim, 
                  feature_conf['batch_size'], summary_dir = summary_dir,
                  max_length = max_length)
+# step checkpoints within an iteration, with "checkpoint_steps" in [nnet-train]
+nnet.set_checkpoint_dir(exp+'/checkpoint')
 
 mlp_init = exp+'/model.init'
 
@@ -158,6 +160,11 @@ else:
 
 nnet.init_training(optimizer_conf)
 
+# the optimizer goes on where it was, with save_full_state
+mlp_state = nnet.state_filename(mlp_best)
+if mlp_state is not None and os.path.isfile(mlp_state+'.index'):
+  nnet.read_state(mlp_state)
+
 # get all variables for nnet training
 initial_lr = scheduler_conf.get('initial_learning_rate', 1.0)
 final_lr = scheduler_conf.get('final_learning_rate', 0)
@@ -188,13 +195,18 @@ for i in range(num_iters):
 
   mlp_best = "%s/nnet/%s_lr%f_tr%.3f_cv%.3f" % (exp, mlp_current_base, current_lr, loss_tr, loss_cv)
 
-  nnet.write(mlp_best)
-  open(exp+'/nnet/iter%02d.model.txt'%(i+1), 'w').write(mlp_best)
+  # written in the background, the files that refer to it once it is complete
+  mlp_state = nnet.state_filename(mlp_best)
+  nnet.write(mlp_best, mlp_state)
+  nnet.write_after(exp+'/nnet/iter%02d.model.txt'%(i+1), mlp_best)
+  if mlp_state is not None:
+    nnet.write_after(exp+'/nnet/iter%02d.state.txt'%(i+1), mlp_state)
   logger.info("%s done %s, acc_tr %s, acc_cv %s", log_info, mlp_best.split('/')[-1], acc_tr, acc_cv)
 
-  open(exp + '/.done_iter%02d'%(i+1), 'w').write("")
+  nnet.write_after(exp + '/.done_iter%02d'%(i+1), "")
   
 # end of train loop
+nnet.wait_write()
 
 if mlp_best != mlp_init:
   open(exp+'/final.model.txt', 'w').write(mlp_best)
@@ -94,6 +94,8 @@ if max_length is not None:
 nnet = NNTrainer(nnet_conf, input_dim, output_dim, 
                  feature_conf, num_gpus = num_gpus,
                  summary_dir = exp+'/summary')
+# step checkpoints within an iteration, with "checkpoint_steps" in [nnet-train]
+nnet.set_checkpoint_dir(exp+'/checkpoint')
 
 mlp_init = exp+'/model.init'
 
@@ -118,6 +120,11 @@ else:
 
 nnet.init_training(optimizer_conf)
 
+# the optimizer goes on where it was, with save_full_state
+mlp_state = nnet.state_filename(mlp_best)
+if mlp_state is not None and os.path.isfile(mlp_state+'.index'):
+  nnet.read_state(mlp_state)
+
 # get all variables for nnet training
 initial_lr = scheduler_conf.get('initial_learning_rate', 1.0)
 keep_lr_iters = scheduler_conf.get('keep_lr_iters', 0)
@@ -137,6 +144,9 @@ else:
 
 logger.info("### neural net training started at %s", datetime.datetime.today())
 
+# the accepted model is kept in memory, a rejected iteration goes back to it
+nnet.init_snapshot(scheduler_conf.get('rollback_optimizer', nnet.has_full_state()))
+
 loss, acc = nnet.iter_data(exp+'/log/iter00.cv.log', cv_gen, None)
 logger.info("ITERATION 0: loss on cv %.3f, acc_cv %s", loss, acc)
 
@@ -165,19 +175,23 @@ for i in range(max_iters):
     # accepting: the loss was better or we have fixed learn-rate
     loss = loss_cv
     mlp_best = mlp_current
-    nnet.write(mlp_best)
-    open(exp+'/nnet/iter%02d.model.txt'%(i+1), 'w').write(mlp_best)
+    # written in the background, the files that refer to it once it is complete
+    mlp_state = nnet.state_filename(mlp_best)
+    nnet.take_snapshot()
+    nnet.write_snapshot(mlp_best, mlp_state)
+    nnet.write_after(exp+'/nnet/iter%02d.model.txt'%(i+1), mlp_best)
+    if mlp_state is not None:
+      nnet.write_after(exp+'/nnet/iter%02d.state.txt'%(i+1), mlp_state)
     logger.info("%s nnet accepted %s, acc_tr %s, acc_cv %s", log_info, mlp_best.split('/')[-1], acc_tr, acc_cv)
-    open(exp + '/.mlp_best', 'w').write(mlp_best)
+    nnet.write_after(exp + '/.mlp_best', mlp_best)
   else:
     mlp_rej = mlp_current + "_rejected"
     nnet.write(mlp_rej)
-    open(exp+'/nnet/iter%02d.model.txt'%(i+1), 'w').write(mlp_rej)
+    nnet.write_after(exp+'/nnet/iter%02d.model.txt'%(i+1), mlp_rej)
     logger.info("%s nnet rejected %s, acc_tr %s, acc_cv %s", log_info, mlp_rej.split('/')[-1], acc_tr, acc_cv)
-    nnet.read(mlp_best)
-    nnet.init_training(optimizer_conf)
+    nnet.restore_snapshot()
 
-  open(exp + '/.done_iter%02d'%(i+1), 'w').write("")
+  nnet.write_after(exp + '/.done_iter%02d'%(i+1), "")
   
   if i < keep_lr_iters:
     continue
@@ -193,13 +207,14 @@ for i in range(max_iters):
 
   if rel_impr < start_halving_impr:
     halving = True
-    open(exp+'/.halving', 'w').write(str(halving))
+    nnet.write_after(exp+'/.halving', str(halving))
 
   if halving:
     current_lr = current_lr * halving_factor
-    open(exp+'/.learn_rate', 'w').write(str(current_lr))
+    nnet.write_after(exp+'/.learn_rate', str(current_lr))
 
 # end of train loop
+nnet.wait_write()
 
 if mlp_best != mlp_init:
   open(exp+'/final.model.txt', 'w').write(mlp_best)
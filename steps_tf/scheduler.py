@@ -57,13 +57,18 @@ def exponential_scheduler(logger, nnet, scheduler_conf, optimizer_conf, exp,
 
     mlp_best = "%s/nnet/%s_lr%f_tr%.3f_cv%.3f" % (exp, mlp_current_base, current_lr, loss_tr, loss_cv)
 
-    nnet.write(mlp_best)
-    open(exp+'/nnet/iter%02d.model.txt'%(i+1), 'w').write(mlp_best)
+    # written in the background, the files that refer to it once it is complete
+    mlp_state = nnet.state_filename(mlp_best)
+    nnet.write(mlp_best, mlp_state)
+    nnet.write_after(exp+'/nnet/iter%02d.model.txt'%(i+1), mlp_best)
+    if mlp_state is not None:
+      nnet.write_after(exp+'/nnet/iter%02d.state.txt'%(i+1), mlp_state)
     logger.info("%s done %s, acc_tr %s, acc_cv %s", log_info, mlp_best.split('/')[-1], acc_tr, acc_cv)
 
-    open(exp + '/.done_iter%02d'%(i+1), 'w').write("")
+    nnet.write_after(exp + '/.done_iter%02d'%(i+1), "")
   
   # end of train loop
+  nnet.wait_write()
   return mlp_best
   
 
@@ -88,6 +93,9 @@ def newbob_scheduler(logger, nnet, scheduler_conf, optimizer_conf, exp,
 
   logger.info("### neural net training started at %s", datetime.datetime.today())
 
+  # the accepted model is kept in memory, a rejected iteration goes back to it
+  nnet.init_snapshot(scheduler_conf.get('rollback_optimizer', nnet.has_full_state()))
+
   loss, acc = nnet.iter_data(exp+'/log/iter00.cv.log', cv_gen, nnet_valid_conf, validation_mode = True)
   logger.info("ITERATION 0: loss on cv %.3f, acc_cv %s", loss, acc)
 
@@ -113,19 +121,23 @@ def newbob_scheduler(logger, nnet, scheduler_conf, optimizer_conf, exp,
       # accepting: the loss was better or we have fixed learn-rate
       loss = loss_cv
       mlp_best = mlp_current
-      nnet.write(mlp_best)
-      open(exp+'/nnet/iter%02d.model.txt'%(i+1), 'w').write(mlp_best)
+      # written in the background, the files that refer to it once it is complete
+      mlp_state = nnet.state_filename(mlp_best)
+      nnet.take_snapshot()
+      nnet.write_snapshot(mlp_best, mlp_state)
+      nnet.write_after(exp+'/nnet/iter%02d.model.txt'%(i+1), mlp_best)
+      if mlp_state is not None:
+        nnet.write_after(exp+'/nnet/iter%02d.state.txt'%(i+1), mlp_state)
       logger.info("%s nnet accepted %s, acc_tr %s, acc_cv %s", log_info, mlp_best.split('/')[-1], acc_tr, acc_cv)
-      open(exp + '/.mlp_best', 'w').write(mlp_best)
+      nnet.write_after(exp + '/.mlp_best', mlp_best)
     else:
       mlp_rej = mlp_current + "_rejected"
       nnet.write(mlp_rej)
-      open(exp+'/nnet/iter%02d.model.txt'%(i+1), 'w').write(mlp_rej)
+      nnet.write_after(exp+'/nnet/iter%02d.model.txt'%(i+1), mlp_rej)
       logger.info("%s nnet rejected %s, acc_tr %s, acc_cv %s", log_info, mlp_rej.split('/')[-1], acc_tr, acc_cv)
-      nnet.read(mlp_best)
-      nnet.init_training(optimizer_conf)
+      nnet.restore_snapshot()
 
-    open(exp + '/.done_iter%02d'%(i+1), 'w').write("")
+    nnet.write_after(exp + '/.done_iter%02d'%(i+1), "")
     
     if i < keep_lr_iters:
       continue
@@ -141,12 +153,13 @@ def newbob_scheduler(logger, nnet, scheduler_conf, optimizer_conf, exp,
 
     if rel_impr < start_halving_impr:
       halving = True
-      open(exp+'/.halving', 'w').write(str(halving))
+      nnet.write_after(exp+'/.halving', str(halving))
 
     if halving:
       current_lr = current_lr * halving_factor
-      open(exp+'/.learn_rate', 'w').write(str(current_lr))
+      nnet.write_after(exp+'/.learn_rate', str(current_lr))
 
   # end of train loop
+  nnet.wait_write()
   return mlp_best
 
@@ -15,21 +15,28 @@ def parse(config_tuple):
              'num_iters', 'num_gpus', 'num_hidden_layers_after_bn', 'num_proj',
              'pooling_units', 'asr_hidden_layers', 'asr_hidden_units',
              'sid_hidden_layers', 'sid_hidden_units', 'max_split_data_size',
-             'split_per_iter', 'gpu_id']:
+             'split_per_iter', 'gpu_id', 'prefetch_splits', 'split_workers',
+             'split_slots', 'input_queue_capacity', 'shuffle_buffer',
+             'split_memory_budget', 'cmvn_utts', 'cmvn_jobs', 'checkpoint_steps',
+             'time_masks', 'time_mask_width', 'freq_masks', 'freq_mask_width',
+             'steps_per_run']:
       config_parsed[i] = int(config_dict[i])
     elif i in ['halving_factor', 'start_halving_impr', 'end_halving_impr', 
                'initial_learning_rate', 'final_learning_rate', 'momentum', 
                'keep_prob', 'keep_in_prob', 'keep_out_prob', 'alpha', 'beta', 
-               'param_stddev_factor', 'hid_bias_range', 'noise_ratio']:
+               'param_stddev_factor', 'hid_bias_range', 'noise_ratio',
+               'augment_noise', 'speed_perturb']:
       config_parsed[i] = float(config_dict[i])
     elif i in ['batch_norm', 'affine_batch_norm', 'with_softmax', 'use_peepholes', 
                'clip_gradients', 'use_std', 'with_nonlin', 'sid_batch_norm', 'fit_buckets',
                'loop_mode', 'clean_up', 'norm_before_pooling', 'variable_length',
-               'edit_model']:
+               'edit_model', 'lazy_splice', 'stream_labels', 'rollback_optimizer',
+               'finalize_graph', 'save_full_state']:
       config_parsed[i] = str2boolean(config_dict[i])
     elif i in ['nonlin', 'op_type', 'nnet_arch', 'lstm_type', 'feat_type', 
                'delta_opts', 'tmp_dir', 'cmvn_type', 'embedding_layers', 
-               'nnet_proto', 'feat_dir', 'gpu_ids', 'mode', 'scheduler_type']:
+               'nnet_proto', 'feat_dir', 'gpu_ids', 'mode', 'scheduler_type',
+               'frontend', 'shm_dir', 'input_pipeline', 'augment']:
       config_parsed[i] = config_dict[i]
     elif i in ['buckets', 'buckets_tr']: # for list of integers
       config_parsed[i] = [int(x) for x in config_dict[i].split(',')]
@@ -42,9 +42,11 @@ class SEQ2CLASS(object):
 
       keep_prob_holder = tf.placeholder(tf.float32, shape=[], name = 'keep_prob')
       beta_holder = tf.placeholder(tf.float32, shape=[], name = 'beta')
+      noise_std_holder = tf.placeholder_with_default(0.0, shape=[], name = 'noise_std')
       
       tf.add_to_collection('keep_prob_holder', keep_prob_holder)
       tf.add_to_collection('beta_holder', beta_holder)
+      tf.add_to_collection('noise_std_holder', noise_std_holder)
 
       bucket_tr_feats_holders = []
       bucket_tr_mask_holders = []
@@ -61,7 +63,8 @@ class SEQ2CLASS(object):
                                                            self.batch_size,
                                                            name_ext = '_tr'+str(bucket_length))
 
-        logits, _, _ = nnet.inference_seq2class(feats_holder, mask_holder, nnet_proto_file, 
+        noisy_feats = nnet.add_noise(feats_holder, noise_std_holder)
+        logits, _, _ = nnet.inference_seq2class(noisy_feats, mask_holder, nnet_proto_file, 
                                              keep_prob_holder, reuse = reuse)
 
         outputs = tf.nn.softmax(logits)
@@ -103,6 +106,7 @@ class SEQ2CLASS(object):
 
       self.keep_prob_holder = keep_prob_holder
       self.beta_holder = beta_holder
+      self.noise_std_holder = noise_std_holder
 
       self.bucket_tr_feats_holders = bucket_tr_feats_holders
       self.bucket_tr_labels_holders = bucket_tr_labels_holders
@@ -125,9 +129,11 @@ class SEQ2CLASS(object):
 
       keep_prob_holder = tf.placeholder(tf.float32, shape=[], name = 'keep_prob')
       beta_holder = tf.placeholder(tf.float32, shape=[], name = 'beta')
+      noise_std_holder = tf.placeholder_with_default(0.0, shape=[], name = 'noise_std')
       
       tf.add_to_collection('keep_prob_holder', keep_prob_holder)
       tf.add_to_collection('beta_holder', beta_holder)
+      tf.add_to_collection('noise_std_holder', noise_std_holder)
 
       # for training buckets 
       bucket_tr_feats_holders = []
@@ -161,7 +167,8 @@ class SEQ2CLASS(object):
               tower_start_index = i * self.batch_size
               tower_end_index = (i+1) * self.batch_size
 
-              tower_feats_holder = feats_holder[tower_start_index:tower_end_index,:,:]
+              tower_feats_holder = nnet.add_noise(feats_holder[tower_start_index:tower_end_index,:,:],
+                                                  noise_std_holder)
               tower_mask_holder = mask_holder[tower_start_index:tower_end_index]
 
               tower_logit, _, _ = nnet.inference_seq2class(tower_feats_holder,
@@ -204,6 +211,7 @@ class SEQ2CLASS(object):
 
       self.keep_prob_holder = keep_prob_holder
       self.beta_holder = beta_holder
+      self.noise_std_holder = noise_std_holder
 
       self.bucket_tr_feats_holders = bucket_tr_feats_holders
       self.bucket_tr_mask_holders = bucket_tr_mask_holders
@@ -237,6 +245,9 @@ class SEQ2CLASS(object):
     self.keep_prob_holder = graph.get_collection('keep_prob_holder')[0]
     self.beta_holder = graph.get_collection('beta_holder')[0] if \
                             graph.get_collection('beta_holder') else None
+    # models from before the noise moved into the graph have none
+    self.noise_std_holder = graph.get_collection('noise_std_holder')[0] if \
+                            graph.get_collection('noise_std_holder') else None
     
     self.bucket_tr_feats_holders = [ x for x in graph.get_collection('bucket_tr_feats_holders') ]
     self.bucket_tr_mask_holders = [ x for x in graph.get_collection('bucket_tr_mask_holders') ]
@@ -258,6 +269,9 @@ class SEQ2CLASS(object):
     self.keep_prob_holder = graph.get_collection('keep_prob_holder')[0]
     self.beta_holder = graph.get_collection('beta_holder')[0] if \
                             graph.get_collection('beta_holder') else None
+    # models from before the noise moved into the graph have none
+    self.noise_std_holder = graph.get_collection('noise_std_holder')[0] if \
+                            graph.get_collection('noise_std_holder') else None
 
     self.bucket_tr_feats_holders = [ x for x in graph.get_collection('bucket_tr_feats_holders') ]
     self.bucket_tr_mask_holders = [ x for x in graph.get_collection('bucket_tr_mask_holders') ]
@@ -405,6 +419,11 @@ class SEQ2CLASS(object):
     return self.bucket_tr_train_op[self.last_bucket_id]
 
 
+  def get_bucket_metrics(self):
+    ''' [loss, eval acc] of each bucket, the loss as get_loss returns it '''
+    return [ list(metrics) for metrics in zip(self.bucket_tr_loss, self.bucket_tr_eval_acc) ]
+
+
   def get_logits(self):
     return self.bucket_tr_logits[self.last_bucket_id]
 
@@ -435,7 +454,14 @@ class SEQ2CLASS(object):
                   self.keep_prob_holder: params.get('keep_prob', 1.0),
                   self.beta_holder: params.get('beta', 0.0)})
 
-    return feed_dict, x is not None
+    # only the training data generator has noise
+    noise_ratio = data_gen.get_noise_ratio()
+    if noise_ratio != 0.0:
+      if self.noise_std_holder is None:
+        raise RuntimeError('noise_ratio needs a model with noise_std in its graph, initialize it again')
+      feed_dict[self.noise_std_holder] = noise_ratio
+
+    return nnet.check_feed(feed_dict), x is not None
 
 
   def prep_forward_feed(self, x, mask, bucket_id, embedding_index):
@@ -448,4 +474,4 @@ class SEQ2CLASS(object):
                   self.keep_prob_holder: 1.0,
                   self.beta_holder: 0.0}
 
-    return feed_dict, embedding
+    return nnet.check_feed(feed_dict), embedding